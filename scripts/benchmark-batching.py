@@ -0,0 +1,103 @@
+from os.path import join
+
+import time
+import random
+import argparse
+
+import pandas as pd
+
+from prompt_batching import (
+    get_token_lengths,
+    get_token_budget_batches,
+    get_fixed_size_batches,
+    get_padded_token_count,
+)
+
+SHARE_DIR = "/project/zwang3049/diffusiondb-hugging"
+
+parser = argparse.ArgumentParser(
+    description="Compare fixed-size and token-budget batching on real prompts"
+)
+parser.add_argument(
+    "-n", "--num_prompts", type=int, default=20000, help="Number of sampled prompts"
+)
+parser.add_argument(
+    "-b", "--batch_size", type=int, default=256, help="Fixed batch size"
+)
+parser.add_argument(
+    "-t",
+    "--max_tokens",
+    type=int,
+    default=16384,
+    help="Max number of padded tokens per batch",
+)
+parser.add_argument(
+    "-m",
+    "--run_model",
+    default=False,
+    help="Also time the Detoxify model with both batching methods",
+    action="store_true",
+)
+parser.add_argument(
+    "-d", "--device", type=str, default="cpu", help="Torch device to use"
+)
+
+
+def time_model(toxicity_model, prompts, batches):
+    """
+    Time the model prediction over all batches. Return the elapsed seconds.
+    """
+    start_time = time.time()
+    for batch in batches:
+        toxicity_model.predict([prompts[i] for i in batch])
+    return time.time() - start_time
+
+
+def main():
+    """
+    Main function
+    """
+    args = parser.parse_args()
+
+    # Sample unique prompts to keep the real prompt length distribution
+    prompts = pd.read_parquet(join(SHARE_DIR, "metadata.parquet"), columns=["prompt"])
+    prompts = list(pd.unique(prompts["prompt"]))
+    random.seed(0)
+    prompts = random.sample(prompts, min(args.num_prompts, len(prompts)))
+
+    toxicity_model = None
+    tokenizer = None
+    if args.run_model:
+        import torch
+        from detoxify import Detoxify
+
+        toxicity_model = Detoxify("multilingual", device=torch.device(args.device))
+        tokenizer = toxicity_model.tokenizer
+
+    lengths = get_token_lengths(prompts, tokenizer)
+    real_token_count = sum(lengths)
+
+    batching_methods = {
+        "fixed": get_fixed_size_batches(len(prompts), args.batch_size),
+        "token-budget": get_token_budget_batches(
+            lengths, args.max_tokens, args.batch_size
+        ),
+    }
+
+    for name, batches in batching_methods.items():
+        padded_token_count = get_padded_token_count(lengths, batches)
+        print(
+            f"{name}: {len(batches)} batches, {padded_token_count} padded tokens, "
+            f"{real_token_count / padded_token_count:.1%} of them are real tokens"
+        )
+
+        if toxicity_model is not None:
+            seconds = time_model(toxicity_model, prompts, batches)
+            print(
+                f"{name}: {real_token_count / seconds:.1f} tokens/sec, "
+                f"{len(prompts) / seconds:.1f} prompts/sec"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import time
+import argparse
+
+import numpy as np
+
+from explorer_data import (
+    get_padded_ranges,
+    get_naive_kde_grid,
+    get_fft_kde_grid,
+)
+
+# The naive KDE is timed on this many points and extrapolated linearly
+NAIVE_SAMPLE_SIZE = 100000
+
+parser = argparse.ArgumentParser(
+    description="Compare the naive KDE grid and the FFT KDE grid"
+)
+parser.add_argument(
+    "-p",
+    "--projection",
+    type=str,
+    default=None,
+    help="Path to a .npy 2D projection (a synthetic mixture if not given)",
+)
+parser.add_argument(
+    "-s",
+    "--sizes",
+    type=int,
+    nargs="+",
+    default=[1000000, 14000000],
+    help="Numbers of points to benchmark",
+)
+parser.add_argument(
+    "-n",
+    "--naive_sample_size",
+    type=int,
+    default=NAIVE_SAMPLE_SIZE,
+    help="Number of points the naive KDE is timed on",
+)
+
+
+def get_synthetic_points(size, rng):
+    """
+    Sample points from a mixture of Gaussian clusters, which looks like a UMAP
+    projection.
+    """
+    centers = rng.uniform(-15, 15, size=(50, 2))
+    scales = rng.uniform(0.3, 2, size=50)
+    cluster_ids = rng.integers(0, 50, size=size)
+    points = centers[cluster_ids] + rng.normal(size=(size, 2)) * scales[
+        cluster_ids, None
+    ]
+    return points.astype(np.float32)
+
+
+def main():
+    """
+    Main function
+    """
+    args = parser.parse_args()
+    rng = np.random.default_rng(0)
+
+    if args.projection is not None:
+        projection = np.load(args.projection)
+
+    for size in args.sizes:
+        if args.projection is not None:
+            points = projection[rng.choice(len(projection), size, replace=True)]
+        else:
+            points = get_synthetic_points(size, rng)
+
+        x_range, y_range = get_padded_ranges(points)
+
+        start_time = time.time()
+        get_fft_kde_grid(points, x_range, y_range)
+        fft_seconds = time.time() - start_time
+
+        # The naive KDE is linear in the number of points
+        naive_size = min(size, args.naive_sample_size)
+        sample = points[:naive_size]
+        start_time = time.time()
+        naive_grid = get_naive_kde_grid(sample, x_range, y_range)
+        naive_seconds = (time.time() - start_time) * size / naive_size
+
+        # Compare both methods on the same points
+        fft_grid = get_fft_kde_grid(sample, x_range, y_range)
+        max_error = np.abs(fft_grid - naive_grid).max() / naive_grid.max()
+        cell_area = (
+            (x_range[1] - x_range[0]) * (y_range[1] - y_range[0]) / fft_grid.size
+        )
+
+        print(f"{size} points:")
+        print(f"\tFFT KDE: {fft_seconds:.2f} seconds")
+        print(
+            f"\tNaive KDE: {naive_seconds:.1f} seconds "
+            f"(extrapolated from {naive_size} points)"
+        )
+        print(f"\tSpeedup: {naive_seconds / fft_seconds:.0f}x")
+        print(f"\tMax error relative to the peak: {max_error:.2%}")
+        print(f"\tFFT grid integral: {fft_grid.sum() * cell_area:.4f}")
+
+
+if __name__ == "__main__":
+    main()
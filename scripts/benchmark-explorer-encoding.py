@@ -0,0 +1,115 @@
+from os.path import join, getsize
+from json import load
+
+import gzip
+import time
+import argparse
+import tempfile
+
+import numpy as np
+
+from explorer_data import write_binary_data, read_binary_data
+
+parser = argparse.ArgumentParser(
+    description="Compare the json and binary explorer grid and topic data"
+)
+parser.add_argument(
+    "name", type=str, nargs="?", default="1m", help="Name of the map, for example 1m"
+)
+parser.add_argument(
+    "-d", "--data_dir", type=str, default="./explorer/data", help="Data directory"
+)
+parser.add_argument(
+    "-r", "--repeat", type=int, default=20, help="Number of timed parses"
+)
+
+
+def get_gzip_size(path):
+    """
+    Get the gzip size of a file, which is close to what the server sends.
+    """
+    with open(path, "rb") as fp:
+        return len(gzip.compress(fp.read()))
+
+
+def time_parse(parse, repeat):
+    """
+    Get the best time of repeated parses in milliseconds.
+    """
+    best_seconds = float("inf")
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        parse()
+        best_seconds = min(best_seconds, time.perf_counter() - start_time)
+    return best_seconds * 1000
+
+
+def main():
+    """
+    Main function
+    """
+    args = parser.parse_args()
+    json_paths = [
+        join(args.data_dir, f"umap-{args.name}-grid.json"),
+        join(args.data_dir, f"umap-{args.name}-topic-data.json"),
+    ]
+
+    grid_data = load(open(json_paths[0], "r", encoding="utf8"))
+    topic_data = load(open(json_paths[1], "r", encoding="utf8"))
+
+    def parse_json():
+        for path in json_paths:
+            with open(path, "r", encoding="utf8") as fp:
+                load(fp)
+
+    for grid_dtype in [np.uint16, np.uint8]:
+        with tempfile.TemporaryDirectory() as binary_dir:
+            manifest = write_binary_data(
+                args.name, grid_data, topic_data, binary_dir, grid_dtype
+            )
+            binary_paths = [
+                join(binary_dir, manifest["grid"]["file"]),
+                join(binary_dir, manifest["topic"]["file"]),
+                join(binary_dir, f"umap-{args.name}-binary.json"),
+            ]
+
+            json_ms = time_parse(parse_json, args.repeat)
+            binary_ms = time_parse(
+                lambda: read_binary_data(manifest, binary_dir), args.repeat
+            )
+            decoded_grid, decoded_topics = read_binary_data(manifest, binary_dir)
+
+            json_size = sum(getsize(p) for p in json_paths)
+            binary_size = sum(getsize(p) for p in binary_paths)
+            json_gzip_size = sum(get_gzip_size(p) for p in json_paths)
+            binary_gzip_size = sum(get_gzip_size(p) for p in binary_paths)
+
+            grid = np.array(grid_data["grid"])
+            max_error = np.abs(decoded_grid["grid"] - grid).max()
+            label_count = sum(
+                len(labels) for _, labels in decoded_topics["data"].values()
+            )
+
+            print(f"Binary with {np.dtype(grid_dtype).name} grid:")
+            print(
+                f"\tSize: json {json_size / 1e3:.1f} KB, "
+                f"binary {binary_size / 1e3:.1f} KB "
+                f"({json_size / binary_size:.1f}x smaller)"
+            )
+            print(
+                f"\tGzip size: json {json_gzip_size / 1e3:.1f} KB, "
+                f"binary {binary_gzip_size / 1e3:.1f} KB"
+            )
+            print(
+                f"\tParse time: json {json_ms:.1f} ms, binary {binary_ms:.1f} ms "
+                f"({json_ms / binary_ms:.1f}x faster)"
+            )
+            print(
+                f"\tMax grid error: {max_error:.2e} "
+                f"({max_error / grid.max():.3%} of the peak)"
+            )
+            print(f"\tTopic labels: {label_count}")
+
+
+if __name__ == "__main__":
+    main()
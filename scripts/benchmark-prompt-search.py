@@ -0,0 +1,78 @@
+from os.path import join
+
+import time
+import argparse
+
+import numpy as np
+
+from embedding_store import open_store
+from prompt_search import IVFIndex, brute_force_search
+
+WORK_DIR = "/nvmescratch/jay/diffusiondb"
+STORE_DIR = join(WORK_DIR, "prompt-embeddings")
+
+parser = argparse.ArgumentParser(
+    description="Measure the QPS and recall@10 of the IVF index against brute force"
+)
+parser.add_argument(
+    "-n", "--num_queries", type=int, default=1000, help="Number of sampled queries"
+)
+parser.add_argument(
+    "-p",
+    "--n_probes",
+    type=int,
+    nargs="+",
+    default=[4, 8, 16, 32, 64],
+    help="Numbers of lists to scan",
+)
+parser.add_argument(
+    "-k", "--k", type=int, default=10, help="Number of results per query"
+)
+
+
+def main():
+    """
+    Main function
+    """
+    args = parser.parse_args()
+
+    store = open_store(STORE_DIR)
+    vectors, _ = store.get_all()
+
+    # Load the vectors in memory, so we time the search instead of the disk
+    vectors = np.asarray(vectors)
+    print(f"{len(vectors)} vectors of {vectors.shape[1]} dimensions")
+
+    start_time = time.time()
+    index = IVFIndex.build(vectors)
+    print(
+        f"Built {len(index.centroids)} lists in {time.time() - start_time:.1f} "
+        "seconds"
+    )
+
+    # Stored prompts as queries, the nearest result is the query itself
+    rng = np.random.default_rng(0)
+    query_rows = rng.choice(len(vectors), args.num_queries, replace=False)
+    queries = np.asarray(vectors[query_rows], dtype=np.float32)
+
+    start_time = time.time()
+    true_rows = [set(brute_force_search(vectors, q, args.k)[0]) for q in queries]
+    brute_force_seconds = time.time() - start_time
+    print(f"Brute force: {args.num_queries / brute_force_seconds:.1f} QPS")
+
+    for n_probe in args.n_probes:
+        start_time = time.time()
+        found_rows = [index.search(vectors, q, args.k, n_probe)[0] for q in queries]
+        seconds = time.time() - start_time
+
+        recall = np.mean(
+            [len(t.intersection(f)) / args.k for t, f in zip(true_rows, found_rows)]
+        )
+        print(
+            f"IVF n_probe={n_probe}: {args.num_queries / seconds:.1f} QPS "
+            f"({brute_force_seconds / seconds:.1f}x), recall@{args.k} {recall:.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
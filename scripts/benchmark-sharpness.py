@@ -0,0 +1,83 @@
+from zipfile import ZipFile
+from sys import argv
+
+import time
+import cv2
+
+import numpy as np
+import tensorflow as tf
+
+from sharpness import get_sharpness_cv2, get_sharpness_tf, BLUR_THRESHOLD
+
+# A part zip file used as the fixture set
+FIXTURE_ZIP = "/project/zwang3049/diffusiondb-hugging/images/part-000001.zip"
+MAX_IMAGES = 1000
+
+if len(argv) > 1:
+    FIXTURE_ZIP = argv[1]
+
+
+def load_fixture_images():
+    """
+    Decode the images in the fixture zip file as RGB arrays.
+    """
+    images = []
+    with ZipFile(FIXTURE_ZIP) as zip_file:
+        for name in zip_file.namelist():
+            if not name.endswith((".png", ".webp")):
+                continue
+
+            img_bytes = np.frombuffer(zip_file.read(name), dtype=np.uint8)
+            img = cv2.imdecode(img_bytes, cv2.IMREAD_COLOR)
+            images.append(cv2.cvtColor(img, cv2.COLOR_BGR2RGB))
+
+            if len(images) == MAX_IMAGES:
+                break
+
+    return images
+
+
+def main():
+    """
+    Compare the OpenCV and TensorFlow sharpness scores on the fixture images.
+    """
+    images = load_fixture_images()
+    print("Loaded", len(images), "images from", FIXTURE_ZIP)
+
+    # Current implementation: one OpenCV call per image, serially
+    start_time = time.time()
+    cv2_scores = np.array([get_sharpness_cv2(img) for img in images])
+    cv2_seconds = time.time() - start_time
+
+    # TF ops in a parallel tf.data map, as in the NSFW decode stage
+    dataset = (
+        tf.data.Dataset.from_generator(
+            lambda: iter(images),
+            output_signature=tf.TensorSpec(shape=(None, None, 3), dtype=tf.uint8),
+        )
+        .map(
+            get_sharpness_tf,
+            num_parallel_calls=tf.data.AUTOTUNE,
+            deterministic=True,
+        )
+        .batch(128)
+    )
+
+    start_time = time.time()
+    tf_scores = np.concatenate([batch.numpy() for batch in dataset])
+    tf_seconds = time.time() - start_time
+
+    cv2_flags = cv2_scores < BLUR_THRESHOLD
+    tf_flags = tf_scores < BLUR_THRESHOLD
+
+    print(f"OpenCV: {len(images) / cv2_seconds:.1f} images/sec")
+    print(f"TF map: {len(images) / tf_seconds:.1f} images/sec")
+    print("Score mismatches:", np.sum(cv2_scores != tf_scores))
+    print("Blur flag mismatches:", np.sum(cv2_flags != tf_flags))
+    print("Blurry images:", np.sum(cv2_flags))
+
+    assert np.array_equal(cv2_flags, tf_flags), "Blur flags do not agree"
+
+
+if __name__ == "__main__":
+    main()
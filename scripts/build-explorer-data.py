@@ -0,0 +1,152 @@
+from os.path import exists, join
+from multiprocessing import Pool
+
+import os
+import time
+import argparse
+
+import numpy as np
+
+from explorer_data import (
+    timed_stage,
+    stage_seconds,
+    load_unique_prompts,
+    get_tfidf_embeddings,
+    project_embeddings,
+    get_grid_data,
+    get_topic_data,
+    write_points,
+    write_json,
+    write_binary_data,
+)
+
+SHARE_DIR = "/project/zwang3049/diffusiondb-hugging"
+OUTPUT_DIR = "./explorer/data"
+N_PROC = 36
+
+parser = argparse.ArgumentParser(
+    description="Build the data files of the DiffusionDB Explorer"
+)
+parser.add_argument(
+    "name", type=str, help="Name of the output files, for example 1m or 14m"
+)
+parser.add_argument(
+    "-m",
+    "--metadata",
+    type=str,
+    default=join(SHARE_DIR, "metadata.parquet"),
+    help="Path to the metadata parquet file",
+)
+parser.add_argument(
+    "-e",
+    "--embeddings",
+    type=str,
+    default=None,
+    help="Path to a .npy embedding file aligned with the unique prompts",
+)
+parser.add_argument(
+    "-p",
+    "--projection",
+    type=str,
+    default=None,
+    help="Path to a .npy 2D projection aligned with the unique prompts",
+)
+parser.add_argument(
+    "-g",
+    "--grid_dtype",
+    type=str,
+    default="uint16",
+    choices=["uint8", "uint16"],
+    help="Quantization of the binary density grid",
+)
+parser.add_argument(
+    "-o", "--output_dir", type=str, default=OUTPUT_DIR, help="Output directory"
+)
+
+
+def load_points(args, prompts):
+    """Load or compute the 2D projection of the unique prompts. A projection
+    file is used as is, otherwise the embeddings (or TF-IDF embeddings) are
+    projected with UMAP, and the projection is saved for the next run.
+
+    Args:
+        args (Namespace): Command line arguments
+        prompts ([string]): Unique prompts
+
+    Returns:
+        np.ndarray: Projected points with shape (len(prompts), 2)
+    """
+    projection_path = args.projection or join(
+        args.output_dir, f"umap-{args.name}-projection.npy"
+    )
+
+    if exists(projection_path):
+        with timed_stage("load projection"):
+            points = np.load(projection_path)
+    else:
+        with timed_stage("embed"):
+            if args.embeddings is not None:
+                embeddings = np.load(args.embeddings, mmap_mode="r")
+            else:
+                embeddings = get_tfidf_embeddings(prompts)
+
+        with timed_stage("project"):
+            points = project_embeddings(embeddings, n_jobs=N_PROC)
+            np.save(projection_path, points)
+
+    if len(points) != len(prompts):
+        raise ValueError(
+            f"The projection has {len(points)} rows but there are "
+            f"{len(prompts)} unique prompts"
+        )
+
+    return points
+
+
+def main():
+    """
+    Main function
+    """
+    args = parser.parse_args()
+    start_time = time.time()
+
+    if not exists(args.output_dir):
+        os.makedirs(args.output_dir)
+
+    with timed_stage("load prompts"):
+        prompts = load_unique_prompts(args.metadata)
+        print(f"Loaded {len(prompts)} unique prompts")
+
+    points = load_points(args, prompts)
+
+    with Pool(1) as p:
+        # The grid does not depend on the topics, so compute it on a worker
+        # while the topic levels are built
+        grid_result = p.apply_async(get_grid_data, (points,))
+
+        with timed_stage("topics"):
+            topic_data = get_topic_data(points, prompts, n_proc=N_PROC)
+            write_json(
+                topic_data, join(args.output_dir, f"umap-{args.name}-topic-data.json")
+            )
+
+        with timed_stage("grid"):
+            grid_data = grid_result.get()
+            write_json(grid_data, join(args.output_dir, f"umap-{args.name}-grid.json"))
+
+    with timed_stage("binary"):
+        grid_dtype = np.uint8 if args.grid_dtype == "uint8" else np.uint16
+        write_binary_data(args.name, grid_data, topic_data, args.output_dir, grid_dtype)
+
+    with timed_stage("points"):
+        write_points(points, prompts, join(args.output_dir, f"umap-{args.name}.ndjson"))
+
+    print("\nStage times:")
+    for name, seconds in stage_seconds.items():
+        print(f"\t{name}: {seconds:.1f} seconds")
+
+    print("Finished in", (time.time() - start_time) / 60, "minutes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,311 @@
+from glob import glob
+from os.path import exists, join
+from collections import Counter
+from multiprocessing import Pool
+from functools import partial
+from itertools import islice
+
+import os
+import re
+import time
+import zlib
+import shutil
+import argparse
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+from explorer_data import timed_stage, stage_seconds, write_json
+
+SHARE_DIR = "/project/zwang3049/diffusiondb-hugging"
+WORK_DIR = "/project/zwang3049/diffusiondb/phrase-counts"
+OUTPUT_DIR = "./explorer/data"
+N_PROC = 36
+
+# Number of prompts each counting task reads
+BATCH_SIZE = 200000
+
+# Phrase counts are split into shards by hash, so each shard fits in memory
+N_SHARDS = 64
+
+# Longest phrase (in words) in the tree: head, com, com2
+MAX_PHRASE_WORDS = 3
+
+# Phrases used fewer times are dropped when shards are reduced
+MIN_PHRASE_COUNT = 200
+
+# Number of top-level phrases and of children kept under each phrase
+TOP_K_ROOT = 200
+TOP_K_CHILDREN = 100
+
+# Labels of the tree levels below the top-level phrases
+CHILD_LABELS = ["com", "com2"]
+
+# Words that cannot end a phrase
+STOP_WORDS = {"a", "an", "the", "of", "and", "in", "with", "by", "on", "for", "to"}
+
+parser = argparse.ArgumentParser(description="Build phrases-tree.json from prompts")
+parser.add_argument(
+    "-l",
+    "--large",
+    default=False,
+    help="Use metadata-large.parquet",
+    action="store_true",
+)
+parser.add_argument(
+    "-o", "--output_dir", type=str, default=OUTPUT_DIR, help="Output directory"
+)
+
+
+def get_clause_phrases(prompt):
+    """Split a prompt into comma clauses, and get the phrases that end each
+    clause: its last word (the head), and the head extended to the left with up
+    to MAX_PHRASE_WORDS words.
+
+    Args:
+        prompt (string): Prompt
+
+    Returns:
+        [string]: Phrases, from the shortest to the longest of each clause
+    """
+    phrases = []
+
+    for clause in re.split(r"[,|;]", prompt.lower()):
+        words = re.findall(r"\w[\w'\-]*", clause)
+        if len(words) == 0 or words[-1] in STOP_WORDS:
+            continue
+
+        for length in range(1, min(len(words), MAX_PHRASE_WORDS) + 1):
+            phrases.append(" ".join(words[-length:]))
+
+    return phrases
+
+
+def get_shard_id(phrase):
+    """
+    Get the shard of a phrase. crc32 is the same in every process, unlike
+    hash() of strings.
+    """
+    return zlib.crc32(phrase.encode("utf8")) % N_SHARDS
+
+
+def count_one_batch(batch, count_dir):
+    """Count the phrases of a batch of prompts, and write the counts of each
+    shard to count_dir/shard-XXX/batch-XXXXXX.parquet.
+
+    Args:
+        batch ((int, [string])): Batch id and its prompts
+        count_dir (string): Directory of the shard counts
+
+    Returns:
+        int: Number of counted prompts
+    """
+    batch_i, prompts = batch
+    counter = Counter()
+
+    for prompt in prompts:
+        if prompt is not None:
+            counter.update(get_clause_phrases(prompt))
+
+    count_df = pd.DataFrame(
+        {"phrase": list(counter.keys()), "count": list(counter.values())}
+    )
+    count_df["shard"] = [get_shard_id(p) for p in count_df["phrase"]]
+
+    for shard_id, shard_df in count_df.groupby("shard"):
+        shard_df[["phrase", "count"]].to_parquet(
+            join(count_dir, f"shard-{shard_id:03}", f"batch-{batch_i:06}.parquet"),
+            index=False,
+        )
+
+    return len(prompts)
+
+
+def reduce_one_shard(shard_dir):
+    """Sum the counts of one shard over all batches, and drop rare phrases.
+
+    Args:
+        shard_dir (string): Directory of the shard counts
+
+    Returns:
+        pd.DataFrame: Columns phrase and count
+    """
+    count_paths = glob(join(shard_dir, "*.parquet"))
+    if len(count_paths) == 0:
+        return pd.DataFrame({"phrase": [], "count": []})
+
+    count_df = pd.concat([pd.read_parquet(p) for p in count_paths])
+    count_df = count_df.groupby("phrase", as_index=False)["count"].sum()
+    return count_df[count_df["count"] >= MIN_PHRASE_COUNT]
+
+
+def read_prompt_batches(metadata_path):
+    """
+    Stream the prompt column of a metadata table in batches.
+    """
+    parquet_file = pq.ParquetFile(metadata_path)
+
+    for batch_i, batch in enumerate(
+        parquet_file.iter_batches(batch_size=BATCH_SIZE, columns=["prompt"])
+    ):
+        yield batch_i, batch.column("prompt").to_pylist()
+
+
+def label_top_phrases(phrases):
+    """Label top-level phrases with their spaCy entity type, "np" for nouns,
+    or "dm" for descriptors. Only the kept top-level phrases are parsed, so it
+    is cheap. Without spaCy, every phrase is labeled "np".
+
+    Args:
+        phrases ([string]): Top-level phrases
+
+    Returns:
+        {string: string}: Label of each phrase
+    """
+    try:
+        import spacy
+
+        nlp = spacy.load("en_core_web_sm")
+    except (ImportError, OSError):
+        print("spaCy or en_core_web_sm is not installed, labeling all phrases np")
+        return {p: "np" for p in phrases}
+
+    labels = {}
+    for phrase, doc in zip(phrases, nlp.pipe(phrases)):
+        if len(doc.ents) > 0:
+            labels[phrase] = doc.ents[-1].label_
+        elif doc[-1].pos_ in ["NOUN", "PROPN"]:
+            labels[phrase] = "np"
+        else:
+            labels[phrase] = "dm"
+
+    return labels
+
+
+def get_child_nodes(phrase, counts_by_words, depth, level=0):
+    """Build the child nodes of a phrase: the phrases that extend it by one
+    word to the left, top TOP_K_CHILDREN by count.
+
+    Args:
+        phrase (string): Parent phrase
+        counts_by_words ({int: {string: {string: int}}}): Phrase counts by
+            number of words, then by the phrase without its first word
+        depth (int): Number of words of the children
+        level (int): Tree level of the children below the top-level phrases
+
+    Returns:
+        [dict]: Child nodes
+    """
+    if depth > MAX_PHRASE_WORDS or level >= len(CHILD_LABELS):
+        return []
+
+    children = counts_by_words[depth].get(phrase, {})
+    top_children = sorted(children.items(), key=lambda x: -x[1])[:TOP_K_CHILDREN]
+    nodes = []
+
+    for child, count in top_children:
+        node = {"n": child, "v": int(count), "l": CHILD_LABELS[level]}
+        grandchildren = get_child_nodes(child, counts_by_words, depth + 1, level + 1)
+        if len(grandchildren) > 0:
+            node["c"] = grandchildren
+        nodes.append(node)
+
+    return nodes
+
+
+def build_tree(phrase_df):
+    """Build the phrase tree from the phrase counts.
+
+    Args:
+        phrase_df (pd.DataFrame): Columns phrase and count
+
+    Returns:
+        dict: Tree of {"n": phrase, "v": count, "l": label, "c": children}
+    """
+    counts_by_words = {length: {} for length in range(1, MAX_PHRASE_WORDS + 1)}
+    top_candidates = {}
+
+    for phrase, count in zip(phrase_df["phrase"], phrase_df["count"]):
+        words = phrase.split(" ")
+        parent = " ".join(words[1:])
+        counts_by_words[len(words)].setdefault(parent, {})[phrase] = count
+
+        # Frequent multi-word phrases (e.g. greg rutkowski, highly detailed)
+        # are top-level phrases too, unless they start with a stop word
+        if words[0] not in STOP_WORDS:
+            top_candidates[phrase] = count
+
+    top_phrases = sorted(top_candidates.items(), key=lambda x: -x[1])
+    top_phrases = top_phrases[:TOP_K_ROOT]
+    labels = label_top_phrases([p for p, _ in top_phrases])
+
+    nodes = []
+    for phrase, count in top_phrases:
+        node = {"n": phrase, "v": int(count), "l": labels[phrase]}
+        children = get_child_nodes(
+            phrase, counts_by_words, len(phrase.split(" ")) + 1
+        )
+        if len(children) > 0:
+            node["c"] = children
+        nodes.append(node)
+
+    return {"n": "root", "c": nodes, "l": "root", "v": 0}
+
+
+def main():
+    """
+    Main function
+    """
+    args = parser.parse_args()
+    start_time = time.time()
+
+    if args.large:
+        metadata_path = join(SHARE_DIR, "metadata-large.parquet")
+    else:
+        metadata_path = join(SHARE_DIR, "metadata.parquet")
+
+    # Start from empty shards, so counts of an old run are never added
+    if exists(WORK_DIR):
+        shutil.rmtree(WORK_DIR)
+    shard_dirs = [join(WORK_DIR, f"shard-{i:03}") for i in range(N_SHARDS)]
+    for shard_dir in shard_dirs:
+        os.makedirs(shard_dir)
+
+    with Pool(N_PROC) as p:
+        with timed_stage("count"):
+            prompt_count = 0
+            batches = read_prompt_batches(metadata_path)
+
+            # Pool reads its input eagerly, so feed it a few batches per worker
+            # at a time to bound the memory
+            while True:
+                window = list(islice(batches, 2 * N_PROC))
+                if len(window) == 0:
+                    break
+
+                for batch_prompt_count in p.imap_unordered(
+                    partial(count_one_batch, count_dir=WORK_DIR), window
+                ):
+                    prompt_count += batch_prompt_count
+
+            print(f"Counted phrases of {prompt_count} prompts")
+
+        with timed_stage("reduce"):
+            phrase_df = pd.concat(p.map(reduce_one_shard, shard_dirs))
+            print(f"Kept {len(phrase_df)} phrases")
+
+    with timed_stage("tree"):
+        tree = build_tree(phrase_df)
+        write_json(tree, join(args.output_dir, "phrases-tree.json"))
+
+    shutil.rmtree(WORK_DIR)
+
+    print("\nStage times:")
+    for name, seconds in stage_seconds.items():
+        print(f"\t{name}: {seconds:.1f} seconds")
+
+    print("Finished in", (time.time() - start_time) / 60, "minutes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,45 @@
+from os.path import join
+
+import time
+import argparse
+
+from prompt_index import build_prompt_index
+
+SHARE_DIR = "/project/zwang3049/diffusiondb-hugging"
+WORK_DIR = "/nvmescratch/jay/diffusiondb"
+N_PROC = 36
+
+parser = argparse.ArgumentParser(description="Build the inverted index of prompts")
+parser.add_argument(
+    "-l",
+    "--large",
+    default=False,
+    help="Index DiffusionDB Large instead of DiffusionDB 2M",
+    action="store_true",
+)
+
+
+def main():
+    """
+    Main function
+    """
+    args = parser.parse_args()
+    start_time = time.time()
+
+    if args.large:
+        metadata_path = join(SHARE_DIR, "metadata-large.parquet")
+        index_dir = join(WORK_DIR, "prompt-index-large")
+    else:
+        metadata_path = join(SHARE_DIR, "metadata.parquet")
+        index_dir = join(WORK_DIR, "prompt-index-2m")
+
+    meta = build_prompt_index(metadata_path, index_dir, N_PROC)
+    print(
+        f"Indexed {meta['token_count']} tokens of {meta['prompt_count']} prompts "
+        f"({meta['row_count']} rows) in {index_dir}"
+    )
+    print("Finished in", (time.time() - start_time) / 60, "minutes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,208 @@
+from os.path import join
+from multiprocessing import Pool
+
+import re
+import time
+import zlib
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+SHARE_DIR = "/project/zwang3049/diffusiondb-hugging"
+WORK_DIR = "/nvmescratch/jay/diffusiondb"
+N_PROC = 36
+
+# Two prompts are near duplicates if their estimated Jaccard similarity of
+# words is at least this. Swapping one word of a 4-word prompt gives 0.6
+JACCARD_THRESHOLD = 0.6
+
+# Number of MinHash permutations, split into LSH bands of rows. Two prompts
+# share a bucket in some band with probability 1 - (1 - J^BAND_ROWS)^N_BANDS,
+# which rises around (1 / N_BANDS)^(1 / BAND_ROWS) = 0.42, below the threshold
+NUM_PERM = 128
+N_BANDS = 32
+BAND_ROWS = NUM_PERM // N_BANDS
+
+# Number of prompts each signature task handles, and the number of prompts
+# hashed at a time inside a task (bounds the permutation x shingle matrix)
+TASK_SIZE = 50000
+HASH_BATCH_SIZE = 2000
+
+# Number of candidate pairs verified at a time
+VERIFY_BATCH_SIZE = 100000
+
+# Multiply-shift hash functions ((a * x + b) mod 2^64) >> 32 with odd a
+_rng = np.random.default_rng(0)
+HASH_A = _rng.integers(1, 2**63, size=NUM_PERM, dtype=np.uint64) | np.uint64(1)
+HASH_B = _rng.integers(0, 2**63, size=NUM_PERM, dtype=np.uint64)
+
+parser = argparse.ArgumentParser(description="Cluster near-duplicate prompts")
+parser.add_argument(
+    "-l",
+    "--large",
+    default=False,
+    help="Cluster prompts in DiffusionDB Large instead of DiffusionDB 2M",
+    action="store_true",
+)
+
+
+def get_shingles(prompt):
+    """
+    Get the words of a prompt. Empty prompts use the empty string.
+    """
+    words = set(re.findall(r"\w+", prompt.lower()))
+    return words if len(words) > 0 else {""}
+
+
+def get_signatures(prompts):
+    """Compute the MinHash signatures of prompts.
+
+    Args:
+        prompts ([string]): Prompts
+
+    Returns:
+        np.ndarray: uint32 signatures with shape (len(prompts), NUM_PERM)
+    """
+    shingle_hashes = []
+    starts = []
+
+    for prompt in prompts:
+        starts.append(len(shingle_hashes))
+        shingle_hashes.extend(
+            zlib.crc32(s.encode("utf8")) for s in get_shingles(prompt)
+        )
+
+    shingle_hashes = np.array(shingle_hashes, dtype=np.uint64)
+    hashed = HASH_A[:, None] * shingle_hashes[None, :] + HASH_B[:, None]
+    hashed >>= np.uint64(32)
+
+    # The minimum hash of each prompt's shingles
+    return np.minimum.reduceat(hashed, starts, axis=1).T.astype(np.uint32)
+
+
+def sign_one_task(task):
+    """Compute the signatures of a range of prompts and write them into the
+    shared signature file.
+
+    Args:
+        task ((string, int, [string])): Signature file path, first prompt id,
+            and prompts
+    """
+    signature_path, first_prompt_id, prompts = task
+    signatures = np.load(signature_path, mmap_mode="r+")
+
+    for lower in range(0, len(prompts), HASH_BATCH_SIZE):
+        batch = prompts[lower : lower + HASH_BATCH_SIZE]
+        start = first_prompt_id + lower
+        signatures[start : start + len(batch)] = get_signatures(batch)
+
+    signatures.flush()
+
+
+def get_band_edges(task):
+    """Find verified near-duplicate pairs among the prompts that share a
+    bucket in one LSH band. Each prompt in a bucket is paired with the first
+    prompt of the bucket.
+
+    Args:
+        task ((string, int)): Signature file path and band id
+
+    Returns:
+        np.ndarray: Prompt id pairs with shape (n, 2)
+    """
+    signature_path, band_i = task
+    signatures = np.load(signature_path, mmap_mode="r")
+    band = np.array(signatures[:, band_i * BAND_ROWS : (band_i + 1) * BAND_ROWS])
+
+    # Fold the rows of the band into one key
+    keys = np.zeros(len(band), dtype=np.uint64)
+    for row_i in range(BAND_ROWS):
+        keys = (keys * np.uint64(0x100000001B3)) ^ band[:, row_i].astype(np.uint64)
+
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    is_bucket_start = np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]
+    bucket_firsts = order[np.where(is_bucket_start)[0]][np.cumsum(is_bucket_start) - 1]
+
+    firsts = bucket_firsts[~is_bucket_start]
+    members = order[~is_bucket_start]
+
+    # Bands can collide on dissimilar prompts, verify with the full signatures
+    is_similar = np.zeros(len(members), dtype=bool)
+    for lower in range(0, len(members), VERIFY_BATCH_SIZE):
+        upper = lower + VERIFY_BATCH_SIZE
+        similarity = np.mean(
+            signatures[firsts[lower:upper]] == signatures[members[lower:upper]],
+            axis=1,
+        )
+        is_similar[lower:upper] = similarity >= JACCARD_THRESHOLD
+
+    return np.stack([firsts[is_similar], members[is_similar]], axis=1)
+
+
+def main():
+    """
+    Main function
+    """
+    args = parser.parse_args()
+    start_time = time.time()
+    if args.large:
+        metadata_path = join(SHARE_DIR, "metadata-large.parquet")
+        output_path = join(WORK_DIR, "prompt-clusters-large.parquet")
+    else:
+        metadata_path = join(SHARE_DIR, "metadata.parquet")
+        output_path = join(WORK_DIR, "prompt-clusters-2m.parquet")
+
+    metadata_df = pd.read_parquet(metadata_path, columns=["image_name", "prompt"])
+    prompt_codes, prompts = pd.factorize(metadata_df["prompt"].fillna(""))
+    prompts = list(prompts)
+    print(f"{len(metadata_df)} rows, {len(prompts)} unique prompts")
+
+    # Signatures live in a file, so workers write and read them without
+    # holding all of them in memory
+    signature_path = join(WORK_DIR, "prompt-signatures.npy")
+    np.lib.format.open_memmap(
+        signature_path, mode="w+", dtype=np.uint32, shape=(len(prompts), NUM_PERM)
+    ).flush()
+
+    with Pool(N_PROC) as p:
+        tasks = [
+            (signature_path, lower, prompts[lower : lower + TASK_SIZE])
+            for lower in range(0, len(prompts), TASK_SIZE)
+        ]
+        p.map(sign_one_task, tasks)
+        print(f"Computed signatures in {time.time() - start_time:.1f} seconds")
+
+        band_edges = p.map(
+            get_band_edges, [(signature_path, i) for i in range(N_BANDS)]
+        )
+
+    edges = np.concatenate(band_edges)
+    print(f"Found {len(edges)} near-duplicate pairs")
+
+    # Near-duplicate clusters are the connected components of the pair graph
+    graph = coo_matrix(
+        (np.ones(len(edges), dtype=np.int8), (edges[:, 0], edges[:, 1])),
+        shape=(len(prompts), len(prompts)),
+    )
+    cluster_count, prompt_clusters = connected_components(graph, directed=False)
+
+    pd.DataFrame(
+        {
+            "image_name": metadata_df["image_name"],
+            "prompt_cluster_id": prompt_clusters[prompt_codes].astype(np.uint32),
+        }
+    ).to_parquet(output_path, index=False)
+
+    print(
+        f"{len(prompts)} unique prompts in {cluster_count} near-duplicate "
+        f"clusters ({1 - cluster_count / len(prompts):.1%} fewer)"
+    )
+    print("Finished in", (time.time() - start_time) / 60, "minutes")
+
+
+if __name__ == "__main__":
+    main()
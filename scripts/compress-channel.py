@@ -4,12 +4,16 @@ from tqdm import tqdm
 from json import load, dump
 from multiprocessing import Pool
 from functools import partial
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
 
 import re
 import os
 import shutil
 import time
 import random
+import argparse
+
+from zip_index import save_zip_index, get_index_path
 
 PART_DIR = "/project/zwang3049/diffusiondb/images"
 SHARE_PART_DIR = "/project/zwang3049/diffusiondb-hugging/images"
@@ -18,30 +22,153 @@ N_PROC = 36
 if not exists(SHARE_PART_DIR):
     os.makedirs(SHARE_PART_DIR)
 
+parser = argparse.ArgumentParser(description="Zip image part folders")
+parser.add_argument(
+    "parts",
+    type=str,
+    help="Part ids to zip, for example 1741-2000 or 1,5,10-20",
+)
+parser.add_argument(
+    "-i",
+    "--image_compression",
+    type=str,
+    default="stored",
+    choices=["stored", "deflated"],
+    help="Compression of image members (PNG and WebP are already compressed)",
+)
+parser.add_argument(
+    "-c",
+    "--compress_level",
+    type=int,
+    default=9,
+    help="Deflate level of deflated members (0-9)",
+)
+
+
+def parse_part_ids(parts_str):
+    """Parse a part id list like "1,5,10-20" into a list of ints.
+
+    Args:
+        parts_str (string): Comma separated part ids or inclusive ranges
+
+    Returns:
+        [int]: Sorted unique part ids
+    """
+    part_ids = set()
+
+    for item in parts_str.split(","):
+        item = item.strip()
+        if "-" in item:
+            lower, higher = item.split("-")
+            part_ids.update(range(int(lower), int(higher) + 1))
+        elif item != "":
+            part_ids.add(int(item))
+
+    return sorted(part_ids)
+
+
+def get_member_names(cur_part_path):
+    """
+    Get the member names of a part in zip order: json files first, then sorted
+    images, so readers can parse the metadata before streaming the images.
+    """
+    names = sorted(os.listdir(cur_part_path))
+    json_names = [n for n in names if n.endswith(".json")]
+    image_names = [n for n in names if not n.endswith(".json")]
+    return json_names + image_names
+
 
-def zip_dir(cur_part):
+def verify_zip(zip_path, member_names):
+    """Check the member order and CRCs of a written zip file.
+
+    Args:
+        zip_path (string): Path to the zip file
+        member_names ([string]): Expected member names in order
+
+    Returns:
+        bool: True if the zip file is valid
+    """
+    with ZipFile(zip_path) as zip_file:
+        if zip_file.namelist() != member_names:
+            return False
+
+        # testzip() reads every member and returns the first one with a bad CRC
+        return zip_file.testzip() is None
+
+
+def zip_dir(cur_part, image_compression=ZIP_STORED, compress_level=9):
     """
     Zip a image part folder.
     Args:
         cur_part (int): The id of the image part folder
+        image_compression (int): Compression type of image members
+        compress_level (int): Deflate level of deflated members
+    Returns:
+        bool: True if the zip file is written and verified
     """
     cur_part_path = join(PART_DIR, f"part-{cur_part:06}")
-    cur_zip_path = join(SHARE_PART_DIR, f"part-{cur_part:06}")
-    shutil.make_archive(cur_zip_path, "zip", cur_part_path)
+    cur_zip_path = join(SHARE_PART_DIR, f"part-{cur_part:06}.zip")
+    member_names = get_member_names(cur_part_path)
+
+    # Remove the stale index first, so it never describes a different zip file
+    if exists(get_index_path(cur_zip_path)):
+        os.remove(get_index_path(cur_zip_path))
+
+    # Write to a temporary file, so readers never see a partial zip file
+    tmp_zip_path = cur_zip_path + ".tmp"
+
+    with ZipFile(tmp_zip_path, "w", compresslevel=compress_level) as zip_file:
+        for name in member_names:
+            # Images are already compressed, only deflate the json file
+            compress_type = (
+                ZIP_DEFLATED if name.endswith(".json") else image_compression
+            )
+            zip_file.write(
+                join(cur_part_path, name), arcname=name, compress_type=compress_type
+            )
+
+    if not verify_zip(tmp_zip_path, member_names):
+        print("Error: failed to verify", cur_zip_path)
+        os.remove(tmp_zip_path)
+        return False
+
+    os.replace(tmp_zip_path, cur_zip_path)
+
+    # Save the member index (offset, size, crc) for random access readers
+    save_zip_index(cur_zip_path)
+    return True
 
 
 def main():
     """
     Main function
     """
+    args = parser.parse_args()
 
     start_time = time.time()
-    part_ids = list(range(1741, 2001))
+    part_ids = parse_part_ids(args.parts)
+    image_compression = ZIP_STORED if args.image_compression == "stored" else ZIP_DEFLATED
 
     # Zip files in parallel
     print(part_ids)
     with Pool(N_PROC) as p:
-        result = list(tqdm(p.imap(zip_dir, part_ids), total=len(part_ids)))
+        result = list(
+            tqdm(
+                p.imap(
+                    partial(
+                        zip_dir,
+                        image_compression=image_compression,
+                        compress_level=args.compress_level,
+                    ),
+                    part_ids,
+                ),
+                total=len(part_ids),
+            )
+        )
+
+    failed_part_ids = [i for i, r in zip(part_ids, result) if not r]
+    if len(failed_part_ids) > 0:
+        print("Failed parts:", failed_part_ids)
 
     print("Finished in", (time.time() - start_time) / 60, "minutes")
 
@@ -1,19 +1,22 @@
-from glob import glob
-from os.path import exists, join, basename
+from os.path import exists, join
 from tqdm import tqdm
 from json import load, dump
-from multiprocessing import Process, JoinableQueue
+from multiprocessing import Process, Queue
+from queue import Empty
+from collections import deque
+from zipfile import ZipFile
 
+import sys
 import time
-import shutil
+import traceback
 import os
-import random
-import cv2
 import multiprocessing
 
 import numpy as np
-import tensorflow_io as tfio
-import tensorflow_hub as hub
+
+from sharpness import get_sharpness_tf, BLUR_THRESHOLD
+from inference_backend import pin_worker_threads, get_cpu_worker_count
+from zip_index import get_index_path, load_zip_index, read_member
 
 LARGE_MODE = True
 
@@ -21,6 +24,22 @@ BATCH_SIZE = 128
 USE_CPU = False
 VERBOSE = False
 
+# GPUs used by the consumers (one consumer per GPU id in this list)
+GPU_IDS = [2, 3, 2, 3]
+# Number of threads (and cores) of each consumer when USE_CPU is True
+THREADS_PER_CPU_WORKER = 8
+
+# Number of parts queued ahead for each worker
+PREFETCH_DEPTH = 2
+# Number of times we try to score a part before marking it as failed
+MAX_ATTEMPTS = 3
+# Number of times a worker is restarted before it is retired, a worker that
+# keeps dying (e.g. a broken GPU) would otherwise burn every part's attempts
+MAX_WORKER_RESTARTS = 5
+WORKER_CHECK_SECONDS = 30
+# Seconds between progress summaries and status.json snapshots
+SUMMARY_SECONDS = 600
+
 ZIP_DIR1 = "/project/zwang3049/diffusiondb-hugging/diffusiondb-large-part-1/"
 ZIP_DIR2 = "/project/zwang3049/diffusiondb-hugging/diffusiondb-large-part-2/"
 ZIP_DIR_2M = "/project/zwang3049/diffusiondb-hugging/images/"
@@ -32,46 +51,88 @@ else:
     NSFW_SCORE_DIR = "/nvmescratch/jay/diffusiondb/nsfw-scores-2m"
 
 
+def get_zip_path(part_id):
+    """
+    Get the path of a part zip file on the share.
+    """
+    if LARGE_MODE:
+        if part_id > 10000:
+            return join(ZIP_DIR2, f"part-{part_id:06}.zip")
+        else:
+            return join(ZIP_DIR1, f"part-{part_id:06}.zip")
+    else:
+        return join(ZIP_DIR_2M, f"part-{part_id:06}.zip")
+
+
+def producer_read_images(zip_path, member_names):
+    """
+    Stream the bytes of image members straight out of a part zip file, without
+    copying or extracting the archive. If the zip file has a member index, read
+    each member with one positioned read instead of parsing the zip headers.
+    """
+    if exists(get_index_path(zip_path)):
+        members = load_zip_index(zip_path)["members"]
+        fd = os.open(zip_path, os.O_RDONLY)
+        try:
+            for name in member_names:
+                yield read_member(fd, members[name])
+        finally:
+            os.close(fd)
+    else:
+        with ZipFile(zip_path) as zip_file:
+            for name in member_names:
+                yield zip_file.read(name)
+
+
 def consumer_detect_nsfw(
-    zipped_queue: JoinableQueue,
-    unzipped_queue: JoinableQueue,
-    part_ids_queue: JoinableQueue,
+    task_queue: Queue,
+    result_queue: Queue,
+    worker_id: int,
     gpu_id: int,
 ):
     """
-    Predict NSFW scores for all iamges in the folder.
+    Predict NSFW scores for all iamges in the part zip files. Report the status
+    of each part to the result_queue.
     """
 
+    # Pin the threads before tensorflow starts its thread pools. Workers are
+    # spawned, so tensorflow and its extensions are only imported here
+    if USE_CPU:
+        os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
+        pin_worker_threads(worker_id, THREADS_PER_CPU_WORKER)
+
     import tensorflow as tf
+    import tensorflow_io as tfio
+    import tensorflow_hub as hub
 
-    global tf
+    if USE_CPU:
+        tf.config.threading.set_intra_op_parallelism_threads(THREADS_PER_CPU_WORKER)
+        tf.config.threading.set_inter_op_parallelism_threads(1)
 
     gpus = tf.config.experimental.list_physical_devices("GPU")
     for gpu in gpus:
         tf.config.experimental.set_memory_growth(gpu, True)
 
-    def get_prompt(file_path, json_data):
+    def get_prompt(img_name, json_data):
         """
         Get the image prompt.
         """
-        img_name = basename(file_path)
         return json_data[img_name]["p"]
 
-    def get_image(file_path):
+    def decode_webp(img_file):
+        return tfio.image.decode_webp(img_file)[:, :, :3]
+
+    def decode_png(img_file):
+        return tf.io.decode_image(img_file, expand_animations=False)[:, :, :3]
+
+    def get_image(img_file, decode_fn):
         """
         Get the processed image array and its sharpness score.
         """
-        # Read the image
-        img_file = tf.io.read_file(file_path)
-        if ".webp" in file_path:
-            img = tfio.image.decode_webp(img_file)[:, :, :3]
-        elif ".png" in file_path:
-            img = tf.io.decode_image(img_file)[:, :, :3]
-
-        # Blur detection
-        # shaprness = cv2.Laplacian(img.numpy(), cv2.CV_64F).var()
-        gray = cv2.cvtColor(img.numpy(), cv2.COLOR_RGB2GRAY)
-        shaprness = np.max(cv2.convertScaleAbs(cv2.Laplacian(gray, 3)))
+        img = decode_fn(img_file)
+
+        # Blur detection (computed in the parallel decode stage with TF ops)
+        shaprness = get_sharpness_tf(img)
 
         # Rescale to 0-1
         normalizer = tf.keras.layers.Rescaling(1.0 / 255)
@@ -81,139 +142,210 @@ def consumer_detect_nsfw(
 
         return normalizer(resized_img), shaprness
 
+    def get_dataset(zip_path, member_names, decode_fn):
+        """
+        Create a pipeline that streams images from the zip file, decodes them in
+        parallel and yields fixed-size batches. Reading and decoding the next
+        batches overlaps with the inference.
+        """
+        return (
+            tf.data.Dataset.from_generator(
+                lambda: producer_read_images(zip_path, member_names),
+                output_signature=tf.TensorSpec(shape=(), dtype=tf.string),
+            )
+            .map(
+                lambda f: get_image(f, decode_fn),
+                num_parallel_calls=tf.data.AUTOTUNE,
+                deterministic=True,
+            )
+            .batch(BATCH_SIZE)
+            .prefetch(tf.data.AUTOTUNE)
+        )
+
+    device = "/device:CPU:0" if USE_CPU else f"/device:GPU:{gpu_id}"
+
     # Load the model
-    with tf.device(f"/device:GPU:{gpu_id}"):
+    with tf.device(device):
         cache_folder = join(WORK_DIR, "./NSFW-cache")
         model = tf.keras.models.load_model(
             join(cache_folder, "nsfweffnetv2-b02-3epochs.h5"),
             custom_objects={"KerasLayer": hub.KerasLayer},
         )
 
-    while True:
-        part_id = zipped_queue.get()
-        print("Start consuming", part_id)
-
-        # Tell producer to produce the next batch
-        if not part_ids_queue.empty():
-            item = part_ids_queue.get()
-            unzipped_queue.put(item)
-            part_ids_queue.task_done()
-
-        zip_path = join(WORK_DIR, f"part-{part_id:06}.zip")
-        data_dir = join(WORK_DIR, f"part-{part_id:06}")
-        json_data = load(
-            open(join(data_dir, f"part-{part_id:06}.json"), "r", encoding="utf8")
-        )
+    def score_one_part(part_id):
+        """
+        Predict and save NSFW scores for all images in one part. Return the
+        number of scored images.
+        """
+        zip_path = get_zip_path(part_id)
 
-        # We should not loop over images here because the model.predict()'s
-        # "computation is done in batches. This method is designed for batch
-        # processing of large numbers of inputs. It is not intended for use inside
-        # of loops that iterate over your data and process small numbers of inputs
-        # at a time."
+        # Only keep one batch of images in memory at a time (the model.predict()
+        # "computation is done in batches", so we run it batch by batch)
         names = []
         prompts = []
-        images = []
+        nsfw_scores = []
         images_sharpness = []
 
-        try:
-            with tf.device(f"/device:GPU:{gpu_id}"):
-                for f in tqdm(
-                    glob(join(data_dir, "*.webp")), position=gpu_id, disable=not VERBOSE
+        # Only read the central directory and the json member here, images are
+        # streamed into the decode stage in the order they are stored
+        with ZipFile(zip_path) as zip_file:
+            member_names = zip_file.namelist()
+            json_data = load(zip_file.open(f"part-{part_id:06}.json"))
+
+        webp_names = [n for n in member_names if n.endswith(".webp")]
+        png_names = [n for n in member_names if n.endswith(".png")]
+
+        for n in webp_names + png_names:
+            names.append(n)
+            prompts.append(get_prompt(n, json_data))
+
+        with tf.device(device):
+            for image_names, decode_fn in [
+                (webp_names, decode_webp),
+                (png_names, decode_png),
+            ]:
+                if len(image_names) == 0:
+                    continue
+
+                for images, sharpness in tqdm(
+                    get_dataset(zip_path, image_names, decode_fn),
+                    total=int(np.ceil(len(image_names) / BATCH_SIZE)),
+                    position=worker_id,
+                    disable=not VERBOSE,
                 ):
-                    names.append(basename(f))
-                    prompts.append(get_prompt(f, json_data))
-                    img, sharpness = get_image(f)
-                    images.append(img)
-                    images_sharpness.append(sharpness)
-
-                for f in tqdm(
-                    glob(join(data_dir, "*.png")), position=gpu_id, disable=not VERBOSE
-                ):
-                    names.append(basename(f))
-                    prompts.append(get_prompt(f, json_data))
-                    img, sharpness = get_image(f)
-                    images.append(img)
-                    images_sharpness.append(sharpness)
-
-                all_images = tf.stack(images)
-
-                # Get the multi-class probability
-                nsfw_scores = model.predict(all_images, verbose=0)
-                nsfw_scores_prob = tf.nn.softmax(nsfw_scores).numpy()
-
-                # Transfer the multi-class probs to binary
-                # Columns are: drawing, hentai, neutral, porn, and sexy
-                trans_mat = np.array(
-                    [
-                        [
-                            0.0,
-                            1.0,
-                            0.0,
-                            1.0,
-                            1.0,
-                        ]
-                    ]
-                ).transpose()
-                nsfw_scores_binary = np.dot(nsfw_scores_prob, trans_mat).reshape(-1)
-
-                # Override the original NSFW scores of blur images as 1.1
-                images_sharpness = np.array(images_sharpness)
-                nsfw_scores_binary[images_sharpness < 10] = 2.0
-
-                # Save the scores
-                cur_score_path = join(NSFW_SCORE_DIR, f"part-{part_id:06}.npz")
-                np.savez_compressed(
-                    cur_score_path,
-                    images_name=names,
-                    images_nsfw=nsfw_scores_binary,
-                )
-
-                del all_images
-
-        except KeyError:
-            print("Key error!", part_id)
-
-        # Remove the zip file and image files
-        os.remove(zip_path)
-        shutil.rmtree(data_dir)
-
-        print("Finish consuming", part_id)
-
-        zipped_queue.task_done()
-
-
-def producer_unzip_images(zipped_queue: JoinableQueue, unzipped_queue: JoinableQueue):
+                    # Get the multi-class probability
+                    nsfw_scores.append(
+                        tf.nn.softmax(model.predict_on_batch(images)).numpy()
+                    )
+                    images_sharpness.append(sharpness.numpy())
+
+        nsfw_scores_prob = np.concatenate(nsfw_scores)
+
+        # Transfer the multi-class probs to binary
+        # Columns are: drawing, hentai, neutral, porn, and sexy
+        trans_mat = np.array(
+            [
+                [
+                    0.0,
+                    1.0,
+                    0.0,
+                    1.0,
+                    1.0,
+                ]
+            ]
+        ).transpose()
+        nsfw_scores_binary = np.dot(nsfw_scores_prob, trans_mat).reshape(-1)
+
+        # Override the original NSFW scores of blur images as 1.1
+        images_sharpness = np.concatenate(images_sharpness)
+        nsfw_scores_binary[images_sharpness < BLUR_THRESHOLD] = 2.0
+
+        # Save the scores. Write to a temporary file first, so an interrupted
+        # run never leaves a partial score file that looks finished.
+        cur_score_path = get_score_path(part_id)
+        with open(cur_score_path + ".tmp", "wb") as fp:
+            np.savez_compressed(
+                fp,
+                images_name=names,
+                images_nsfw=nsfw_scores_binary,
+            )
+        os.replace(cur_score_path + ".tmp", cur_score_path)
+
+        return len(names)
+
+    while True:
+        part_id = task_queue.get()
+
+        # None means there is no more work
+        if part_id is None:
+            break
+
+        result_queue.put({"status": "started", "part_id": part_id, "worker": worker_id})
+        start_time = time.time()
+
+        try:
+            image_count = score_one_part(part_id)
+            result_queue.put(
+                {
+                    "status": "done",
+                    "part_id": part_id,
+                    "worker": worker_id,
+                    "images": image_count,
+                    "seconds": time.time() - start_time,
+                }
+            )
+        except Exception:
+            result_queue.put(
+                {
+                    "status": "failed",
+                    "part_id": part_id,
+                    "worker": worker_id,
+                    "error": traceback.format_exc(),
+                    "seconds": time.time() - start_time,
+                }
+            )
+
+
+def get_score_path(part_id):
     """
-    Download and unzip zip files.
+    Get the path of the NSFW score file of a part.
     """
+    return join(NSFW_SCORE_DIR, f"part-{part_id:06}.npz")
+
+
+def start_worker(task_queue, result_queue, worker_id):
+    """
+    Start one consumer process.
+    """
+    worker = Process(
+        target=consumer_detect_nsfw,
+        args=(task_queue, result_queue, worker_id, GPU_IDS[worker_id % len(GPU_IDS)]),
+    )
+    worker.start()
+    return worker
 
-    while True:
-        part_id = unzipped_queue.get()
-        print("Start producing", part_id)
-
-        # Download and extract the zip file
-        cur_zip = join(WORK_DIR, f"part-{part_id:06}.zip")
-
-        if LARGE_MODE:
-            if part_id > 10000:
-                shutil.copyfile(
-                    join(ZIP_DIR2, f"part-{part_id:06}.zip"),
-                    cur_zip,
-                )
-            else:
-                shutil.copyfile(
-                    join(ZIP_DIR1, f"part-{part_id:06}.zip"),
-                    cur_zip,
-                )
-        else:
-            shutil.copyfile(join(ZIP_DIR_2M, f"part-{part_id:06}.zip"), cur_zip)
 
-        img_dir = join(WORK_DIR, f"part-{part_id:06}")
-        shutil.unpack_archive(cur_zip, img_dir)
+def save_status(part_status):
+    """
+    Save the status of all parts to status.json. Write to a temporary file
+    first, so a killed run never leaves a partial status file.
+    """
+    status_path = join(NSFW_SCORE_DIR, "status.json")
+    with open(status_path + ".tmp", "w", encoding="utf8") as fp:
+        dump(part_status, fp, indent=2)
+    os.replace(status_path + ".tmp", status_path)
 
-        print("Finish producing", part_id)
-        zipped_queue.put(part_id)
-        unzipped_queue.task_done()
+
+def print_summary(part_status, worker_stats, elapsed_seconds):
+    """Print the progress and throughput of the NSFW scoring run.
+
+    Args:
+        part_status (dict): Part id => status record
+        worker_stats (dict): Worker id => {"parts", "images", "seconds"}
+        elapsed_seconds (float): Time since the scheduler started
+    """
+    done_count = len([s for s in part_status.values() if s["status"] == "done"])
+    failed_count = len([s for s in part_status.values() if s["status"] == "failed"])
+    total_count = len(part_status)
+    hours = max(elapsed_seconds, 1e-6) / 3600
+
+    if USE_CPU:
+        print(f"Config: CPU, {THREADS_PER_CPU_WORKER} threads per worker")
+    else:
+        print(f"Config: GPUs {GPU_IDS}")
+
+    print(
+        f"Parts: {done_count}/{total_count} done, {failed_count} failed, "
+        f"{done_count / hours:.1f} parts/hour"
+    )
+
+    for worker_id in sorted(worker_stats):
+        stats = worker_stats[worker_id]
+        images_per_second = stats["images"] / max(stats["seconds"], 1e-6)
+        print(
+            f"Worker {worker_id}: {stats['parts']} parts, "
+            f"{images_per_second:.1f} images/sec"
+        )
 
 
 def main():
@@ -225,42 +357,160 @@ def main():
     part_ids = list(range(1, 14001))
     print(part_ids[0], part_ids[-1])
 
-    # Produce NSFW scores in parallel
-    zipped_queue = JoinableQueue()
-    unzipped_queue = JoinableQueue()
-    part_ids_queue = JoinableQueue()
-
-    n_producers = 4
-    n_consumers = 4
-
-    # Producer
-    for _ in range(n_producers):
-        Process(
-            target=producer_unzip_images,
-            args=(zipped_queue, unzipped_queue),
-            daemon=True,
-        ).start()
-
-    # Consumer
-    for gpu_id in range(n_consumers):
-        Process(
-            target=consumer_detect_nsfw,
-            args=(zipped_queue, unzipped_queue, part_ids_queue, gpu_id % 2 + 2),
-            daemon=True,
-        ).start()
+    if not exists(NSFW_SCORE_DIR):
+        os.makedirs(NSFW_SCORE_DIR)
 
-    for part_id in part_ids:
-        part_ids_queue.put(part_id)
+    # Resume from existing score files
+    part_status = {}
+    pending_part_ids = deque()
 
-    # Start n processes
-    for _ in range(n_producers):
-        item = part_ids_queue.get()
-        unzipped_queue.put(item)
-        part_ids_queue.task_done()
-
-    part_ids_queue.join()
-    unzipped_queue.join()
-    zipped_queue.join()
+    for part_id in part_ids:
+        if exists(get_score_path(part_id)):
+            part_status[part_id] = {"status": "done", "attempts": 0}
+        else:
+            part_status[part_id] = {"status": "pending", "attempts": 0}
+            pending_part_ids.append(part_id)
+
+    print("Resuming with", len(pending_part_ids), "parts left")
+
+    # Each consumer streams images from the zip files on the share. Each
+    # worker has its own task queue holding a few parts, so failed parts can be
+    # retried without waiting behind the whole backlog, and the parts of a
+    # dead worker are known exactly.
+    if USE_CPU:
+        n_consumers = get_cpu_worker_count(THREADS_PER_CPU_WORKER)
+    else:
+        n_consumers = len(GPU_IDS)
+    result_queue = Queue()
+
+    workers = {}
+    task_queues = {}
+    worker_stats = {}
+    worker_restarts = {}
+    # Worker id => part ids sent to the worker and not finished, in order
+    worker_parts = {}
+
+    def restart_worker(worker_id):
+        task_queues[worker_id] = Queue()
+        workers[worker_id] = start_worker(
+            task_queues[worker_id], result_queue, worker_id
+        )
+        worker_parts[worker_id] = []
+
+    for worker_id in range(n_consumers):
+        restart_worker(worker_id)
+        worker_stats[worker_id] = {"parts": 0, "images": 0, "seconds": 0.0}
+        worker_restarts[worker_id] = 0
+
+    def retry_or_fail(part_id, error):
+        part_status[part_id]["error"] = error
+        if part_status[part_id]["attempts"] < MAX_ATTEMPTS:
+            part_status[part_id]["status"] = "pending"
+            pending_part_ids.append(part_id)
+        else:
+            part_status[part_id]["status"] = "failed"
+            print("Failed", part_id, error)
+
+    last_summary_time = time.time()
+
+    with tqdm(total=len(pending_part_ids)) as pbar:
+        while len(pending_part_ids) > 0 or any(worker_parts.values()):
+            # Keep each task queue filled up to the prefetch depth
+            for worker_id in workers:
+                while (
+                    len(pending_part_ids) > 0
+                    and len(worker_parts[worker_id]) < PREFETCH_DEPTH
+                ):
+                    part_id = pending_part_ids.popleft()
+                    part_status[part_id]["status"] = "queued"
+                    part_status[part_id]["attempts"] += 1
+                    task_queues[worker_id].put(part_id)
+                    worker_parts[worker_id].append(part_id)
+
+            # Wait for one result, then drain the queue, so a part a worker
+            # finished right before dying is not retried
+            results = []
+            try:
+                results.append(result_queue.get(timeout=WORKER_CHECK_SECONDS))
+                while True:
+                    results.append(result_queue.get_nowait())
+            except Empty:
+                pass
+
+            for result in results:
+                part_id = result["part_id"]
+                worker_id = result["worker"]
+
+                # Skip late results of parts already taken back from the worker
+                if part_id not in worker_parts.get(worker_id, []):
+                    continue
+
+                if result["status"] == "started":
+                    part_status[part_id]["status"] = "running"
+                    continue
+
+                worker_parts[worker_id].remove(part_id)
+
+                if result["status"] == "done":
+                    part_status[part_id]["status"] = "done"
+                    worker_stats[worker_id]["parts"] += 1
+                    worker_stats[worker_id]["images"] += result["images"]
+                    worker_stats[worker_id]["seconds"] += result["seconds"]
+                    pbar.update(1)
+                else:
+                    retry_or_fail(part_id, result["error"])
+
+            # Take the parts back from dead workers: the running part counts as
+            # an attempt, the parts still queued do not
+            for worker_id, worker in list(workers.items()):
+                if worker.is_alive():
+                    continue
+
+                print("Worker", worker_id, "died with exit code", worker.exitcode)
+                for part_id in worker_parts[worker_id]:
+                    if part_status[part_id]["status"] == "running":
+                        retry_or_fail(
+                            part_id, f"Worker died with exit code {worker.exitcode}"
+                        )
+                    else:
+                        part_status[part_id]["status"] = "pending"
+                        part_status[part_id]["attempts"] -= 1
+                        pending_part_ids.appendleft(part_id)
+
+                if worker_restarts[worker_id] < MAX_WORKER_RESTARTS:
+                    worker_restarts[worker_id] += 1
+                    restart_worker(worker_id)
+                else:
+                    print("Retired worker", worker_id, "after too many restarts")
+                    del workers[worker_id]
+                    del task_queues[worker_id]
+                    del worker_parts[worker_id]
+
+            # Stop if no worker is left, the remaining parts can not be scored
+            if len(workers) == 0:
+                print("All workers were retired, stopping")
+                for part_id in pending_part_ids:
+                    part_status[part_id]["status"] = "failed"
+                    part_status[part_id]["error"] = "All workers were retired"
+                save_status(part_status)
+                print_summary(part_status, worker_stats, time.time() - start_time)
+                sys.exit(1)
+
+            if time.time() - last_summary_time > SUMMARY_SECONDS:
+                print_summary(part_status, worker_stats, time.time() - start_time)
+                save_status(part_status)
+                last_summary_time = time.time()
+
+    # Stop all workers
+    for worker_id in workers:
+        task_queues[worker_id].put(None)
+
+    for worker in workers.values():
+        worker.join()
+
+    # Save the status of all parts
+    save_status(part_status)
+    print_summary(part_status, worker_stats, time.time() - start_time)
 
     print("Finished in", (time.time() - start_time) / 60, "minutes")
 
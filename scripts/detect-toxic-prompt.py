@@ -2,63 +2,318 @@ from glob import glob
 from os.path import exists, join, basename
 from tqdm import tqdm
 from json import load, dump
-from matplotlib import pyplot as plt
-from detoxify import Detoxify
 
-import torch
 import time
 import shutil
 import os
-import pickle
-import cv2
+import argparse
 
 import pandas as pd
 import numpy as np
+import pyarrow.parquet as pq
+
+from prompt_batching import get_token_lengths, get_token_budget_batches
+from inference_backend import start_cpu_pool, predict_batches, print_throughput
+from prompt_hash import hash_string
 
 SHARE_DIR = "/project/zwang3049/diffusiondb-hugging"
 WORK_DIR = "/nvmescratch/jay/diffusiondb"
 
+# Scores of all prompts we have seen, shared by 2M and Large
+CACHE_DIR = join(WORK_DIR, "prompt-toxicity-cache")
+
+# Tokenizer of the Detoxify multilingual model
+TOKENIZER_NAME = "xlm-roberta-base"
+
+# Stub scores are kept apart, so a test run never fills the real cache with 0s
+STUB_CACHE_DIR = join(WORK_DIR, "prompt-toxicity-cache-stub")
+
+parser = argparse.ArgumentParser(description="Score the toxicity of prompts")
+parser.add_argument(
+    "-l",
+    "--large",
+    default=False,
+    help="Score prompts in DiffusionDB Large instead of DiffusionDB 2M",
+    action="store_true",
+)
+parser.add_argument(
+    "-d", "--device", type=str, default="cuda:0", help="Torch device to use"
+)
+parser.add_argument(
+    "-b",
+    "--batch_size",
+    type=int,
+    default=256,
+    help="Max number of prompts per batch",
+)
+parser.add_argument(
+    "-t",
+    "--max_tokens",
+    type=int,
+    default=16384,
+    help="Max number of padded tokens per batch",
+)
+parser.add_argument(
+    "-w",
+    "--n_workers",
+    type=int,
+    default=0,
+    help="Number of CPU worker processes (0 to run the model in this process)",
+)
+parser.add_argument(
+    "--threads_per_worker",
+    type=int,
+    default=4,
+    help="Number of threads (and cores) of each CPU worker",
+)
+parser.add_argument(
+    "-q",
+    "--quantize",
+    default=False,
+    help="Use a dynamically int8-quantized model (CPU only)",
+    action="store_true",
+)
+parser.add_argument(
+    "-s",
+    "--stub",
+    default=False,
+    help="Use a stub model that scores every prompt 0 (for testing)",
+    action="store_true",
+)
+
+
+class StubToxicityModel:
+    """A stand-in for Detoxify that returns zero scores without a model."""
+
+    def predict(self, prompts):
+        return {
+            "toxicity": [0.0] * len(prompts),
+            "sexual_explicit": [0.0] * len(prompts),
+        }
+
+
+def load_toxicity_model(device_name, stub=False, quantize=False):
+    """Load the toxicity model.
+
+    Args:
+        device_name (string): Torch device name
+        stub (bool): True to use the stub model
+        quantize (bool): True to quantize the linear layers to int8
+
+    Returns:
+        Detoxify: Toxicity model
+    """
+    if stub:
+        return StubToxicityModel()
+
+    import torch
+    from detoxify import Detoxify
+
+    toxicity_model = Detoxify("multilingual", device=torch.device(device_name))
+
+    if quantize:
+        toxicity_model.model = torch.quantization.quantize_dynamic(
+            toxicity_model.model, {torch.nn.Linear}, dtype=torch.qint8
+        )
+
+    return toxicity_model
+
+
+def load_tokenizer(stub=False):
+    """Load the tokenizer of the toxicity model without its weights. The parent
+    process needs it to batch prompts by token length when the model runs on
+    CPU workers.
+
+    Args:
+        stub (bool): True if using the stub model, which has no tokenizer
+
+    Returns:
+        PreTrainedTokenizer: Tokenizer, None for the stub model
+    """
+    if stub:
+        return None
+
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(TOKENIZER_NAME)
+
+
+def load_cache(cache_dir):
+    """
+    Load the prompt hash => [toxicity, sexual_explicit] cache.
+    """
+    cache = {}
+
+    for cache_path in sorted(glob(join(cache_dir, "*.parquet"))):
+        cache_df = pd.read_parquet(cache_path)
+        for prompt_hash, toxicity, sexual_explicit in zip(
+            cache_df["prompt_hash"].to_numpy(),
+            cache_df["toxicity"].to_numpy(),
+            cache_df["sexual_explicit"].to_numpy(),
+        ):
+            cache[int(prompt_hash)] = [toxicity, sexual_explicit]
+
+    return cache
+
+
+def score_prompts(
+    toxicity_model, tokenizer, prompts, batch_size, max_tokens, pool=None
+):
+    """Score prompts in batches. Prompts are grouped by token length under a
+    padded token budget, so each batch has prompts of similar lengths and
+    little padding.
+
+    Args:
+        toxicity_model (Detoxify): Toxicity model, None if using the pool
+        tokenizer (PreTrainedTokenizer): Tokenizer of the model, None to
+            estimate token lengths
+        prompts ([string]): Prompts to score
+        batch_size (int): Max number of prompts per batch
+        max_tokens (int): Max number of padded tokens per batch
+        pool (Pool): CPU worker pool from start_cpu_pool() (optional)
+
+    Returns:
+        ([float], [float]): Toxicity and sexual explicit scores of prompts
+    """
+    lengths = get_token_lengths(prompts, tokenizer)
+    toxicity = np.zeros(len(prompts), dtype=np.float32)
+    sexual_explicit = np.zeros(len(prompts), dtype=np.float32)
+
+    batches = get_token_budget_batches(lengths, max_tokens, batch_size)
+    batch_prompts = [[prompts[i] for i in b] for b in batches]
+
+    if pool is None:
+        results = [toxicity_model.predict(b) for b in batch_prompts]
+    else:
+        results = predict_batches(pool, batch_prompts)
+
+    for batch_indexes, result in zip(batches, results):
+        toxicity[batch_indexes] = result["toxicity"]
+        sexual_explicit[batch_indexes] = result["sexual_explicit"]
+
+    return toxicity, sexual_explicit
+
 
 def main():
     """
     Main function.
     """
+    args = parser.parse_args()
+    start_time = time.time()
+
+    # Shard batches across CPU workers, or run the model in this process
+    toxicity_model = None
+    pool = None
+
+    if args.n_workers > 0:
+        pool = start_cpu_pool(
+            args.n_workers,
+            args.threads_per_worker,
+            load_toxicity_model,
+            ("cpu", args.stub, args.quantize),
+        )
+        tokenizer = load_tokenizer(args.stub)
+        config_name = (
+            f"cpu, {args.n_workers} workers x {args.threads_per_worker} threads"
+        )
+    else:
+        toxicity_model = load_toxicity_model(args.device, args.stub, args.quantize)
+        tokenizer = getattr(toxicity_model, "tokenizer", None)
+        config_name = args.device
+
+    if args.quantize:
+        config_name += ", int8"
+
+    if args.large:
+        metadata_path = join(SHARE_DIR, "metadata-large.parquet")
+        output_path = join(WORK_DIR, "prompt-toxicity-large.parquet")
+    else:
+        metadata_path = join(SHARE_DIR, "metadata.parquet")
+        output_path = join(WORK_DIR, "prompt-toxicity-2m.parquet")
+
+    cache_dir = STUB_CACHE_DIR if args.stub else CACHE_DIR
+    if not exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # There are many same prompts, keep a persistent cache so re-runs and the
+    # Large table only score prompts we have not seen
+    prompt_toxicity_map = load_cache(cache_dir)
+    print("Loaded", len(prompt_toxicity_map), "cached scores")
+
+    # Stream the prompt column one row group at a time
+    parquet_file = pq.ParquetFile(metadata_path)
+    unique_prompts = {}
+    new_count = 0
+    score_seconds = 0.0
+
+    for row_group_i in tqdm(range(parquet_file.num_row_groups)):
+        prompts = parquet_file.read_row_group(row_group_i, columns=["prompt"])
+        prompts = pd.unique(prompts.column("prompt").to_pandas())
+
+        new_prompts = []
+        new_hashes = []
+        for p in prompts:
+            if p in unique_prompts:
+                continue
+
+            prompt_hash = hash_string(p)
+            unique_prompts[p] = prompt_hash
+
+            if prompt_hash not in prompt_toxicity_map:
+                new_prompts.append(p)
+                new_hashes.append(prompt_hash)
+
+        if len(new_prompts) == 0:
+            continue
+
+        score_start_time = time.time()
+        toxicity, sexual_explicit = score_prompts(
+            toxicity_model,
+            tokenizer,
+            new_prompts,
+            args.batch_size,
+            args.max_tokens,
+            pool,
+        )
+        score_seconds += time.time() - score_start_time
+
+        for i, prompt_hash in enumerate(new_hashes):
+            prompt_toxicity_map[prompt_hash] = [toxicity[i], sexual_explicit[i]]
+
+        # Save new scores after each row group, so an interrupted run can resume
+        pd.DataFrame(
+            {
+                "prompt_hash": np.array(new_hashes, dtype=np.uint64),
+                "toxicity": toxicity,
+                "sexual_explicit": sexual_explicit,
+            }
+        ).to_parquet(
+            join(cache_dir, f"scores-{int(time.time() * 1000)}.parquet"), index=False
+        )
+        new_count += len(new_prompts)
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print("Scored", new_count, "new prompts")
+    print_throughput(config_name, new_count, score_seconds)
+
+    # Save the scores of all unique prompts in their first appearance order
+    hashes = list(unique_prompts.values())
+    pd.DataFrame(
+        {
+            "prompt": list(unique_prompts.keys()),
+            "toxicity": np.array(
+                [prompt_toxicity_map[h][0] for h in hashes], dtype=np.float32
+            ),
+            "sexual_explicit": np.array(
+                [prompt_toxicity_map[h][1] for h in hashes], dtype=np.float32
+            ),
+        }
+    ).to_parquet(output_path, index=False)
 
-    device = torch.device("cuda:0")
-    toxicity_model = Detoxify("multilingual", device=device)
-
-    prompts_2m = pd.read_parquet(
-        join(SHARE_DIR, "metadata.parquet"), columns=["prompt"]
-    )["prompt"]
-    prompts_2m = list(set(prompts_2m))
-    batch_size = 256
-
-    lower = 0
-    prompt_toxicity_map = {}
-
-    # There are many same prompts, keep a dictionary
-    with tqdm(total=len(prompts_2m)) as pbar:
-        while lower < len(prompts_2m):
-            higher = min(lower + batch_size, len(prompts_2m))
-            cur_prompts = prompts_2m[lower:higher]
-
-            result = toxicity_model.predict(cur_prompts)
-
-            for i, p in enumerate(cur_prompts):
-                # Prompt => [toxicity, sexual_explicity]
-                prompt_toxicity_map[p] = [
-                    result["toxicity"][i],
-                    result["sexual_explicit"][i],
-                ]
-
-            # Next batch
-            lower += batch_size
-            pbar.update(batch_size)
-
-    # Save the dictionary
-    pickle.dump(
-        prompt_toxicity_map, open(join(WORK_DIR, "prompt_toxicity_map_2m.pkl"), "wb")
-    )
+    print("Finished in", (time.time() - start_time) / 60, "minutes")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,169 @@
+from os.path import join
+
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from prompt_batching import get_token_lengths, get_token_budget_batches
+from inference_backend import start_cpu_pool, predict_batches, print_throughput
+from embedding_store import (
+    EMBEDDING_MODEL,
+    EmbeddingStore,
+    load_embedding_model,
+    load_embedding_tokenizer,
+)
+from prompt_hash import hash_string
+
+SHARE_DIR = "/project/zwang3049/diffusiondb-hugging"
+WORK_DIR = "/nvmescratch/jay/diffusiondb"
+
+# Prompt embeddings of all prompts we have seen, shared by 2M and Large
+STORE_DIR = join(WORK_DIR, "prompt-embeddings")
+
+# Number of prompts embedded between two commits
+CHUNK_SIZE = 100000
+
+parser = argparse.ArgumentParser(description="Embed new prompts into the store")
+parser.add_argument(
+    "-l",
+    "--large",
+    default=False,
+    help="Embed prompts in DiffusionDB Large instead of DiffusionDB 2M",
+    action="store_true",
+)
+parser.add_argument(
+    "-m", "--model", type=str, default=EMBEDDING_MODEL, help="Embedding model"
+)
+parser.add_argument(
+    "-b",
+    "--batch_size",
+    type=int,
+    default=256,
+    help="Max number of prompts per batch",
+)
+parser.add_argument(
+    "-t",
+    "--max_tokens",
+    type=int,
+    default=16384,
+    help="Max number of padded tokens per batch",
+)
+parser.add_argument(
+    "-w",
+    "--n_workers",
+    type=int,
+    default=0,
+    help="Number of CPU worker processes (0 to run the model in this process)",
+)
+parser.add_argument(
+    "--threads_per_worker",
+    type=int,
+    default=4,
+    help="Number of threads (and cores) of each CPU worker",
+)
+
+
+def embed_prompts(model, tokenizer, prompts, batch_size, max_tokens, pool=None):
+    """Embed prompts in length-bucketed batches.
+
+    Args:
+        model (EmbeddingModel): Embedding model, None if using the pool
+        tokenizer (PreTrainedTokenizer): Tokenizer of the model
+        prompts ([string]): Prompts
+        batch_size (int): Max number of prompts per batch
+        max_tokens (int): Max number of padded tokens per batch
+        pool (Pool): CPU worker pool from start_cpu_pool() (optional)
+
+    Returns:
+        np.ndarray: float16 vectors in the order of prompts
+    """
+    lengths = get_token_lengths(prompts, tokenizer)
+    batches = get_token_budget_batches(lengths, max_tokens, batch_size)
+    batch_prompts = [[prompts[i] for i in batch] for batch in batches]
+
+    if pool is None:
+        batch_vectors = [model.predict(b) for b in batch_prompts]
+    else:
+        batch_vectors = predict_batches(pool, batch_prompts)
+
+    # Batches are sorted by length, put vectors back in the prompt order
+    batch_vectors = np.concatenate(batch_vectors)
+    vectors = np.zeros_like(batch_vectors)
+    vectors[np.concatenate(batches)] = batch_vectors
+    return vectors
+
+
+def main():
+    """
+    Main function
+    """
+    args = parser.parse_args()
+    start_time = time.time()
+
+    if args.large:
+        metadata_path = join(SHARE_DIR, "metadata-large.parquet")
+    else:
+        metadata_path = join(SHARE_DIR, "metadata.parquet")
+
+    # Workers load their own model, the parent only needs the tokenizer
+    model = None
+    pool = None
+    if args.n_workers > 0:
+        pool = start_cpu_pool(
+            args.n_workers,
+            args.threads_per_worker,
+            load_embedding_model,
+            (args.model,),
+        )
+        tokenizer = load_embedding_tokenizer(args.model)
+
+        # Ask a worker for the vector size by embedding one empty prompt
+        dim = predict_batches(pool, [[""]])[0].shape[1]
+    else:
+        model = load_embedding_model(args.model)
+        tokenizer, dim = model.tokenizer, model.dim
+
+    store = EmbeddingStore(STORE_DIR, dim, args.model)
+
+    # Only embed prompts that are not in the store yet
+    prompts = pd.read_parquet(metadata_path, columns=["prompt"])["prompt"]
+    prompts = [p for p in pd.unique(prompts) if p is not None]
+    prompt_hashes = [hash_string(p) for p in prompts]
+    new_indexes = [i for i, h in enumerate(prompt_hashes) if not store.contains(h)]
+    print(
+        f"{len(prompts)} unique prompts, {len(prompts) - len(new_indexes)} already "
+        f"stored, {len(new_indexes)} to embed"
+    )
+
+    embed_start_time = time.time()
+
+    # Commit each chunk, so an interrupted run resumes from the last chunk
+    for lower in range(0, len(new_indexes), CHUNK_SIZE):
+        chunk_indexes = new_indexes[lower : lower + CHUNK_SIZE]
+        vectors = embed_prompts(
+            model,
+            tokenizer,
+            [prompts[i] for i in chunk_indexes],
+            args.batch_size,
+            args.max_tokens,
+            pool,
+        )
+        store.append([prompt_hashes[i] for i in chunk_indexes], vectors)
+        print(f"Stored {store.count} vectors")
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    print_throughput(
+        f"{args.n_workers} workers" if pool is not None else "in-process",
+        len(new_indexes),
+        time.time() - embed_start_time,
+    )
+    print("Finished in", (time.time() - start_time) / 60, "minutes")
+
+
+if __name__ == "__main__":
+    main()
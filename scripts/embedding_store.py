@@ -0,0 +1,220 @@
+"""Persistent prompt embedding store: float16 vectors in a memory-mapped file
+and a prompt hash => row index."""
+
+from glob import glob
+from os.path import exists, join
+from json import load, dump
+
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+from prompt_hash import hash_string
+
+# Sentence embedding model, small enough for CPU inference
+EMBEDDING_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+# The vector file grows by at least this many rows at a time
+GROW_ROWS = 1000000
+
+
+class EmbeddingModel:
+    """A sentence embedding model with the predict(batch) interface of the CPU
+    inference backend."""
+
+    def __init__(self, model_name=EMBEDDING_MODEL):
+        from sentence_transformers import SentenceTransformer
+
+        self.model = SentenceTransformer(model_name, device="cpu")
+        self.tokenizer = self.model.tokenizer
+        self.dim = self.model.get_sentence_embedding_dimension()
+
+    def predict(self, prompts):
+        return self.model.encode(
+            list(prompts),
+            batch_size=len(prompts),
+            convert_to_numpy=True,
+            normalize_embeddings=True,
+        ).astype(np.float16)
+
+
+def load_embedding_model(model_name=EMBEDDING_MODEL):
+    """
+    Load the embedding model (module-level, so pool workers can call it).
+    """
+    return EmbeddingModel(model_name)
+
+
+def load_embedding_tokenizer(model_name=EMBEDDING_MODEL):
+    """
+    Load only the tokenizer of the embedding model, to batch prompts by token
+    length in a process that does not run the model.
+    """
+    from transformers import AutoTokenizer
+
+    return AutoTokenizer.from_pretrained(model_name)
+
+
+class EmbeddingStore:
+    """Embedding store in a directory:
+
+    - vectors.f16: float16 matrix (capacity x dim) opened as a memmap
+    - index-*.parquet: prompt_hash and row of the stored vectors
+    - store.json: model, dim, capacity, and count (number of committed rows)
+
+    Rows are committed by updating store.json last, so an interrupted append
+    leaves the store at its previous state and the next run resumes from it.
+    """
+
+    def __init__(self, store_dir, dim, model_name=EMBEDDING_MODEL):
+        self.store_dir = store_dir
+        self.vector_path = join(store_dir, "vectors.f16")
+        self.meta_path = join(store_dir, "store.json")
+
+        if exists(self.meta_path):
+            self.meta = load(open(self.meta_path, "r", encoding="utf8"))
+            if self.meta["dim"] != dim or self.meta["model"] != model_name:
+                raise ValueError(
+                    f"The store has {self.meta['model']} vectors of "
+                    f"{self.meta['dim']} dimensions"
+                )
+        else:
+            os.makedirs(store_dir, exist_ok=True)
+            self.meta = {"model": model_name, "dim": dim, "capacity": 0, "count": 0}
+            self._grow(GROW_ROWS)
+            self._save_meta()
+
+        self.vectors = self._open_vectors()
+        self.rows = self._load_index()
+
+    @property
+    def count(self):
+        return self.meta["count"]
+
+    def _open_vectors(self, mode="r+"):
+        return np.memmap(
+            self.vector_path,
+            dtype=np.float16,
+            mode=mode,
+            shape=(self.meta["capacity"], self.meta["dim"]),
+        )
+
+    def _grow(self, capacity):
+        """
+        Extend the vector file to capacity rows. The new rows are zeros.
+        """
+        with open(self.vector_path, "ab") as fp:
+            fp.truncate(capacity * self.meta["dim"] * 2)
+        self.meta["capacity"] = capacity
+
+    def _save_meta(self):
+        tmp_path = self.meta_path + ".tmp"
+        dump(self.meta, open(tmp_path, "w", encoding="utf8"))
+        os.replace(tmp_path, self.meta_path)
+
+    def _load_index(self):
+        """
+        Load the prompt hash => row index. The index file of an uncommitted
+        append is removed, because the next append reuses its rows.
+        """
+        rows = {}
+
+        for index_path in sorted(glob(join(self.store_dir, "index-*.parquet"))):
+            index_df = pd.read_parquet(index_path)
+            if len(index_df) > 0 and index_df["row"].max() >= self.count:
+                os.remove(index_path)
+                continue
+
+            for prompt_hash, row in zip(
+                index_df["prompt_hash"].to_numpy(), index_df["row"].to_numpy()
+            ):
+                rows[int(prompt_hash)] = int(row)
+
+        return rows
+
+    def contains(self, prompt_hash):
+        return prompt_hash in self.rows
+
+    def append(self, prompt_hashes, vectors):
+        """Append vectors and commit them.
+
+        Args:
+            prompt_hashes ([int]): Prompt hash of each vector
+            vectors (np.ndarray): Vectors with shape (n, dim)
+        """
+        start, end = self.count, self.count + len(vectors)
+
+        if end > self.meta["capacity"]:
+            del self.vectors
+            self._grow(max(end, self.meta["capacity"] + GROW_ROWS))
+            self.vectors = self._open_vectors()
+
+        self.vectors[start:end] = vectors
+        self.vectors.flush()
+
+        pd.DataFrame(
+            {
+                "prompt_hash": np.array(prompt_hashes, dtype=np.uint64),
+                "row": np.arange(start, end, dtype=np.int64),
+            }
+        ).to_parquet(
+            join(self.store_dir, f"index-{int(time.time() * 1000)}.parquet"),
+            index=False,
+        )
+
+        self.meta["count"] = end
+        self._save_meta()
+
+        for prompt_hash, row in zip(prompt_hashes, range(start, end)):
+            self.rows[int(prompt_hash)] = row
+
+    def get_vectors(self, prompt_hashes):
+        """Get the vectors of prompts.
+
+        Args:
+            prompt_hashes ([int]): Prompt hashes, all of them must be stored
+
+        Returns:
+            np.ndarray: float16 vectors with shape (n, dim)
+        """
+        return self.vectors[[self.rows[int(h)] for h in prompt_hashes]]
+
+    def get_all(self):
+        """
+        Get a read-only view of all committed vectors and the prompt hash of
+        each row.
+        """
+        row_hashes = np.zeros(self.count, dtype=np.uint64)
+        for prompt_hash, row in self.rows.items():
+            row_hashes[row] = prompt_hash
+
+        return self._open_vectors("r")[: self.count], row_hashes
+
+
+def open_store(store_dir):
+    """
+    Open an existing store without loading its model.
+    """
+    meta = load(open(join(store_dir, "store.json"), "r", encoding="utf8"))
+    return EmbeddingStore(store_dir, meta["dim"], meta["model"])
+
+
+def get_image_prompt_hashes(metadata_df):
+    """Map image names to the prompt hashes that key the store, so vectors can
+    be looked up by image_name.
+
+    Args:
+        metadata_df (pd.DataFrame): Metadata with image_name and prompt
+
+    Returns:
+        pd.Series: Prompt hash (uint64) indexed by image_name, images without
+            a prompt are skipped
+    """
+    metadata_df = metadata_df[metadata_df["prompt"].notna()]
+    prompt_hashes = {p: hash_string(p) for p in pd.unique(metadata_df["prompt"])}
+    return pd.Series(
+        metadata_df["prompt"].map(prompt_hashes).to_numpy(dtype=np.uint64),
+        index=metadata_df["image_name"],
+    )
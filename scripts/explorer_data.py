@@ -0,0 +1,881 @@
+"""Build the data files of the DiffusionDB Explorer (explorer/data/)."""
+
+from json import dump
+from os.path import exists, join
+from contextlib import contextmanager
+from multiprocessing import Pool
+
+import os
+import time
+
+import numpy as np
+import pandas as pd
+
+# Number of rows and columns of the density grid
+GRID_SIZE = 200
+
+# Number of points binned at a time by the FFT KDE grid
+BIN_CHUNK_SIZE = 1000000
+
+# Quadtree levels of the topic labels
+TOPIC_LEVELS = [6, 7, 8, 9]
+
+# A tile needs at least this many points to get a topic label
+MIN_TILE_POINTS = 10
+
+# Number of words in each topic label
+TOPIC_WORD_COUNT = 4
+
+# Number of points used to fit UMAP, the other points are transformed
+UMAP_FIT_SAMPLE_SIZE = 1000000
+
+# Max number of points a point tile adds to its parent tiles
+TILE_CAPACITY = 4096
+
+# Deepest level of point tiles, it takes all the remaining points
+MAX_TILE_LEVEL = 12
+
+# Byte alignment of sections in binary files, so readers can view them as
+# typed arrays without copies
+BINARY_ALIGNMENT = 8
+
+# Little-endian record of one point in a tile buffer
+TILE_RECORD_DTYPE = np.dtype([("x", "<f4"), ("y", "<f4"), ("id", "<u4")])
+
+# Seconds spent in each stage of the pipeline
+stage_seconds = {}
+
+# Inputs of the topic workers, shared with them by fork instead of pickling
+_topic_inputs = None
+
+# Inputs of the tile writers, shared with them by fork instead of pickling
+_tile_inputs = None
+
+
+@contextmanager
+def timed_stage(name):
+    """
+    Time a pipeline stage and print its duration.
+    """
+    print(f"Start stage: {name}")
+    start_time = time.time()
+    yield
+    stage_seconds[name] = time.time() - start_time
+    print(f"Finish stage: {name} in {stage_seconds[name]:.1f} seconds")
+
+
+def load_unique_prompts(metadata_path):
+    """Load the unique prompts of a metadata table in their first appearance
+    order. Embedding and projection files are aligned with this order.
+
+    Args:
+        metadata_path (string): Path to metadata.parquet or
+            metadata-large.parquet
+
+    Returns:
+        [string]: Unique prompts
+    """
+    prompts = pd.read_parquet(metadata_path, columns=["prompt"])["prompt"]
+    return list(pd.unique(prompts))
+
+
+def get_tfidf_embeddings(prompts, n_components=64):
+    """Embed prompts with TF-IDF and truncated SVD, used when there are no
+    precomputed embeddings.
+
+    Args:
+        prompts ([string]): Prompts
+        n_components (int): Embedding dimension
+
+    Returns:
+        np.ndarray: Embeddings with shape (len(prompts), n_components)
+    """
+    from sklearn.feature_extraction.text import TfidfVectorizer
+    from sklearn.decomposition import TruncatedSVD
+
+    tfidf = TfidfVectorizer(
+        stop_words="english", min_df=5, max_features=200000, dtype=np.float32
+    ).fit_transform(pd.Series(prompts).fillna(""))
+
+    return TruncatedSVD(n_components, random_state=0).fit_transform(tfidf)
+
+
+def project_embeddings(embeddings, n_jobs=-1):
+    """Project embeddings to 2D with UMAP. UMAP is fitted on a random sample,
+    and the other points are transformed in chunks.
+
+    Args:
+        embeddings (np.ndarray): Embeddings with shape (n, d)
+        n_jobs (int): Number of parallel jobs of UMAP
+
+    Returns:
+        np.ndarray: Projected points with shape (n, 2)
+    """
+    import umap
+
+    rng = np.random.default_rng(0)
+    fit_size = min(UMAP_FIT_SAMPLE_SIZE, len(embeddings))
+    fit_indexes = np.sort(rng.choice(len(embeddings), fit_size, replace=False))
+
+    reducer = umap.UMAP(n_components=2, low_memory=True, n_jobs=n_jobs)
+    points = np.zeros((len(embeddings), 2), dtype=np.float32)
+    points[fit_indexes] = reducer.fit_transform(embeddings[fit_indexes])
+
+    is_fitted = np.zeros(len(embeddings), dtype=bool)
+    is_fitted[fit_indexes] = True
+    rest_indexes = np.where(~is_fitted)[0]
+
+    for lower in range(0, len(rest_indexes), fit_size):
+        chunk_indexes = rest_indexes[lower : lower + fit_size]
+        points[chunk_indexes] = reducer.transform(embeddings[chunk_indexes])
+
+    return points
+
+
+def get_padded_ranges(points):
+    """Pad the data ranges by 1/50 of the longer side and make them square, in
+    the same way as the explorer does for grids without the padded flag.
+
+    Args:
+        points (np.ndarray): Projected points with shape (n, 2)
+
+    Returns:
+        ([float, float], [float, float]): xRange and yRange
+    """
+    x_range = [float(points[:, 0].min()), float(points[:, 0].max())]
+    y_range = [float(points[:, 1].min()), float(points[:, 1].max())]
+    x_length = x_range[1] - x_range[0]
+    y_length = y_range[1] - y_range[0]
+
+    if x_length < y_length:
+        y_range = [y_range[0] - y_length / 50, y_range[1] + y_length / 50]
+        y_length = y_range[1] - y_range[0]
+        x_range = [
+            x_range[0] - (y_length - x_length) / 2,
+            x_range[1] + (y_length - x_length) / 2,
+        ]
+    else:
+        x_range = [x_range[0] - x_length / 50, x_range[1] + x_length / 50]
+        x_length = x_range[1] - x_range[0]
+        y_range = [
+            y_range[0] - (x_length - y_length) / 2,
+            y_range[1] + (x_length - y_length) / 2,
+        ]
+
+    return x_range, y_range
+
+
+def get_grid_centers(x_range, y_range, grid_size=GRID_SIZE):
+    """
+    Get the x and y coordinates of the grid cell centers.
+    """
+    x_step = (x_range[1] - x_range[0]) / grid_size
+    y_step = (y_range[1] - y_range[0]) / grid_size
+    xs = x_range[0] + (np.arange(grid_size) + 0.5) * x_step
+    ys = y_range[0] + (np.arange(grid_size) + 0.5) * y_step
+    return xs, ys
+
+
+def get_kde_covariance(points):
+    """
+    Get the kernel covariance of a Gaussian KDE with Scott's rule, the same as
+    scipy.stats.gaussian_kde.
+    """
+    covariance = np.cov(points.astype(np.float64), rowvar=False)
+    return covariance * len(points) ** (-2 / 6)
+
+
+def get_naive_kde_grid(points, x_range, y_range, grid_size=GRID_SIZE):
+    """Evaluate a Gaussian KDE (Scott's bandwidth, full covariance) of the
+    points at every grid cell center. The cost is O(points x cells).
+
+    Args:
+        points (np.ndarray): Points with shape (n, 2)
+        x_range ([float, float]): Grid x range
+        y_range ([float, float]): Grid y range
+        grid_size (int): Number of rows and columns of the grid
+
+    Returns:
+        np.ndarray: Density grid with shape (grid_size, grid_size), indexed by
+            [y, x]
+    """
+    points = points.astype(np.float64)
+    n = len(points)
+
+    covariance = get_kde_covariance(points)
+    inv_covariance = np.linalg.inv(covariance)
+    norm = 1 / (n * 2 * np.pi * np.sqrt(np.linalg.det(covariance)))
+
+    xs, ys = get_grid_centers(x_range, y_range, grid_size)
+    grid = np.zeros((grid_size, grid_size))
+
+    # Evaluate one grid row at a time to bound the memory
+    for yi, y in enumerate(ys):
+        dxs = xs[:, None] - points[None, :, 0]
+        dys = np.broadcast_to(y - points[None, :, 1], dxs.shape)
+        mahalanobis = (
+            inv_covariance[0, 0] * dxs**2
+            + 2 * inv_covariance[0, 1] * dxs * dys
+            + inv_covariance[1, 1] * dys**2
+        )
+        grid[yi] = norm * np.exp(-0.5 * mahalanobis).sum(axis=1)
+
+    return grid
+
+
+def get_binned_counts(points, x_range, y_range, grid_size=GRID_SIZE):
+    """Spread each point over its four nearest cell centers with bilinear
+    weights. Points are binned in chunks to bound the memory.
+
+    Args:
+        points (np.ndarray): Points with shape (n, 2)
+        x_range ([float, float]): Grid x range
+        y_range ([float, float]): Grid y range
+        grid_size (int): Number of rows and columns of the grid
+
+    Returns:
+        np.ndarray: Weighted counts with shape (grid_size, grid_size), indexed
+            by [y, x]
+    """
+    x_step = (x_range[1] - x_range[0]) / grid_size
+    y_step = (y_range[1] - y_range[0]) / grid_size
+    counts = np.zeros(grid_size * grid_size)
+
+    for lower in range(0, len(points), BIN_CHUNK_SIZE):
+        chunk = points[lower : lower + BIN_CHUNK_SIZE].astype(np.float64)
+
+        # Grid coordinates where cell centers are integers
+        grid_xs = (chunk[:, 0] - x_range[0]) / x_step - 0.5
+        grid_ys = (chunk[:, 1] - y_range[0]) / y_step - 0.5
+        left_xs, bottom_ys = np.floor(grid_xs), np.floor(grid_ys)
+        right_weights, top_weights = grid_xs - left_xs, grid_ys - bottom_ys
+
+        for x_shift, x_weights in [(0, 1 - right_weights), (1, right_weights)]:
+            for y_shift, y_weights in [(0, 1 - top_weights), (1, top_weights)]:
+                cell_xs = (left_xs + x_shift).astype(np.int64)
+                cell_ys = (bottom_ys + y_shift).astype(np.int64)
+                is_inside = (
+                    (cell_xs >= 0)
+                    & (cell_xs < grid_size)
+                    & (cell_ys >= 0)
+                    & (cell_ys < grid_size)
+                )
+                counts += np.bincount(
+                    cell_ys[is_inside] * grid_size + cell_xs[is_inside],
+                    weights=(x_weights * y_weights)[is_inside],
+                    minlength=grid_size * grid_size,
+                )
+
+    return counts.reshape(grid_size, grid_size)
+
+
+def get_fft_kde_grid(points, x_range, y_range, grid_size=GRID_SIZE):
+    """Approximate the Gaussian KDE of get_naive_kde_grid() on all points: bin
+    the points on the grid, then convolve the counts with the kernel using FFT.
+    The cost is O(points + cells log cells).
+
+    Args:
+        points (np.ndarray): Points with shape (n, 2)
+        x_range ([float, float]): Grid x range
+        y_range ([float, float]): Grid y range
+        grid_size (int): Number of rows and columns of the grid
+
+    Returns:
+        np.ndarray: Density grid with shape (grid_size, grid_size), indexed by
+            [y, x]
+    """
+    counts = get_binned_counts(points, x_range, y_range, grid_size)
+
+    covariance = get_kde_covariance(points)
+    inv_covariance = np.linalg.inv(covariance)
+    norm = 1 / (len(points) * 2 * np.pi * np.sqrt(np.linalg.det(covariance)))
+
+    # Kernel values at every cell offset between two grid cells
+    x_step = (x_range[1] - x_range[0]) / grid_size
+    y_step = (y_range[1] - y_range[0]) / grid_size
+    offsets = np.arange(-(grid_size - 1), grid_size)
+    dxs, dys = np.meshgrid(offsets * x_step, offsets * y_step)
+    mahalanobis = (
+        inv_covariance[0, 0] * dxs**2
+        + 2 * inv_covariance[0, 1] * dxs * dys
+        + inv_covariance[1, 1] * dys**2
+    )
+    kernel = norm * np.exp(-0.5 * mahalanobis)
+
+    # Zero padding makes the circular FFT convolution a linear one
+    fft_shape = (3 * grid_size - 2, 3 * grid_size - 2)
+    convolved = np.fft.irfft2(
+        np.fft.rfft2(counts, fft_shape) * np.fft.rfft2(kernel, fft_shape), fft_shape
+    )
+    center = slice(grid_size - 1, 2 * grid_size - 1)
+    grid = convolved[center, center]
+
+    # FFT round-off can make empty cells slightly negative
+    return np.maximum(grid, 0)
+
+
+def get_grid_data(points):
+    """Create the density grid data of the explorer from all points.
+
+    Args:
+        points (np.ndarray): Projected points with shape (n, 2)
+
+    Returns:
+        dict: {"grid", "xRange", "yRange", "sampleSize", "padded"}
+    """
+    x_range, y_range = get_padded_ranges(points)
+    grid = get_fft_kde_grid(points, x_range, y_range)
+
+    return {
+        "grid": np.round(grid, 4).tolist(),
+        "xRange": x_range,
+        "yRange": y_range,
+        "sampleSize": len(points),
+        "padded": True,
+    }
+
+
+def get_topic_extent(points):
+    """Get the square extent of the topic quadtree. It starts at the floor of
+    the data minimums and its side is a power of two, so tiles at every level
+    have simple coordinates.
+
+    Args:
+        points (np.ndarray): Projected points with shape (n, 2)
+
+    Returns:
+        [[int, int], [int, int]]: [[x0, y0], [x1, y1]]
+    """
+    x0 = int(np.floor(points[:, 0].min()))
+    y0 = int(np.floor(points[:, 1].min()))
+    longest_side = max(points[:, 0].max() - x0, points[:, 1].max() - y0)
+    side = int(2 ** np.ceil(np.log2(longest_side)))
+    return [[x0, y0], [x0 + side, y0 + side]]
+
+
+def get_tile_ids(points, extent, level):
+    """Assign each point to a quadtree tile at a level.
+
+    Args:
+        points (np.ndarray): Projected points with shape (n, 2)
+        extent ([[int, int], [int, int]]): Quadtree extent
+        level (int): Quadtree level
+
+    Returns:
+        (np.ndarray, np.ndarray): Tile x and y indexes of each point
+    """
+    tile_count = 2**level
+    tile_size = (extent[1][0] - extent[0][0]) / tile_count
+    tile_xs = np.floor((points[:, 0] - extent[0][0]) / tile_size).astype(np.int64)
+    tile_ys = np.floor((points[:, 1] - extent[0][1]) / tile_size).astype(np.int64)
+    return (
+        np.clip(tile_xs, 0, tile_count - 1),
+        np.clip(tile_ys, 0, tile_count - 1),
+    )
+
+
+def get_term_matrix(prompts):
+    """Count the words of each prompt.
+
+    Args:
+        prompts ([string]): Prompts
+
+    Returns:
+        (scipy.sparse.csr_matrix, np.ndarray): Binary prompt-word matrix and
+            the words of its columns
+    """
+    from sklearn.feature_extraction.text import CountVectorizer
+
+    vectorizer = CountVectorizer(
+        stop_words="english",
+        token_pattern=r"(?u)\b[a-zA-Z][a-zA-Z0-9]+\b",
+        min_df=2,
+        binary=True,
+        dtype=np.float32,
+    )
+    # Null prompts keep their row (rows are aligned with the points) with no
+    # words
+    term_matrix = vectorizer.fit_transform(pd.Series(prompts).fillna(""))
+    return term_matrix, vectorizer.get_feature_names_out()
+
+
+def get_level_topics(points, term_matrix, words, extent, level):
+    """Label each tile with enough points at a quadtree level with the top
+    TF-IDF words of its prompts (each tile is a document).
+
+    Args:
+        points (np.ndarray): Projected points with shape (n, 2)
+        term_matrix (scipy.sparse.csr_matrix): Prompt-word matrix
+        words (np.ndarray): Words of the term matrix columns
+        extent ([[int, int], [int, int]]): Quadtree extent
+        level (int): Quadtree level
+
+    Returns:
+        [[float, float, string]]: Tile center x, tile center y, and label
+    """
+    from scipy.sparse import csr_matrix
+
+    tile_xs, tile_ys = get_tile_ids(points, extent, level)
+    tile_keys = tile_xs * (2**level) + tile_ys
+    unique_keys, inverse, counts = np.unique(
+        tile_keys, return_inverse=True, return_counts=True
+    )
+
+    # Sum the word counts of prompts in each tile with one sparse product
+    membership = csr_matrix(
+        (np.ones(len(points), dtype=np.float32), (inverse, np.arange(len(points)))),
+        shape=(len(unique_keys), len(points)),
+    )
+    tile_terms = (membership @ term_matrix).tocsr()
+
+    # TF-IDF across tiles at this level
+    tile_document_freqs = np.bincount(tile_terms.indices, minlength=len(words))
+    idf = np.log(len(unique_keys) / (1 + tile_document_freqs)) + 1
+
+    tile_size = (extent[1][0] - extent[0][0]) / (2**level)
+    topics = []
+
+    for tile_i, key in enumerate(unique_keys):
+        if counts[tile_i] < MIN_TILE_POINTS:
+            continue
+
+        row_start, row_end = tile_terms.indptr[tile_i], tile_terms.indptr[tile_i + 1]
+        if row_end == row_start:
+            continue
+
+        word_indexes = tile_terms.indices[row_start:row_end]
+        scores = tile_terms.data[row_start:row_end] * idf[word_indexes]
+        top_k = min(TOPIC_WORD_COUNT, len(scores))
+        top_indexes = np.argpartition(-scores, top_k - 1)[:top_k]
+        top_indexes = top_indexes[np.argsort(-scores[top_indexes])]
+
+        tile_x, tile_y = divmod(int(key), 2**level)
+        topics.append(
+            [
+                extent[0][0] + (tile_x + 0.5) * tile_size,
+                extent[0][1] + (tile_y + 0.5) * tile_size,
+                "-".join(words[word_indexes[top_indexes]]),
+            ]
+        )
+
+    return topics
+
+
+def _get_level_topics_from_inputs(level):
+    """
+    Pool worker: label the tiles of one level with the shared topic inputs.
+    """
+    points, term_matrix, words, extent = _topic_inputs
+    return get_level_topics(points, term_matrix, words, extent, level)
+
+
+def get_topic_data(points, prompts, levels=TOPIC_LEVELS, n_proc=1):
+    """Create the multi-level topic label data of the explorer.
+
+    Args:
+        points (np.ndarray): Projected points with shape (n, 2)
+        prompts ([string]): Prompts of the points
+        levels ([int]): Quadtree levels
+        n_proc (int): Number of processes to compute levels in parallel
+
+    Returns:
+        dict: {"extent", "data", "range"}
+    """
+    global _topic_inputs
+
+    extent = get_topic_extent(points)
+    term_matrix, words = get_term_matrix(prompts)
+
+    if n_proc <= 1:
+        level_topics = [
+            get_level_topics(points, term_matrix, words, extent, level)
+            for level in levels
+        ]
+    else:
+        # Forked workers inherit the large term matrix without a copy
+        _topic_inputs = (points, term_matrix, words, extent)
+        with Pool(min(n_proc, len(levels))) as p:
+            level_topics = p.map(_get_level_topics_from_inputs, levels)
+        _topic_inputs = None
+
+    return {
+        "extent": extent,
+        "data": {str(level): t for level, t in zip(levels, level_topics)},
+        "range": [
+            round(float(points[:, 0].min()), 4),
+            round(float(points[:, 1].min()), 4),
+            round(float(points[:, 0].max()), 4),
+            round(float(points[:, 1].max()), 4),
+        ],
+    }
+
+
+def write_points(points, prompts, output_path):
+    """Write the points as json lines of [x, y, prompt] in random order, so the
+    first lines the explorer streams are a uniform sample.
+
+    Args:
+        points (np.ndarray): Projected points with shape (n, 2)
+        prompts ([string]): Prompts of the points
+        output_path (string): Path to the ndjson file
+    """
+    from json import dumps
+
+    order = np.random.default_rng(0).permutation(len(points))
+    rounded = np.round(points.astype(np.float64), 4)
+
+    with open(output_path, "w", encoding="utf8") as fp:
+        for i in order:
+            fp.write(dumps([rounded[i, 0], rounded[i, 1], prompts[i]]))
+            fp.write("\n")
+
+
+def write_json(data, output_path):
+    """
+    Write a compact json file.
+    """
+    dump(data, open(output_path, "w", encoding="utf8"), separators=(",", ":"))
+
+
+def write_sections(arrays, output_path):
+    """Write arrays back to back into one little-endian binary file, each one
+    starting at a multiple of BINARY_ALIGNMENT.
+
+    Args:
+        arrays ({string: np.ndarray}): Arrays to write, by section name
+        output_path (string): Path to the binary file
+
+    Returns:
+        dict: {name: {"offset", "dtype", "shape"}} of each section
+    """
+    sections = {}
+    offset = 0
+
+    with open(output_path, "wb") as fp:
+        for name, array in arrays.items():
+            array = np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<"))
+            padding = -offset % BINARY_ALIGNMENT
+            fp.write(b"\0" * padding)
+            offset += padding
+
+            sections[name] = {
+                "offset": offset,
+                "dtype": array.dtype.str,
+                "shape": list(array.shape),
+            }
+            fp.write(array.tobytes())
+            offset += array.nbytes
+
+    return sections
+
+
+def read_section(data, section):
+    """
+    View a section of a binary file (bytes) as a numpy array without a copy.
+    """
+    dtype = np.dtype(section["dtype"])
+    count = int(np.prod(section["shape"]))
+    array = np.frombuffer(data, dtype=dtype, count=count, offset=section["offset"])
+    return array.reshape(section["shape"])
+
+
+def quantize_grid(grid, dtype=np.uint16):
+    """Quantize a non-negative density grid to unsigned integers.
+
+    Args:
+        grid (np.ndarray): Density grid
+        dtype (np.dtype): np.uint8 or np.uint16
+
+    Returns:
+        (np.ndarray, float): Quantized grid and its scale, density = value *
+            scale
+    """
+    max_value = np.iinfo(dtype).max
+    scale = float(grid.max()) / max_value if grid.max() > 0 else 1.0
+    quantized = np.clip(np.round(grid / scale), 0, max_value).astype(dtype)
+    return quantized, scale
+
+
+def get_string_table(strings):
+    """Encode strings as one UTF-8 blob and the offsets of each string in it.
+
+    Args:
+        strings ([string]): Strings
+
+    Returns:
+        (np.ndarray, np.ndarray): uint8 blob and uint32 offsets, string i is
+            blob[offsets[i]:offsets[i + 1]]
+    """
+    encoded = [string.encode("utf8") for string in strings]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.uint32)
+    offsets[1:] = np.cumsum([len(e) for e in encoded])
+    blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+    return blob, offsets
+
+
+def write_binary_data(name, grid_data, topic_data, output_dir, grid_dtype=np.uint16):
+    """Write the compact binary variant of the grid and topic data:
+    umap-<name>-grid.bin, umap-<name>-topic-data.bin, and the manifest
+    umap-<name>-binary.json with the section layout and the small fields.
+
+    Topic labels are stored once in a string table. Each level has float32
+    tile centers and uint32 indexes into the table.
+
+    Args:
+        name (string): Name of the map, for example 1m
+        grid_data (dict): Data from get_grid_data()
+        topic_data (dict): Data from get_topic_data()
+        output_dir (string): Output directory
+        grid_dtype (np.dtype): np.uint8 or np.uint16
+
+    Returns:
+        dict: The manifest
+    """
+    grid, scale = quantize_grid(np.array(grid_data["grid"]), grid_dtype)
+    grid_file = f"umap-{name}-grid.bin"
+    grid_sections = write_sections({"grid": grid}, join(output_dir, grid_file))
+
+    labels = sorted(
+        {t[2] for level_topics in topic_data["data"].values() for t in level_topics}
+    )
+    label_indexes = {label: i for i, label in enumerate(labels)}
+    blob, offsets = get_string_table(labels)
+    topic_arrays = {"labelOffsets": offsets, "labelBlob": blob}
+
+    for level, level_topics in topic_data["data"].items():
+        topic_arrays[f"{level}/centers"] = np.array(
+            [t[:2] for t in level_topics], dtype=np.float32
+        ).reshape(-1, 2)
+        topic_arrays[f"{level}/labels"] = np.array(
+            [label_indexes[t[2]] for t in level_topics], dtype=np.uint32
+        )
+
+    topic_file = f"umap-{name}-topic-data.bin"
+    topic_sections = write_sections(topic_arrays, join(output_dir, topic_file))
+
+    # Older topic files (e.g. the 60k map) have no range, use the grid's
+    # range instead, which can be padded around the points
+    topic_range = topic_data.get("range")
+    if topic_range is None:
+        topic_range = [
+            grid_data["xRange"][0],
+            grid_data["yRange"][0],
+            grid_data["xRange"][1],
+            grid_data["yRange"][1],
+        ]
+
+    manifest = {
+        "grid": {
+            "file": grid_file,
+            "sections": grid_sections,
+            "scale": scale,
+            "xRange": grid_data["xRange"],
+            "yRange": grid_data["yRange"],
+            "sampleSize": grid_data.get("sampleSize"),
+            "padded": grid_data.get("padded", False),
+        },
+        "topic": {
+            "file": topic_file,
+            "sections": topic_sections,
+            "levels": list(topic_data["data"].keys()),
+            "extent": topic_data["extent"],
+            "range": topic_range,
+        },
+    }
+    write_json(manifest, join(output_dir, f"umap-{name}-binary.json"))
+    return manifest
+
+
+def read_binary_data(manifest, output_dir):
+    """Read the binary variant back into the grid and topic data dicts, with
+    numpy arrays in place of nested lists.
+
+    Args:
+        manifest (dict): Manifest from write_binary_data()
+        output_dir (string): Directory of the binary files
+
+    Returns:
+        (dict, dict): Grid data and topic data
+    """
+    grid_manifest, topic_manifest = manifest["grid"], manifest["topic"]
+
+    with open(join(output_dir, grid_manifest["file"]), "rb") as fp:
+        grid_bytes = fp.read()
+    grid = read_section(grid_bytes, grid_manifest["sections"]["grid"])
+    grid_data = {
+        "grid": grid * grid_manifest["scale"],
+        "xRange": grid_manifest["xRange"],
+        "yRange": grid_manifest["yRange"],
+    }
+
+    with open(join(output_dir, topic_manifest["file"]), "rb") as fp:
+        topic_bytes = fp.read()
+    sections = topic_manifest["sections"]
+    offsets = read_section(topic_bytes, sections["labelOffsets"])
+    blob = read_section(topic_bytes, sections["labelBlob"]).tobytes()
+    labels = [
+        blob[offsets[i] : offsets[i + 1]].decode("utf8")
+        for i in range(len(offsets) - 1)
+    ]
+
+    topic_data = {"extent": topic_manifest["extent"], "range": topic_manifest["range"]}
+    topic_data["data"] = {
+        level: (
+            read_section(topic_bytes, sections[f"{level}/centers"]),
+            [labels[i] for i in read_section(topic_bytes, sections[f"{level}/labels"])],
+        )
+        for level in topic_manifest["levels"]
+    }
+
+    return grid_data, topic_data
+
+
+def assign_point_tiles(
+    points, extent, tile_capacity=TILE_CAPACITY, max_level=MAX_TILE_LEVEL
+):
+    """Assign each point to exactly one quadtree tile. Going down from level 0,
+    each tile takes up to tile_capacity of its unassigned points, picked by a
+    random priority, and the tiles at max_level take all the remaining points.
+    A viewer draws a region by merging the visible tiles of every level up to
+    its zoom, so each level adds detail to the coarser ones.
+
+    Args:
+        points (np.ndarray): Projected points with shape (n, 2)
+        extent ([[int, int], [int, int]]): Quadtree extent
+        tile_capacity (int): Max number of points of a tile above max_level
+        max_level (int): Deepest tile level
+
+    Returns:
+        (np.ndarray, np.ndarray): Tile level and tile key (x * 2^level + y) of
+            each point
+    """
+    priorities = np.random.default_rng(0).permutation(len(points))
+    point_levels = np.full(len(points), -1, dtype=np.int8)
+    point_keys = np.zeros(len(points), dtype=np.int64)
+
+    for level in range(max_level + 1):
+        unassigned = np.where(point_levels < 0)[0]
+        if len(unassigned) == 0:
+            break
+
+        tile_xs, tile_ys = get_tile_ids(points[unassigned], extent, level)
+        keys = tile_xs * (2**level) + tile_ys
+
+        if level == max_level:
+            selected = np.ones(len(unassigned), dtype=bool)
+        else:
+            # Rank the points of each tile by priority
+            order = np.lexsort((priorities[unassigned], keys))
+            sorted_keys = keys[order]
+            group_starts = np.r_[0, np.where(np.diff(sorted_keys) != 0)[0] + 1]
+            group_sizes = np.diff(np.r_[group_starts, len(order)])
+            ranks = np.arange(len(order)) - np.repeat(group_starts, group_sizes)
+            selected = np.zeros(len(unassigned), dtype=bool)
+            selected[order[ranks < tile_capacity]] = True
+
+        point_levels[unassigned[selected]] = level
+        point_keys[unassigned[selected]] = keys[selected]
+
+    return point_levels, point_keys
+
+
+def get_tile_name(level, key):
+    """
+    Get the name of a tile: level/x/y.
+    """
+    level = int(level)
+    tile_x, tile_y = divmod(int(key), 2**level)
+    return f"{level}/{tile_x}/{tile_y}"
+
+
+def _write_tile(tile):
+    """Pool worker: write the point buffer and the prompt shard of one tile.
+
+    Args:
+        tile ((string, int, int)): Tile name, and the start and end of its
+            points in the shared tile order
+
+    Returns:
+        int: Number of written bytes
+    """
+    points, prompts, order, tile_dir = _tile_inputs
+    name, start, end = tile
+    point_ids = order[start:end]
+
+    records = np.zeros(len(point_ids), dtype=TILE_RECORD_DTYPE)
+    records["x"] = points[point_ids, 0]
+    records["y"] = points[point_ids, 1]
+    records["id"] = point_ids
+
+    tile_path = join(tile_dir, name)
+    os.makedirs(os.path.dirname(tile_path), exist_ok=True)
+    records.tofile(tile_path + ".bin")
+
+    # Prompts are in the same order as the point records
+    write_json([prompts[i] for i in point_ids], tile_path + ".json")
+
+    return records.nbytes + os.path.getsize(tile_path + ".json")
+
+
+def export_tiles(
+    points,
+    prompts,
+    tile_dir,
+    tile_capacity=TILE_CAPACITY,
+    max_level=MAX_TILE_LEVEL,
+    n_proc=1,
+):
+    """Export the points as a quadtree of tiles. Each tile has a binary point
+    buffer level/x/y.bin of TILE_RECORD_DTYPE records (the id is the row of the
+    point in the unique prompts) and a prompt shard level/x/y.json. A
+    manifest.json lists the tiles and their point counts.
+
+    Args:
+        points (np.ndarray): Projected points with shape (n, 2)
+        prompts ([string]): Prompts of the points
+        tile_dir (string): Output directory
+        tile_capacity (int): Max number of points of a tile above max_level
+        max_level (int): Deepest tile level
+        n_proc (int): Number of processes to write tiles in parallel
+
+    Returns:
+        dict: The manifest
+    """
+    global _tile_inputs
+
+    if not exists(tile_dir):
+        os.makedirs(tile_dir)
+
+    extent = get_topic_extent(points)
+    point_levels, point_keys = assign_point_tiles(
+        points, extent, tile_capacity, max_level
+    )
+
+    # Group the points of each tile
+    order = np.lexsort((point_keys, point_levels))
+    sorted_levels, sorted_keys = point_levels[order], point_keys[order]
+    is_new_tile = (np.diff(sorted_levels) != 0) | (np.diff(sorted_keys) != 0)
+    starts = np.r_[0, np.where(is_new_tile)[0] + 1]
+    ends = np.r_[starts[1:], len(order)]
+    tiles = [
+        (get_tile_name(sorted_levels[s], sorted_keys[s]), s, e)
+        for s, e in zip(starts, ends)
+    ]
+
+    # Forked workers inherit the points and prompts without a copy
+    _tile_inputs = (points, prompts, order, tile_dir)
+    with Pool(n_proc) as p:
+        tile_bytes = p.map(_write_tile, tiles, chunksize=16)
+    _tile_inputs = None
+
+    manifest = {
+        "extent": extent,
+        "maxLevel": int(point_levels.max()),
+        "tileCapacity": tile_capacity,
+        "pointCount": len(points),
+        "record": [[name, TILE_RECORD_DTYPE[name].str] for name in ["x", "y", "id"]],
+        "tiles": {name: int(e - s) for name, s, e in tiles},
+        "totalBytes": int(sum(tile_bytes)),
+    }
+    write_json(manifest, join(tile_dir, "manifest.json"))
+    return manifest
@@ -0,0 +1,107 @@
+from os.path import join
+
+import time
+import argparse
+
+import numpy as np
+
+from explorer_data import (
+    TILE_CAPACITY,
+    MAX_TILE_LEVEL,
+    timed_stage,
+    stage_seconds,
+    load_unique_prompts,
+    export_tiles,
+)
+
+SHARE_DIR = "/project/zwang3049/diffusiondb-hugging"
+OUTPUT_DIR = "./explorer/data"
+N_PROC = 36
+
+parser = argparse.ArgumentParser(
+    description="Export the explorer points as a quadtree of tiles"
+)
+parser.add_argument(
+    "name", type=str, help="Name of the map, for example 1m or 14m"
+)
+parser.add_argument(
+    "-m",
+    "--metadata",
+    type=str,
+    default=join(SHARE_DIR, "metadata.parquet"),
+    help="Path to the metadata parquet file",
+)
+parser.add_argument(
+    "-p",
+    "--projection",
+    type=str,
+    default=None,
+    help="Path to the .npy 2D projection (default: the one saved by "
+    "build-explorer-data.py)",
+)
+parser.add_argument(
+    "-c",
+    "--tile_capacity",
+    type=int,
+    default=TILE_CAPACITY,
+    help="Max number of points a tile adds to its parent tiles",
+)
+parser.add_argument(
+    "-l", "--max_level", type=int, default=MAX_TILE_LEVEL, help="Deepest tile level"
+)
+parser.add_argument(
+    "-o", "--output_dir", type=str, default=OUTPUT_DIR, help="Output directory"
+)
+
+
+def main():
+    """
+    Main function
+    """
+    args = parser.parse_args()
+    start_time = time.time()
+
+    projection_path = args.projection or join(
+        args.output_dir, f"umap-{args.name}-projection.npy"
+    )
+
+    with timed_stage("load"):
+        prompts = load_unique_prompts(args.metadata)
+        points = np.load(projection_path)
+
+    if len(points) != len(prompts):
+        raise ValueError(
+            f"The projection has {len(points)} rows but there are "
+            f"{len(prompts)} unique prompts"
+        )
+
+    with timed_stage("tiles"):
+        manifest = export_tiles(
+            points,
+            prompts,
+            join(args.output_dir, f"tiles-{args.name}"),
+            args.tile_capacity,
+            args.max_level,
+            n_proc=N_PROC,
+        )
+
+    tile_counts = list(manifest["tiles"].values())
+    root_count = manifest["tiles"].get("0/0/0", 0)
+    print(
+        f"{len(tile_counts)} tiles up to level {manifest['maxLevel']}, "
+        f"{manifest['totalBytes'] / 1e6:.1f} MB in total"
+    )
+    print(
+        f"The root tile has {root_count} of {manifest['pointCount']} points, "
+        f"the largest tile has {max(tile_counts)} points"
+    )
+
+    print("\nStage times:")
+    for name, seconds in stage_seconds.items():
+        print(f"\t{name}: {seconds:.1f} seconds")
+
+    print("Finished in", (time.time() - start_time) / 60, "minutes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+from os.path import join
+from multiprocessing import Pool
+
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+WORK_DIR = "/nvmescratch/jay/diffusiondb"
+N_PROC = 36
+
+# Hashes are split into this many 16-bit blocks. Two hashes within Hamming
+# distance N_BLOCKS - 1 share at least one block exactly (pigeonhole).
+N_BLOCKS = 4
+BLOCK_BITS = 64 // N_BLOCKS
+MAX_DISTANCE = N_BLOCKS - 1
+
+# Buckets larger than this (e.g. flat images) are split again by their other
+# bits instead of comparing every pair in them
+MAX_BUCKET_SIZE = 5000
+
+parser = argparse.ArgumentParser(
+    description="Find groups of duplicate images by their perceptual hashes"
+)
+parser.add_argument(
+    "-l",
+    "--large",
+    default=False,
+    help="Use the hashes of DiffusionDB Large instead of DiffusionDB 2M",
+    action="store_true",
+)
+parser.add_argument(
+    "-c",
+    "--hash_column",
+    type=str,
+    default="image_phash",
+    choices=["image_phash", "image_dhash"],
+    help="Hash column to compare",
+)
+parser.add_argument(
+    "-d",
+    "--max_distance",
+    type=int,
+    default=MAX_DISTANCE,
+    help=f"Max Hamming distance of duplicates (at most {MAX_DISTANCE})",
+)
+
+
+def popcount64(values):
+    """
+    Count the set bits of uint64 values (SWAR bit counting).
+    """
+    values = values - ((values >> np.uint64(1)) & np.uint64(0x5555555555555555))
+    values = (values & np.uint64(0x3333333333333333)) + (
+        (values >> np.uint64(2)) & np.uint64(0x3333333333333333)
+    )
+    values = (values + (values >> np.uint64(4))) & np.uint64(0x0F0F0F0F0F0F0F0F)
+    return ((values * np.uint64(0x0101010101010101)) >> np.uint64(56)).astype(
+        np.int64
+    )
+
+
+def get_bucket_pairs(hashes, indexes, keys, max_distance):
+    """Find pairs of hashes within max_distance that have the same key. Hashes
+    are sorted by key, then each hash is compared with the next ones in its
+    bucket, one offset at a time. Oversized buckets are returned instead.
+
+    Args:
+        hashes (np.ndarray): Unique hashes
+        indexes (np.ndarray): Indexes of the hashes to pair
+        keys (np.ndarray): Bucket key of each index
+        max_distance (int): Max Hamming distance
+
+    Returns:
+        (np.ndarray, [np.ndarray]): Index pairs with shape (n, 2), and the
+            indexes of each oversized bucket
+    """
+    order = np.argsort(keys, kind="stable")
+    sorted_keys = keys[order]
+    is_bucket_start = np.r_[True, sorted_keys[1:] != sorted_keys[:-1]]
+    bucket_ids = np.cumsum(is_bucket_start) - 1
+    bucket_sizes = np.bincount(bucket_ids)
+
+    # Number of hashes after each one in its bucket
+    remaining = np.cumsum(bucket_sizes)[bucket_ids] - np.arange(len(order)) - 1
+
+    # Set oversized buckets aside, whole buckets are removed so the remaining
+    # counts stay valid
+    is_oversized = bucket_sizes[bucket_ids] > MAX_BUCKET_SIZE
+    oversized_buckets = []
+    if is_oversized.any():
+        oversized_buckets = np.split(
+            indexes[order[is_oversized]],
+            np.where(np.diff(bucket_ids[is_oversized]) != 0)[0] + 1,
+        )
+
+    order, remaining = indexes[order[~is_oversized]], remaining[~is_oversized]
+    sorted_hashes = hashes[order]
+
+    pairs = [np.zeros((0, 2), dtype=np.int64)]
+    lefts = np.arange(len(order))
+    offset = 1
+    while True:
+        # Only hashes with a bucket mate at this offset
+        lefts = lefts[remaining[lefts] >= offset]
+        if len(lefts) == 0:
+            break
+
+        distances = popcount64(sorted_hashes[lefts] ^ sorted_hashes[lefts + offset])
+        close_lefts = lefts[distances <= max_distance]
+        pairs.append(
+            np.stack([order[close_lefts], order[close_lefts + offset]], axis=1)
+        )
+        offset += 1
+
+    return np.concatenate(pairs), oversized_buckets
+
+
+def get_sub_block_masks(used_mask, n_blocks):
+    """
+    Split the bits not in used_mask into n_blocks masks of nearly equal sizes.
+    """
+    free_bits = [b for b in range(64) if not (used_mask >> b) & 1]
+    return [
+        sum(1 << int(b) for b in bits)
+        for bits in np.array_split(free_bits, n_blocks)
+        if len(bits) > 0
+    ]
+
+
+def find_block_pairs(task):
+    """Find pairs of hashes within max_distance that share one block.
+
+    Hashes in an oversized bucket agree on the bucket's bits, so a pair within
+    max_distance differs in at most max_distance of the other bits. Splitting
+    those bits into max_distance + 1 sub-blocks, the pair shares one of them
+    (pigeonhole again), so each sub-block re-buckets the hashes without
+    missing pairs. Buckets shrink as more bits are fixed, and hashes are
+    unique, so this ends before the free bits run out.
+
+    Args:
+        task ((np.ndarray, int, int)): Unique hashes, block id, and max
+            Hamming distance
+
+    Returns:
+        np.ndarray: Index pairs into the unique hashes with shape (n, 2)
+    """
+    hashes, block_i, max_distance = task
+    block_mask = ((1 << BLOCK_BITS) - 1) << (block_i * BLOCK_BITS)
+
+    # Stack of (hash indexes, key mask, bits fixed in the bucket)
+    buckets = [(np.arange(len(hashes)), block_mask, block_mask)]
+    pairs = []
+    split_count = 0
+
+    while len(buckets) > 0:
+        indexes, key_mask, used_mask = buckets.pop()
+        keys = hashes[indexes] & np.uint64(key_mask)
+        bucket_pairs, oversized_buckets = get_bucket_pairs(
+            hashes, indexes, keys, max_distance
+        )
+        pairs.append(bucket_pairs)
+
+        for bucket_indexes in oversized_buckets:
+            split_count += 1
+            for sub_mask in get_sub_block_masks(used_mask, max_distance + 1):
+                buckets.append((bucket_indexes, sub_mask, used_mask | sub_mask))
+
+    print(f"Block {block_i}: split {split_count} oversized buckets")
+    return np.concatenate(pairs)
+
+
+def main():
+    """
+    Main function
+    """
+    args = parser.parse_args()
+    start_time = time.time()
+
+    if args.max_distance > MAX_DISTANCE:
+        raise ValueError(f"The max distance is at most {MAX_DISTANCE}")
+
+    dataset = "large" if args.large else "2m"
+    hash_df = pd.read_parquet(
+        join(WORK_DIR, f"image-hashes-{dataset}.parquet"),
+        columns=["image_name", args.hash_column],
+    )
+
+    # Images with the same hash are exact duplicates, only compare unique hashes
+    unique_hashes, hash_codes = np.unique(
+        hash_df[args.hash_column].to_numpy(dtype=np.uint64), return_inverse=True
+    )
+    print(f"{len(hash_df)} images, {len(unique_hashes)} unique hashes")
+
+    search_start_time = time.time()
+    with Pool(min(N_PROC, N_BLOCKS)) as p:
+        block_pairs = p.map(
+            find_block_pairs,
+            [(unique_hashes, i, args.max_distance) for i in range(N_BLOCKS)],
+        )
+    pairs = np.concatenate(block_pairs)
+    search_seconds = time.time() - search_start_time
+    print(
+        f"Found {len(pairs)} near-duplicate hash pairs in {search_seconds:.1f} "
+        f"seconds, {len(unique_hashes) / max(search_seconds, 1e-6):.0f} hashes/sec"
+    )
+
+    # Duplicate groups are the connected components of the pair graph
+    graph = coo_matrix(
+        (np.ones(len(pairs), dtype=np.int8), (pairs[:, 0], pairs[:, 1])),
+        shape=(len(unique_hashes), len(unique_hashes)),
+    )
+    _, hash_groups = connected_components(graph, directed=False)
+    image_groups = hash_groups[hash_codes].astype(np.uint32)
+
+    output_path = join(WORK_DIR, f"image-duplicates-{dataset}.parquet")
+    pd.DataFrame(
+        {"image_name": hash_df["image_name"], "image_duplicate_group": image_groups}
+    ).to_parquet(output_path, index=False)
+
+    group_sizes = np.bincount(image_groups)
+    print(
+        f"{np.sum(group_sizes > 1)} duplicate groups with "
+        f"{np.sum(group_sizes[group_sizes > 1])} images, the largest group has "
+        f"{group_sizes.max()} images"
+    )
+    print("Finished in", (time.time() - start_time) / 60, "minutes")
+
+
+if __name__ == "__main__":
+    main()
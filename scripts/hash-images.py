@@ -0,0 +1,303 @@
+from glob import glob
+from os.path import exists, join, basename
+from io import BytesIO
+from zipfile import ZipFile
+from multiprocessing import Pool
+from tqdm import tqdm
+
+import os
+import re
+import time
+import argparse
+
+import numpy as np
+import pandas as pd
+from PIL import Image
+
+from zip_index import get_index_path, load_zip_index, read_member
+
+N_PROC = 36
+
+ZIP_DIR1 = "/project/zwang3049/diffusiondb-hugging/diffusiondb-large-part-1/"
+ZIP_DIR2 = "/project/zwang3049/diffusiondb-hugging/diffusiondb-large-part-2/"
+ZIP_DIR_2M = "/project/zwang3049/diffusiondb-hugging/images/"
+WORK_DIR = "/nvmescratch/jay/diffusiondb"
+
+# pHash: DCT of a 32x32 gray image, keep the 8x8 lowest frequencies
+PHASH_IMAGE_SIZE = 32
+PHASH_SIZE = 8
+
+# Number of images hashed at a time
+HASH_BATCH_SIZE = 256
+
+parser = argparse.ArgumentParser(
+    description="Compute perceptual hashes (pHash and dHash) of all images"
+)
+parser.add_argument(
+    "-l",
+    "--large",
+    default=False,
+    help="Hash DiffusionDB Large (WebP) instead of DiffusionDB 2M (PNG)",
+    action="store_true",
+)
+
+
+def get_zip_path(part_id, large):
+    """
+    Get the path of a part zip file on the share.
+    """
+    if large:
+        if part_id > 10000:
+            return join(ZIP_DIR2, f"part-{part_id:06}.zip")
+        else:
+            return join(ZIP_DIR1, f"part-{part_id:06}.zip")
+    else:
+        return join(ZIP_DIR_2M, f"part-{part_id:06}.zip")
+
+
+def get_hash_path(part_id, large):
+    """
+    Get the path of the hash file of a part.
+    """
+    hash_dir = join(WORK_DIR, "image-hashes-large" if large else "image-hashes-2m")
+    return join(hash_dir, f"part-{part_id:06}.npz")
+
+
+def read_images(zip_path):
+    """Stream the image members of a part zip file. With a member index, each
+    member is one positioned read.
+
+    Args:
+        zip_path (string): Path to the zip file
+
+    Yields:
+        (string, bytes): Image name and its bytes
+    """
+    if exists(get_index_path(zip_path)):
+        members = load_zip_index(zip_path)["members"]
+        fd = os.open(zip_path, os.O_RDONLY)
+        try:
+            for name, entry in members.items():
+                if not name.endswith(".json"):
+                    yield name, read_member(fd, entry)
+        finally:
+            os.close(fd)
+    else:
+        with ZipFile(zip_path) as zip_file:
+            for name in zip_file.namelist():
+                if not name.endswith(".json"):
+                    yield name, zip_file.read(name)
+
+
+def get_dct_matrix(size):
+    """
+    Get the orthonormal DCT-II matrix, so the 2D DCT of X is D @ X @ D.T.
+    """
+    k = np.arange(size)[:, None]
+    n = np.arange(size)[None, :]
+    matrix = np.cos(np.pi * (2 * n + 1) * k / (2 * size)) * np.sqrt(2 / size)
+    matrix[0] /= np.sqrt(2)
+    return matrix.astype(np.float32)
+
+
+DCT_MATRIX = get_dct_matrix(PHASH_IMAGE_SIZE)
+
+# Bit weights to pack 64 booleans into a uint64
+BIT_WEIGHTS = np.uint64(1) << np.arange(64, dtype=np.uint64)
+
+
+def pack_bits(bits):
+    """
+    Pack boolean arrays with shape (n, 64) into uint64 hashes.
+    """
+    return np.bitwise_or.reduce(
+        np.where(bits, BIT_WEIGHTS[None, :], np.uint64(0)), axis=1
+    )
+
+
+def get_phashes(images):
+    """Compute pHashes of a batch of gray images: the signs of the 8x8 lowest
+    DCT frequencies relative to their median.
+
+    Args:
+        images (np.ndarray): float32 gray images with shape (n, 32, 32)
+
+    Returns:
+        np.ndarray: uint64 hashes
+    """
+    dct = np.einsum("ij,njk,lk->nil", DCT_MATRIX, images, DCT_MATRIX)
+    low = dct[:, :PHASH_SIZE, :PHASH_SIZE].reshape(len(images), -1)
+    return pack_bits(low > np.median(low, axis=1, keepdims=True))
+
+
+def get_dhashes(images):
+    """Compute dHashes of a batch of gray images: whether each pixel is
+    brighter than its right neighbor.
+
+    Args:
+        images (np.ndarray): float32 gray images with shape (n, 8, 9)
+
+    Returns:
+        np.ndarray: uint64 hashes
+    """
+    bits = images[:, :, 1:] > images[:, :, :-1]
+    return pack_bits(bits.reshape(len(images), -1))
+
+
+def hash_one_part(task):
+    """Hash all images of a part and save the hashes to an npz file.
+
+    Args:
+        task ((int, bool)): Part id and whether it is a Large part
+
+    Returns:
+        (int, float, float, float): Number of images, read seconds, decode
+            seconds, and hash seconds
+    """
+    part_id, large = task
+    image_names, phashes, dhashes = [], [], []
+    phash_images, dhash_images = [], []
+    read_seconds, decode_seconds, hash_seconds = 0.0, 0.0, 0.0
+
+    def hash_batch():
+        nonlocal hash_seconds
+        start_time = time.time()
+        phashes.append(get_phashes(np.stack(phash_images)))
+        dhashes.append(get_dhashes(np.stack(dhash_images)))
+        phash_images.clear()
+        dhash_images.clear()
+        hash_seconds += time.time() - start_time
+
+    images = read_images(get_zip_path(part_id, large))
+    while True:
+        # Time reading the image bytes from the share apart from decoding
+        start_time = time.time()
+        item = next(images, None)
+        read_seconds += time.time() - start_time
+        if item is None:
+            break
+
+        name, data = item
+        start_time = time.time()
+        try:
+            image = Image.open(BytesIO(data)).convert("L")
+        except OSError as error:
+            print(f"Skipped {name} in part {part_id}: {error}")
+            continue
+
+        phash_images.append(
+            np.asarray(
+                image.resize((PHASH_IMAGE_SIZE, PHASH_IMAGE_SIZE), Image.BILINEAR),
+                dtype=np.float32,
+            )
+        )
+        dhash_images.append(
+            np.asarray(image.resize((9, 8), Image.BILINEAR), dtype=np.float32)
+        )
+        image_names.append(name)
+        decode_seconds += time.time() - start_time
+
+        if len(phash_images) == HASH_BATCH_SIZE:
+            hash_batch()
+
+    if len(phash_images) > 0:
+        hash_batch()
+
+    # Write to a temporary file, so a killed run never leaves a partial file
+    hash_path = get_hash_path(part_id, large)
+    tmp_path = hash_path + ".tmp.npz"
+    np.savez(
+        tmp_path,
+        image_name=np.array(image_names),
+        phash=np.concatenate(phashes) if phashes else np.zeros(0, np.uint64),
+        dhash=np.concatenate(dhashes) if dhashes else np.zeros(0, np.uint64),
+    )
+    os.replace(tmp_path, hash_path)
+
+    return len(image_names), read_seconds, decode_seconds, hash_seconds
+
+
+def merge_hashes(large):
+    """Merge the hash files of all parts into one parquet file.
+
+    Args:
+        large (bool): Whether to merge Large parts
+
+    Returns:
+        string: Path to the parquet file
+    """
+    hash_dir = os.path.dirname(get_hash_path(1, large))
+    hash_dfs = []
+
+    for hash_path in sorted(glob(join(hash_dir, "part-??????.npz"))):
+        hashes = np.load(hash_path)
+        hash_df = pd.DataFrame(
+            {
+                "image_name": hashes["image_name"],
+                "image_phash": hashes["phash"],
+                "image_dhash": hashes["dhash"],
+            }
+        )
+        hash_df["part_id"] = np.uint16(
+            int(re.sub(r"part-(\d+)\.npz", r"\1", basename(hash_path)))
+        )
+        hash_dfs.append(hash_df)
+
+    output_path = hash_dir + ".parquet"
+    pd.concat(hash_dfs, ignore_index=True).to_parquet(output_path, index=False)
+    return output_path
+
+
+def main():
+    """
+    Main function
+    """
+    args = parser.parse_args()
+    start_time = time.time()
+
+    part_ids = list(range(1, 14001 if args.large else 2001))
+    hash_dir = os.path.dirname(get_hash_path(1, args.large))
+    if not exists(hash_dir):
+        os.makedirs(hash_dir)
+
+    # Resume from existing hash files
+    pending_part_ids = [
+        i for i in part_ids if not exists(get_hash_path(i, args.large))
+    ]
+    print("Resuming with", len(pending_part_ids), "parts left")
+
+    image_count, read_seconds, decode_seconds, hash_seconds = 0, 0.0, 0.0, 0.0
+    hash_start_time = time.time()
+
+    with Pool(N_PROC) as p:
+        for cur_count, cur_read_seconds, cur_decode_seconds, cur_hash_seconds in tqdm(
+            p.imap_unordered(
+                hash_one_part, [(i, args.large) for i in pending_part_ids]
+            ),
+            total=len(pending_part_ids),
+        ):
+            image_count += cur_count
+            read_seconds += cur_read_seconds
+            decode_seconds += cur_decode_seconds
+            hash_seconds += cur_hash_seconds
+
+    elapsed_seconds = time.time() - hash_start_time
+    image_format = "WebP" if args.large else "PNG"
+    print(
+        f"Hashed {image_count} {image_format} images in {elapsed_seconds:.1f} "
+        f"seconds, {image_count / max(elapsed_seconds, 1e-6):.1f} images/sec "
+        f"with {N_PROC} processes"
+    )
+    print(
+        f"Per process: read {image_count / max(read_seconds, 1e-6):.1f} "
+        f"images/sec, decode + resize "
+        f"{image_count / max(decode_seconds, 1e-6):.1f} images/sec, "
+        f"batched hashing {image_count / max(hash_seconds, 1e-6):.1f} images/sec"
+    )
+
+    print("Saved", merge_hashes(args.large))
+    print("Finished in", (time.time() - start_time) / 60, "minutes")
+
+
+if __name__ == "__main__":
+    main()
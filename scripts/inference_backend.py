@@ -0,0 +1,131 @@
+"""Run model inference on multiple CPU worker processes with pinned threads."""
+
+from multiprocessing import Pool, Value
+
+import os
+import sys
+
+# Environment variables that size the thread pools of math libraries
+_THREAD_ENV_VARS = [
+    "OMP_NUM_THREADS",
+    "MKL_NUM_THREADS",
+    "OPENBLAS_NUM_THREADS",
+    "TF_NUM_INTRAOP_THREADS",
+]
+
+# The model loaded in each worker process
+_worker_model = None
+
+
+def get_cpu_cores():
+    """
+    Get the CPU cores this process can run on.
+    """
+    if hasattr(os, "sched_getaffinity"):
+        return sorted(os.sched_getaffinity(0))
+
+    return list(range(os.cpu_count()))
+
+
+def get_cpu_worker_count(threads_per_worker):
+    """
+    Get the number of workers that fit on the available cores without
+    oversubscription.
+    """
+    return max(1, len(get_cpu_cores()) // threads_per_worker)
+
+
+def pin_worker_threads(worker_id, threads_per_worker):
+    """Limit the math library thread pools of this process to
+    threads_per_worker and bind it to its own cores. Call it before the worker
+    imports torch or tensorflow.
+
+    Args:
+        worker_id (int): Index of the worker
+        threads_per_worker (int): Number of threads (and cores) of each worker
+    """
+    for name in _THREAD_ENV_VARS:
+        os.environ[name] = str(threads_per_worker)
+
+    # Inter-op parallelism would use threads outside the worker's budget
+    os.environ["TF_NUM_INTEROP_THREADS"] = "1"
+
+    cores = get_cpu_cores()
+    start = (worker_id * threads_per_worker) % len(cores)
+    worker_cores = cores[start : start + threads_per_worker]
+
+    if hasattr(os, "sched_setaffinity") and len(worker_cores) > 0:
+        os.sched_setaffinity(0, worker_cores)
+
+    # Environment variables are only read when torch starts
+    if "torch" in sys.modules:
+        sys.modules["torch"].set_num_threads(threads_per_worker)
+
+
+def _init_worker(worker_counter, threads_per_worker, load_model, load_model_args):
+    """
+    Pool initializer: pin the threads of this worker and load its model.
+    """
+    global _worker_model
+
+    with worker_counter.get_lock():
+        worker_id = worker_counter.value
+        worker_counter.value += 1
+
+    pin_worker_threads(worker_id, threads_per_worker)
+    _worker_model = load_model(*load_model_args)
+
+
+def _predict_on_worker(batch):
+    """
+    Run the worker's model on one batch.
+    """
+    return _worker_model.predict(batch)
+
+
+def start_cpu_pool(n_workers, threads_per_worker, load_model, load_model_args=()):
+    """Start CPU worker processes that each load their own model.
+
+    Args:
+        n_workers (int): Number of worker processes
+        threads_per_worker (int): Number of threads (and cores) of each worker
+        load_model (function): Module-level function that returns a model with
+            a predict(batch) method. It runs in the worker after the threads
+            are pinned.
+        load_model_args (tuple): Arguments of load_model
+
+    Returns:
+        Pool: The worker pool
+    """
+    return Pool(
+        n_workers,
+        initializer=_init_worker,
+        initargs=(Value("i", 0), threads_per_worker, load_model, load_model_args),
+    )
+
+
+def predict_batches(pool, batches):
+    """Predict batches on the worker pool.
+
+    Args:
+        pool (Pool): Pool from start_cpu_pool()
+        batches ([list]): Model inputs of each batch
+
+    Returns:
+        [dict]: Model outputs of each batch, in the same order
+    """
+    return pool.map(_predict_on_worker, batches, chunksize=1)
+
+
+def print_throughput(config_name, item_count, seconds):
+    """Print the throughput of an inference configuration.
+
+    Args:
+        config_name (string): Description of the configuration
+        item_count (int): Number of processed items
+        seconds (float): Elapsed seconds
+    """
+    print(
+        f"[{config_name}] {item_count} items in {seconds:.1f} seconds, "
+        f"{item_count / max(seconds, 1e-6):.1f} items/sec"
+    )
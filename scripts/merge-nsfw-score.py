@@ -0,0 +1,85 @@
+from glob import glob
+from os.path import join, basename
+from tqdm import tqdm
+from multiprocessing import Pool
+
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+LARGE_MODE = True
+N_PROC = 36
+
+SHARE_DIR = "/project/zwang3049/diffusiondb-hugging"
+
+if LARGE_MODE:
+    NSFW_SCORE_DIR = "/nvmescratch/jay/diffusiondb/nsfw-scores-large"
+    METADATA_PATH = join(SHARE_DIR, "metadata-large.parquet")
+    OUTPUT_PATH = "/nvmescratch/jay/diffusiondb/nsfw-scores-large.parquet"
+else:
+    NSFW_SCORE_DIR = "/nvmescratch/jay/diffusiondb/nsfw-scores-2m"
+    METADATA_PATH = join(SHARE_DIR, "metadata.parquet")
+    OUTPUT_PATH = "/nvmescratch/jay/diffusiondb/nsfw-scores-2m.parquet"
+
+
+def load_one_part(score_path):
+    """Load the NSFW scores of one part.
+
+    Args:
+        score_path (string): Path to a part-XXXXXX.npz file
+
+    Returns:
+        DataFrame: Scores with columns image_name, part_id, and image_nsfw
+    """
+    part_id = int(re.sub(r"part-(\d+)\.npz", r"\1", basename(score_path)))
+    scores = np.load(score_path)
+
+    return pd.DataFrame(
+        {
+            "image_name": scores["images_name"],
+            "part_id": np.full(len(scores["images_name"]), part_id, dtype=np.uint16),
+            "image_nsfw": scores["images_nsfw"].astype(np.float32),
+        }
+    )
+
+
+def main():
+    """
+    Main function
+    """
+    start_time = time.time()
+    score_paths = sorted(glob(join(NSFW_SCORE_DIR, "part-*.npz")))
+
+    # Load score files in parallel
+    with Pool(N_PROC) as p:
+        score_dfs = list(
+            tqdm(
+                p.imap(load_one_part, score_paths, chunksize=16),
+                total=len(score_paths),
+            )
+        )
+
+    score_df = pd.concat(score_dfs, ignore_index=True)
+    del score_dfs
+    print("Loaded", len(score_df), "scores from", len(score_paths), "parts")
+
+    # Sort the scores to match the metadata table with one vectorized join, so
+    # the image_nsfw column can be copied into the metadata table directly
+    metadata_df = pd.read_parquet(METADATA_PATH, columns=["image_name", "part_id"])
+    score_df = metadata_df.merge(
+        score_df.drop(columns=["part_id"]), on="image_name", how="left"
+    )
+
+    missing_count = score_df["image_nsfw"].isnull().sum()
+    if missing_count > 0:
+        print("Missing NSFW scores for", missing_count, "images")
+
+    score_df.to_parquet(OUTPUT_PATH, index=False)
+
+    print("Finished in", (time.time() - start_time) / 60, "minutes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""Length-bucketed dynamic batching for prompt models."""
+
+# Max number of padded tokens in one batch (batch size x longest prompt)
+MAX_TOKENS = 16384
+
+
+def get_token_lengths(prompts, tokenizer=None):
+    """Get the number of tokens of each prompt.
+
+    Args:
+        prompts ([string]): Prompts
+        tokenizer (PreTrainedTokenizer): Hugging Face tokenizer of the model. If
+            it is None, the length is estimated from the number of characters.
+
+    Returns:
+        [int]: Number of tokens of each prompt
+    """
+    if tokenizer is None:
+        # About four characters per token for English prompts, plus the
+        # special tokens
+        return [len(p) // 4 + 2 for p in prompts]
+
+    input_ids = tokenizer(list(prompts), truncation=True)["input_ids"]
+    return [len(ids) for ids in input_ids]
+
+
+def get_token_budget_batches(lengths, max_tokens=MAX_TOKENS, max_batch_size=None):
+    """Group items into batches of similar lengths. Items are sorted by length,
+    and a batch is closed when padding all its items to the longest one would
+    exceed max_tokens. Short prompts get large batches and long prompts get
+    small batches.
+
+    Args:
+        lengths ([int]): Number of tokens of each item
+        max_tokens (int): Max number of padded tokens in one batch
+        max_batch_size (int): Max number of items in one batch (optional)
+
+    Returns:
+        [[int]]: Item indexes of each batch
+    """
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    batches = []
+    cur_batch = []
+
+    for i in order:
+        # Items are sorted, so the current item is the longest in the batch
+        if len(cur_batch) > 0 and (
+            lengths[i] * (len(cur_batch) + 1) > max_tokens
+            or (max_batch_size is not None and len(cur_batch) >= max_batch_size)
+        ):
+            batches.append(cur_batch)
+            cur_batch = []
+
+        cur_batch.append(i)
+
+    if len(cur_batch) > 0:
+        batches.append(cur_batch)
+
+    return batches
+
+
+def get_fixed_size_batches(count, batch_size):
+    """Split items into batches of batch_size in their original order.
+
+    Args:
+        count (int): Number of items
+        batch_size (int): Number of items per batch
+
+    Returns:
+        [[int]]: Item indexes of each batch
+    """
+    return [
+        list(range(lower, min(lower + batch_size, count)))
+        for lower in range(0, count, batch_size)
+    ]
+
+
+def get_padded_token_count(lengths, batches):
+    """Count the tokens a model processes after padding each batch to its
+    longest item.
+
+    Args:
+        lengths ([int]): Number of tokens of each item
+        batches ([[int]]): Item indexes of each batch
+
+    Returns:
+        int: Number of padded tokens
+    """
+    return sum([max([lengths[i] for i in b]) * len(b) for b in batches])
@@ -0,0 +1,14 @@
+"""Stable 64-bit prompt hashes shared by the prompt caches and stores."""
+
+from hashlib import blake2b
+
+
+def hash_string(string):
+    """
+    Hash a string into an unsigned 64-bit integer. Unlike hash(), it is the
+    same in every process and run, so hashes can be saved and compared across
+    scripts.
+    """
+    return int.from_bytes(
+        blake2b(string.encode("utf8"), digest_size=8).digest(), "little"
+    )
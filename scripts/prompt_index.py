@@ -0,0 +1,502 @@
+"""On-disk inverted index over prompts with boolean and phrase queries."""
+
+from json import load, dump
+from os.path import join
+from multiprocessing import Pool
+
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+# Number of prompts each indexing task tokenizes
+TOKENIZE_CHUNK_SIZE = 100000
+
+# Query operators
+OPERATORS = {"AND", "OR", "NOT", "(", ")"}
+
+# Codes of the sampler column in metadata.parquet (see the README)
+SAMPLER_CODES = {
+    "ddim": 1,
+    "plms": 2,
+    "k_euler": 3,
+    "k_euler_ancestral": 4,
+    "k_heun": 5,
+    "k_dpm_2": 6,
+    "k_dpm_2_ancestral": 7,
+    "k_lms": 8,
+    "others": 9,
+}
+
+# Value of timestamp.npy for rows without a timestamp, they never pass a time
+# filter
+MISSING_TIMESTAMP = np.iinfo(np.int64).min
+
+# Positional postings store prompt_id << POSITION_BITS | token position, so
+# phrases can only match within the first 2^POSITION_BITS tokens of a prompt
+POSITION_BITS = 12
+
+
+def tokenize(text):
+    """
+    Split a text into lowercase word tokens. Prompts and queries use the same
+    tokenizer, so phrases match token by token.
+    """
+    return re.findall(r"\w+", text.lower())
+
+
+def encode_varints(values):
+    """Encode unsigned integers as LEB128 varints (7 bits per byte, the high
+    bit is set on all bytes but the last).
+
+    Args:
+        values (np.ndarray): Unsigned integers below 2^42
+
+    Returns:
+        (np.ndarray, np.ndarray): uint8 bytes and the byte count of each value
+    """
+    values = values.astype(np.uint64)
+    byte_counts = np.ones(len(values), dtype=np.int64)
+    for shift in [7, 14, 21, 28, 35]:
+        byte_counts += values >= (1 << shift)
+
+    # Byte j of a value holds its bits 7j to 7j + 6
+    value_indexes = np.repeat(np.arange(len(values)), byte_counts)
+    starts = np.cumsum(byte_counts) - byte_counts
+    byte_positions = np.arange(len(value_indexes)) - np.repeat(starts, byte_counts)
+
+    data = (values[value_indexes] >> (7 * byte_positions).astype(np.uint64)) & 127
+    is_last = byte_positions == byte_counts[value_indexes] - 1
+    data = data | np.where(is_last, 0, 128).astype(np.uint64)
+    return data.astype(np.uint8), byte_counts
+
+
+def decode_varints(data):
+    """Decode LEB128 varints.
+
+    Args:
+        data (np.ndarray): uint8 bytes from encode_varints()
+
+    Returns:
+        np.ndarray: int64 values
+    """
+    data = np.asarray(data, dtype=np.uint8)
+    if len(data) == 0:
+        # Tokens that only appear past the positional limit have no positions
+        return np.zeros(0, dtype=np.int64)
+
+    is_last = data < 128
+    value_indexes = np.concatenate([[0], np.cumsum(is_last)[:-1]])
+    starts = np.concatenate([[0], np.where(is_last)[0][:-1] + 1])
+    byte_positions = np.arange(len(data)) - starts[value_indexes]
+
+    parts = (data & 127).astype(np.int64) << (7 * byte_positions)
+    return np.bincount(value_indexes, weights=parts, minlength=is_last.sum()).astype(
+        np.int64
+    )
+
+
+def _tokenize_chunk(chunk):
+    """Pool worker: get the (token, prompt id, position) of every token
+    occurrence in a chunk.
+
+    Args:
+        chunk ((int, [string])): Id of the first prompt and the prompts
+
+    Returns:
+        ([string], np.ndarray, np.ndarray, np.ndarray): Local vocabulary, and
+            the local token code, prompt id, and position of each occurrence
+    """
+    first_prompt_id, prompts = chunk
+    vocab = {}
+    token_codes = []
+    prompt_ids = []
+    positions = []
+
+    for prompt_i, prompt in enumerate(prompts):
+        for position, token in enumerate(tokenize(prompt)):
+            token_codes.append(vocab.setdefault(token, len(vocab)))
+            prompt_ids.append(first_prompt_id + prompt_i)
+            positions.append(position)
+
+    return (
+        list(vocab.keys()),
+        np.array(token_codes, dtype=np.int32),
+        np.array(prompt_ids, dtype=np.int64),
+        np.array(positions, dtype=np.int64),
+    )
+
+
+def write_postings(path, token_codes, values):
+    """Write delta + varint encoded posting lists: the first value of each
+    list, then the gaps between values.
+
+    Args:
+        path (string): Output file path
+        token_codes (np.ndarray): Sorted token code of each value
+        values (np.ndarray): Values, sorted within each token
+
+    Returns:
+        (np.ndarray, np.ndarray, np.ndarray, np.ndarray): Token code, byte
+            offset, byte length, and value count of each list
+    """
+    is_list_start = np.r_[True, token_codes[1:] != token_codes[:-1]]
+    deltas = np.where(is_list_start, values, np.diff(values, prepend=0))
+    data, byte_counts = encode_varints(deltas)
+    data.tofile(path)
+
+    list_starts = np.where(is_list_start)[0]
+    list_counts = np.diff(np.r_[list_starts, len(token_codes)])
+    value_offsets = np.r_[0, np.cumsum(byte_counts)]
+    byte_offsets = value_offsets[list_starts]
+    byte_lengths = value_offsets[list_starts + list_counts] - byte_offsets
+
+    return token_codes[list_starts], byte_offsets, byte_lengths, list_counts
+
+
+def build_prompt_index(metadata_path, index_dir, n_proc=1):
+    """Build the index of a metadata table in index_dir:
+
+    - postings.bin and vocab.parquet: delta + varint encoded sorted prompt ids
+      of each token, and the token's byte offset, byte length, and count
+    - positions.bin: delta + varint encoded sorted positional keys
+      (prompt_id << POSITION_BITS | position) of each token, with the byte
+      offset and length in vocab.parquet
+    - prompts.bin and prompt-offsets.npy: text of each unique prompt
+    - prompt-rows.npy and prompt-row-offsets.npy: metadata rows of each prompt
+    - image_nsfw.npy, timestamp.npy (seconds, MISSING_TIMESTAMP if missing),
+      sampler.npy (SAMPLER_CODES, 0 if missing): filter columns of each row
+
+    Args:
+        metadata_path (string): Path to the metadata parquet file
+        index_dir (string): Output directory
+        n_proc (int): Number of processes to tokenize prompts in parallel
+
+    Returns:
+        dict: Index meta data
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    metadata_df = pd.read_parquet(
+        metadata_path, columns=["prompt", "image_nsfw", "timestamp", "sampler"]
+    )
+
+    # Index unique prompts, and map them back to rows
+    prompt_codes, prompts = pd.factorize(metadata_df["prompt"].fillna(""))
+    row_order = np.argsort(prompt_codes, kind="stable")
+    row_offsets = np.zeros(len(prompts) + 1, dtype=np.int64)
+    row_offsets[1:] = np.cumsum(np.bincount(prompt_codes, minlength=len(prompts)))
+    np.save(join(index_dir, "prompt-rows.npy"), row_order.astype(np.uint32))
+    np.save(join(index_dir, "prompt-row-offsets.npy"), row_offsets)
+
+    encoded_prompts = [p.encode("utf8") for p in prompts]
+    prompt_offsets = np.zeros(len(prompts) + 1, dtype=np.int64)
+    prompt_offsets[1:] = np.cumsum([len(p) for p in encoded_prompts])
+    with open(join(index_dir, "prompts.bin"), "wb") as fp:
+        fp.write(b"".join(encoded_prompts))
+    np.save(join(index_dir, "prompt-offsets.npy"), prompt_offsets)
+
+    # Filter columns
+    np.save(
+        join(index_dir, "image_nsfw.npy"),
+        metadata_df["image_nsfw"].to_numpy(dtype=np.float32),
+    )
+    timestamps = pd.to_datetime(metadata_df["timestamp"], utc=True)
+    has_timestamp = timestamps.notna().to_numpy()
+    seconds = np.full(len(timestamps), MISSING_TIMESTAMP, dtype=np.int64)
+    seconds[has_timestamp] = (
+        timestamps[has_timestamp] - pd.Timestamp(0, tz="UTC")
+    ) // pd.Timedelta(seconds=1)
+    np.save(join(index_dir, "timestamp.npy"), seconds)
+    np.save(
+        join(index_dir, "sampler.npy"),
+        metadata_df["sampler"].fillna(0).to_numpy(dtype=np.uint8),
+    )
+
+    # Tokenize chunks of prompts in parallel
+    chunks = [
+        (lower, list(prompts[lower : lower + TOKENIZE_CHUNK_SIZE]))
+        for lower in range(0, len(prompts), TOKENIZE_CHUNK_SIZE)
+    ]
+    with Pool(n_proc) as p:
+        chunk_results = p.map(_tokenize_chunk, chunks)
+
+    # Merge the local vocabularies
+    vocab = {}
+    all_token_codes, all_prompt_ids, all_positions = [], [], []
+    for local_vocab, token_codes, prompt_ids, positions in chunk_results:
+        code_map = np.array(
+            [vocab.setdefault(t, len(vocab)) for t in local_vocab], dtype=np.int32
+        )
+        all_token_codes.append(code_map[token_codes])
+        all_prompt_ids.append(prompt_ids)
+        all_positions.append(positions)
+
+    token_codes = np.concatenate(all_token_codes)
+    prompt_ids = np.concatenate(all_prompt_ids)
+    positions = np.concatenate(all_positions)
+    order = np.lexsort((positions, prompt_ids, token_codes))
+    token_codes, prompt_ids = token_codes[order], prompt_ids[order]
+    positions = positions[order]
+
+    # Positional postings, every occurrence is already sorted by its key
+    is_indexed = positions < (1 << POSITION_BITS)
+    position_codes, position_offsets, position_lengths, _ = write_postings(
+        join(index_dir, "positions.bin"),
+        token_codes[is_indexed],
+        (prompt_ids[is_indexed] << POSITION_BITS) | positions[is_indexed],
+    )
+
+    # Prompt postings keep one occurrence of each (token, prompt) pair
+    is_first = np.r_[
+        True,
+        (token_codes[1:] != token_codes[:-1]) | (prompt_ids[1:] != prompt_ids[:-1]),
+    ]
+    list_codes, byte_offsets, byte_lengths, list_counts = write_postings(
+        join(index_dir, "postings.bin"), token_codes[is_first], prompt_ids[is_first]
+    )
+
+    # A token that only appears past the positional limit has no positions
+    position_df = pd.DataFrame(
+        {
+            "code": position_codes,
+            "positions_offset": position_offsets,
+            "positions_length": position_lengths,
+        }
+    )
+    tokens = np.array(list(vocab.keys()), dtype=object)
+    vocab_df = pd.DataFrame(
+        {
+            "code": list_codes,
+            "token": tokens[list_codes],
+            "offset": byte_offsets,
+            "length": byte_lengths,
+            "count": list_counts,
+        }
+    ).merge(position_df, on="code", how="left")
+    vocab_df[["positions_offset", "positions_length"]] = (
+        vocab_df[["positions_offset", "positions_length"]].fillna(0).astype(np.int64)
+    )
+    vocab_df.drop(columns="code").to_parquet(
+        join(index_dir, "vocab.parquet"), index=False
+    )
+
+    meta = {
+        "prompt_count": len(prompts),
+        "row_count": len(metadata_df),
+        "token_count": len(list_codes),
+        "samplers": SAMPLER_CODES,
+    }
+    dump(meta, open(join(index_dir, "meta.json"), "w", encoding="utf8"))
+    return meta
+
+
+class PromptIndex:
+    """Query an index from build_prompt_index(). Arrays are memory-mapped, so
+    opening it is fast and queries only read what they need."""
+
+    def __init__(self, index_dir):
+        self.meta = load(open(join(index_dir, "meta.json"), "r", encoding="utf8"))
+
+        vocab_df = pd.read_parquet(join(index_dir, "vocab.parquet"))
+        self.vocab = dict(
+            zip(
+                vocab_df["token"],
+                zip(
+                    vocab_df["offset"].to_numpy(),
+                    vocab_df["length"].to_numpy(),
+                    vocab_df["positions_offset"].to_numpy(),
+                    vocab_df["positions_length"].to_numpy(),
+                ),
+            )
+        )
+
+        def load_array(name):
+            return np.load(join(index_dir, name), mmap_mode="r")
+
+        self.postings = np.memmap(join(index_dir, "postings.bin"), mode="r")
+        self.positions = np.memmap(join(index_dir, "positions.bin"), mode="r")
+        self.prompt_text = np.memmap(join(index_dir, "prompts.bin"), mode="r")
+        self.prompt_offsets = load_array("prompt-offsets.npy")
+        self.prompt_rows = load_array("prompt-rows.npy")
+        self.prompt_row_offsets = load_array("prompt-row-offsets.npy")
+        self.columns = {
+            name: load_array(f"{name}.npy")
+            for name in ["image_nsfw", "timestamp", "sampler"]
+        }
+
+    def get_prompt(self, prompt_id):
+        start, end = self.prompt_offsets[prompt_id], self.prompt_offsets[prompt_id + 1]
+        return self.prompt_text[start:end].tobytes().decode("utf8")
+
+    def get_postings(self, token):
+        """
+        Get the sorted prompt ids of a token.
+        """
+        if token not in self.vocab:
+            return np.zeros(0, dtype=np.int64)
+
+        offset, length = self.vocab[token][:2]
+        return np.cumsum(decode_varints(self.postings[offset : offset + length]))
+
+    def get_position_keys(self, token):
+        """
+        Get the sorted positional keys (prompt_id << POSITION_BITS | position)
+        of a token.
+        """
+        if token not in self.vocab:
+            return np.zeros(0, dtype=np.int64)
+
+        offset, length = self.vocab[token][2:]
+        return np.cumsum(decode_varints(self.positions[offset : offset + length]))
+
+    def get_phrase_postings(self, phrase_tokens):
+        """Get the sorted prompt ids of a phrase. Token i of the phrase must be
+        at position p + i of a prompt, so the positional keys of token i
+        shifted back by i are intersected, rarest token first.
+
+        Args:
+            phrase_tokens ([string]): Tokens of the phrase
+
+        Returns:
+            np.ndarray: Prompt ids
+        """
+        if len(phrase_tokens) == 1:
+            return self.get_postings(phrase_tokens[0])
+
+        # Token i at position p < i can not be in the phrase, drop it so the
+        # shifted key does not borrow from the prompt id
+        shifted_keys = []
+        for i, token in enumerate(phrase_tokens):
+            keys = self.get_position_keys(token)
+            keys = keys[(keys & ((1 << POSITION_BITS) - 1)) >= i] - i
+            shifted_keys.append(keys)
+        shifted_keys.sort(key=len)
+
+        keys = shifted_keys[0]
+        for token_keys in shifted_keys[1:]:
+            keys = np.intersect1d(keys, token_keys, assume_unique=True)
+
+        return np.unique(keys >> POSITION_BITS)
+
+    def parse_query(self, query):
+        """Evaluate a boolean query on prompts. Words and "quoted phrases" can
+        be combined with AND (or a space), OR, NOT, and parentheses, for
+        example: "greg rutkowski" artstation NOT (anime OR manga).
+
+        Args:
+            query (string): Query
+
+        Returns:
+            np.ndarray: Sorted prompt ids
+        """
+        terms = re.findall(r'"[^"]*"|\(|\)|[^\s()"]+', query)
+        position = 0
+
+        def peek():
+            return terms[position] if position < len(terms) else None
+
+        def parse_or():
+            nonlocal position
+            prompt_ids = parse_and()
+            while peek() == "OR":
+                position += 1
+                prompt_ids = np.union1d(prompt_ids, parse_and())
+            return prompt_ids
+
+        def parse_and():
+            nonlocal position
+            prompt_ids = parse_not()
+            while peek() is not None and peek() not in {"OR", ")"}:
+                if peek() == "AND":
+                    position += 1
+                prompt_ids = np.intersect1d(prompt_ids, parse_not(), assume_unique=True)
+            return prompt_ids
+
+        def parse_not():
+            nonlocal position
+            if peek() == "NOT":
+                position += 1
+                all_ids = np.arange(self.meta["prompt_count"])
+                return np.setdiff1d(all_ids, parse_not(), assume_unique=True)
+            return parse_term()
+
+        def parse_term():
+            nonlocal position
+            term = peek()
+            if term is None or term in OPERATORS - {"("}:
+                raise ValueError(f"Unexpected {term} in query: {query}")
+
+            position += 1
+            if term == "(":
+                prompt_ids = parse_or()
+                if peek() != ")":
+                    raise ValueError(f"Missing ) in query: {query}")
+                position += 1
+                return prompt_ids
+
+            # Words with punctuation, like full-hd, are phrases too
+            phrase_tokens = tokenize(term.strip('"'))
+            if len(phrase_tokens) == 0:
+                raise ValueError(f"Empty term in query: {query}")
+            return self.get_phrase_postings(phrase_tokens)
+
+        prompt_ids = parse_or()
+        if peek() is not None:
+            raise ValueError(f"Unexpected {peek()} in query: {query}")
+        return prompt_ids
+
+    def search(
+        self,
+        query,
+        nsfw_range=None,
+        time_range=None,
+        samplers=None,
+    ):
+        """Search metadata rows whose prompt matches a query and whose columns
+        pass the filters.
+
+        Args:
+            query (string): Boolean query, see parse_query()
+            nsfw_range ((float, float)): Inclusive image_nsfw range (optional)
+            time_range ((pd.Timestamp, pd.Timestamp)): Inclusive UTC timestamp
+                range, rows without a timestamp are excluded (optional)
+            samplers ([string]): Allowed sampler names of SAMPLER_CODES
+                (optional)
+
+        Returns:
+            np.ndarray: Sorted metadata row ids
+        """
+        prompt_ids = self.parse_query(query)
+
+        # Expand prompts to their rows
+        starts = self.prompt_row_offsets[prompt_ids]
+        counts = self.prompt_row_offsets[prompt_ids + 1] - starts
+        positions = np.repeat(starts - np.cumsum(counts) + counts, counts) + np.arange(
+            counts.sum()
+        )
+        rows = np.sort(np.asarray(self.prompt_rows[positions], dtype=np.int64))
+
+        is_kept = np.ones(len(rows), dtype=bool)
+        if nsfw_range is not None:
+            image_nsfw = self.columns["image_nsfw"][rows]
+            is_kept &= (image_nsfw >= nsfw_range[0]) & (image_nsfw <= nsfw_range[1])
+
+        if time_range is not None:
+            timestamps = self.columns["timestamp"][rows]
+            start, end = [pd.Timestamp(t).timestamp() for t in time_range]
+            is_kept &= timestamps != MISSING_TIMESTAMP
+            is_kept &= (timestamps >= start) & (timestamps <= end)
+
+        if samplers is not None:
+            unknown_samplers = set(samplers) - set(self.meta["samplers"])
+            if len(unknown_samplers) > 0:
+                raise ValueError(
+                    f"Unknown samplers {sorted(unknown_samplers)}, use "
+                    f"{list(self.meta['samplers'])}"
+                )
+
+            sampler_codes = [self.meta["samplers"][s] for s in samplers]
+            is_kept &= np.isin(self.columns["sampler"][rows], sampler_codes)
+
+        return rows[is_kept]
@@ -0,0 +1,332 @@
+"""Approximate nearest-neighbor prompt search over the embedding store."""
+
+from json import loads
+from os.path import join
+from threading import Lock
+
+import numpy as np
+import pandas as pd
+
+from embedding_store import open_store, load_embedding_model
+from prompt_hash import hash_string
+
+# Number of inverted lists is about this many times the square root of the
+# number of vectors
+LIST_COUNT_FACTOR = 4
+
+# Number of k-means training vectors per list
+TRAIN_VECTORS_PER_LIST = 64
+
+# Number of k-means iterations
+KMEANS_ITERATIONS = 10
+
+# Number of lists a query scans by default
+N_PROBE = 32
+
+# Rebuild the index when the store has grown this many times since the index
+# was built, because the old centroids no longer fit the new vectors
+REBUILD_GROWTH = 2
+
+# Number of vectors scored at a time, to bound the memory of the score matrix
+SCORE_CHUNK_SIZE = 16384
+
+
+def get_top_k(scores, k):
+    """
+    Get the indexes of the k highest scores, from the highest.
+    """
+    k = min(k, len(scores))
+    top_indexes = np.argpartition(-scores, k - 1)[:k]
+    return top_indexes[np.argsort(-scores[top_indexes])]
+
+
+def assign_lists(vectors, centroids):
+    """Assign each vector to the centroid with the highest inner product.
+
+    Args:
+        vectors (np.ndarray): Vectors with shape (n, dim)
+        centroids (np.ndarray): float32 centroids with shape (n_lists, dim)
+
+    Returns:
+        np.ndarray: List id of each vector
+    """
+    list_ids = np.zeros(len(vectors), dtype=np.int32)
+
+    for lower in range(0, len(vectors), SCORE_CHUNK_SIZE):
+        chunk = np.asarray(vectors[lower : lower + SCORE_CHUNK_SIZE], np.float32)
+        list_ids[lower : lower + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+
+    return list_ids
+
+
+def train_centroids(vectors, n_lists, seed=0):
+    """Train spherical k-means centroids on a sample of normalized vectors.
+
+    Args:
+        vectors (np.ndarray): Vectors with shape (n, dim)
+        n_lists (int): Number of centroids
+        seed (int): Random seed
+
+    Returns:
+        np.ndarray: float32 centroids with shape (n_lists, dim)
+    """
+    rng = np.random.default_rng(seed)
+    sample_size = min(len(vectors), n_lists * TRAIN_VECTORS_PER_LIST)
+    sample_rows = np.sort(rng.choice(len(vectors), sample_size, replace=False))
+    sample = np.asarray(vectors[sample_rows], dtype=np.float32)
+
+    centroids = sample[rng.choice(sample_size, n_lists, replace=False)]
+
+    for _ in range(KMEANS_ITERATIONS):
+        list_ids = assign_lists(sample, centroids)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, list_ids, sample)
+
+        # Keep the old centroid of an empty list
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        centroids = np.where(norms > 0, sums / np.maximum(norms, 1e-12), centroids)
+
+    return centroids.astype(np.float32)
+
+
+class IVFIndex:
+    """Inverted file index: vectors are grouped by their nearest centroid, and
+    a query only scores the vectors of its n_probe nearest lists. Scores are
+    inner products, which are cosine similarities for normalized vectors."""
+
+    def __init__(self, centroids, list_offsets, list_rows):
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+
+    @property
+    def vector_count(self):
+        """
+        Number of indexed vectors, which are the first rows of the store.
+        """
+        return len(self.list_rows)
+
+    @classmethod
+    def build(cls, vectors, n_lists=None):
+        """Build the index of vectors.
+
+        Args:
+            vectors (np.ndarray): Normalized vectors with shape (n, dim)
+            n_lists (int): Number of inverted lists (optional)
+
+        Returns:
+            IVFIndex: The index
+        """
+        if n_lists is None:
+            n_lists = int(LIST_COUNT_FACTOR * np.sqrt(len(vectors)))
+        n_lists = max(1, min(n_lists, len(vectors)))
+
+        centroids = train_centroids(vectors, n_lists)
+        list_ids = assign_lists(vectors, centroids)
+
+        # Rows of list i are list_rows[list_offsets[i]:list_offsets[i + 1]]
+        list_rows = np.argsort(list_ids, kind="stable").astype(np.int64)
+        list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        list_offsets[1:] = np.cumsum(np.bincount(list_ids, minlength=n_lists))
+
+        return cls(centroids, list_offsets, list_rows)
+
+    def add(self, vectors):
+        """Assign the vectors appended after the indexed ones to their nearest
+        lists. The centroids are not changed.
+
+        Args:
+            vectors (np.ndarray): All vectors with shape (n, dim), the first
+                vector_count of them are already indexed
+        """
+        n_lists = len(self.centroids)
+        start = self.vector_count
+
+        list_ids = np.concatenate(
+            [
+                np.repeat(np.arange(n_lists), np.diff(self.list_offsets)),
+                assign_lists(vectors[start:], self.centroids),
+            ]
+        )
+        rows = np.concatenate(
+            [self.list_rows, np.arange(start, len(vectors), dtype=np.int64)]
+        )
+
+        self.list_rows = rows[np.argsort(list_ids, kind="stable")]
+        self.list_offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        self.list_offsets[1:] = np.cumsum(np.bincount(list_ids, minlength=n_lists))
+
+    def save(self, path):
+        np.savez(
+            path,
+            centroids=self.centroids,
+            list_offsets=self.list_offsets,
+            list_rows=self.list_rows,
+            vector_count=self.vector_count,
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        index = cls(data["centroids"], data["list_offsets"], data["list_rows"])
+
+        if "vector_count" in data and data["vector_count"] != index.vector_count:
+            raise ValueError(f"{path} is corrupted, its lists miss some rows")
+        return index
+
+    def search(self, vectors, query, k=10, n_probe=N_PROBE):
+        """Search the k nearest vectors of a query.
+
+        Args:
+            vectors (np.ndarray): The indexed vectors (can be a memmap)
+            query (np.ndarray): Query vector with shape (dim,)
+            k (int): Number of results
+            n_probe (int): Number of lists to scan
+
+        Returns:
+            (np.ndarray, np.ndarray): Rows and scores of the results
+        """
+        if k < 1 or n_probe < 1:
+            raise ValueError("k and n_probe must be at least 1")
+
+        query = np.asarray(query, dtype=np.float32)
+        probe_lists = get_top_k(self.centroids @ query, n_probe)
+        candidate_rows = np.concatenate(
+            [
+                self.list_rows[self.list_offsets[i] : self.list_offsets[i + 1]]
+                for i in probe_lists
+            ]
+        )
+
+        # Sorted rows make the memmap reads sequential
+        candidate_rows.sort()
+        scores = np.asarray(vectors[candidate_rows], dtype=np.float32) @ query
+        top_indexes = get_top_k(scores, k)
+        return candidate_rows[top_indexes], scores[top_indexes]
+
+
+def brute_force_search(vectors, query, k=10):
+    """Search the k nearest vectors of a query by scoring every vector.
+
+    Args:
+        vectors (np.ndarray): Vectors with shape (n, dim)
+        query (np.ndarray): Query vector with shape (dim,)
+        k (int): Number of results
+
+    Returns:
+        (np.ndarray, np.ndarray): Rows and scores of the results
+    """
+    query = np.asarray(query, dtype=np.float32)
+    scores = np.zeros(len(vectors), dtype=np.float32)
+
+    for lower in range(0, len(vectors), SCORE_CHUNK_SIZE * 16):
+        chunk = vectors[lower : lower + SCORE_CHUNK_SIZE * 16]
+        scores[lower : lower + len(chunk)] = np.asarray(chunk, np.float32) @ query
+
+    top_rows = get_top_k(scores, k)
+    return top_rows, scores[top_rows]
+
+
+def load_index(index_path, vectors):
+    """Load the index of the store vectors, or build it if it is missing. An
+    index built before more vectors were appended gets the new vectors
+    assigned to its lists, or is rebuilt if the store has grown too much.
+
+    Args:
+        index_path (string): Path to the index npz file
+        vectors (np.ndarray): All committed vectors of the store
+
+    Returns:
+        IVFIndex: The index covering every vector
+    """
+    try:
+        index = IVFIndex.load(index_path)
+    except FileNotFoundError:
+        index = None
+
+    if index is not None and index.vector_count == len(vectors):
+        return index
+
+    # The store is append-only, so a smaller count means a different store
+    if (
+        index is None
+        or index.vector_count > len(vectors)
+        or len(vectors) > REBUILD_GROWTH * index.vector_count
+    ):
+        index = IVFIndex.build(vectors)
+    else:
+        index.add(vectors)
+
+    index.save(index_path)
+    return index
+
+
+class PromptSearch:
+    """Search prompts similar to a text, and return one image of each prompt
+    with its metadata fields."""
+
+    def __init__(self, store_dir, metadata_path, index_path=None):
+        self.store = open_store(store_dir)
+        self.vectors, self.row_hashes = self.store.get_all()
+        self.model = None
+        self.model_lock = Lock()
+
+        index_path = index_path or join(store_dir, "ivf-index.npz")
+        self.index = load_index(index_path, self.vectors)
+
+        # The first image of each prompt, keyed by the prompt hash. Images
+        # without a prompt are never a search result
+        self.metadata_df = pd.read_parquet(metadata_path)
+        first_image_df = self.metadata_df[
+            self.metadata_df["prompt"].notna()
+        ].drop_duplicates("prompt")
+        self.image_rows = pd.Series(
+            first_image_df.index.to_numpy(),
+            index=[hash_string(p) for p in first_image_df["prompt"]],
+        )
+
+    def embed(self, text):
+        """
+        Embed a query text. The model is loaded at the first query, once even
+        if several server threads ask for it at the same time.
+        """
+        if self.model is None:
+            with self.model_lock:
+                if self.model is None:
+                    self.model = load_embedding_model(self.store.meta["model"])
+        return self.model.predict([text])[0]
+
+    def search(self, text, k=10, n_probe=N_PROBE):
+        """Search prompts similar to a text.
+
+        Args:
+            text (string): Query text
+            k (int): Number of results
+            n_probe (int): Number of lists to scan
+
+        Returns:
+            [dict]: Metadata fields of one image of each similar prompt, with
+                its similarity score
+        """
+        query = self.embed(text)
+
+        # Some stored prompts are only in the other metadata table, fetch more
+        # hits until k of them have an image or the probed lists run out
+        fetch_k = k
+        while True:
+            rows, scores = self.index.search(self.vectors, query, fetch_k, n_probe)
+            image_rows = [self.image_rows.get(int(self.row_hashes[r])) for r in rows]
+            hits = [(i, s) for i, s in zip(image_rows, scores) if i is not None]
+
+            if len(hits) >= k or len(rows) < fetch_k:
+                break
+            fetch_k *= 2
+
+        results = []
+        for image_row, score in hits[:k]:
+            result_df = self.metadata_df.iloc[[image_row]]
+            result = loads(result_df.to_json(orient="records", date_format="iso"))[0]
+            result["score"] = float(score)
+            results.append(result)
+
+        return results
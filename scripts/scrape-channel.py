@@ -6,33 +6,69 @@ from PIL import Image
 from PIL.PngImagePlugin import PngInfo
 from copy import deepcopy
 from tqdm import tqdm
-from json import load, dump
+from json import load, dump, dumps
 from multiprocessing import Pool
-from collections import ChainMap
-from sys import argv
+from functools import partial
 
 import re
 import os
+import argparse
 import uuid
 import shutil
 import time
 import random
 import PIL
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 
 # Change WORK_DIR to where the chat logs are stored
 WORK_DIR = "/project/zwang3049/prompt/"
 N_PROC = 36
-CHANNEL = ""
 
-if len(argv) > 1:
-    CHANNEL = argv[1]
+# Linux ioctl request number to clone a file's extents (reflink)
+FICLONE = 0x40049409
+
+# Namespace for deterministic image names derived from discord message ids
+IMAGE_NAME_NAMESPACE = uuid.uuid5(
+    uuid.NAMESPACE_URL, "https://poloclub.github.io/diffusiondb"
+)
+
+parser = argparse.ArgumentParser(description="Scrape images from a chat log")
+parser.add_argument("channel", nargs="?", default="", help="Channel name")
+parser.add_argument(
+    "-l",
+    "--link",
+    type=str,
+    default="copy",
+    choices=["copy", "move", "hardlink", "reflink", "auto"],
+    help=(
+        "How to place non-grid images into the processed directory. 'reflink' "
+        "and 'hardlink' fall back to copy when the filesystem does not support "
+        "them, 'auto' tries reflink, then hardlink, then copy"
+    ),
+)
+parser.add_argument(
+    "-i",
+    "--incremental",
+    default=False,
+    help="Only scrape messages newer than the channel checkpoint",
+    action="store_true",
+)
+args = parser.parse_args()
+
+CHANNEL = args.channel
+LINK_MODE = args.link
+INCREMENTAL = args.incremental
 
 IMAGE_DIR = join(WORK_DIR, f"{CHANNEL}")
 HTML_DIR = join(WORK_DIR, f"{CHANNEL}-htmls")
 PROCESSED_DIR = join(WORK_DIR, f"{CHANNEL}-processed")
+CHECKPOINT_PATH = join(WORK_DIR, f"{CHANNEL}-checkpoint.json")
 UNIQUE_PROMPT = True
-COPY_FILE = True
 
 if not exists(HTML_DIR):
     os.makedirs(HTML_DIR)
@@ -41,41 +77,109 @@ if not exists(PROCESSED_DIR):
     os.makedirs(PROCESSED_DIR)
 
 
-def split_html():
+def load_checkpoint():
+    """
+    Load the last scraped message id and timestamp of this channel.
+    """
+    if not exists(CHECKPOINT_PATH):
+        return {"last_message_id": 0, "last_timestamp": ""}
+
+    return load(open(CHECKPOINT_PATH, "r", encoding="utf8"))
+
+
+def has_new_message(html_chunk, last_message_id):
+    """
+    Check if an html chunk contains any message newer than last_message_id.
+    """
+    message_ids = re.findall(r'data-message-id="(\d+)"', html_chunk)
+    return any([int(m) > last_message_id for m in message_ids])
+
+
+def split_html(last_message_id=0):
     """
     Split the html file into k files, where each file has 1k lines
-    (~1.7mb per file)
+    (~1.7mb per file). Chunks without any message newer than last_message_id
+    are not written. Return the ids of written chunks.
     """
     with open(join(WORK_DIR, f"{CHANNEL}.html"), "r", encoding="utf8") as fp:
         line_count = 0
         line_per_file = 1000
         chunk_count = 1
         cur_chunk = ""
+        chunk_is = []
+
+        def save_chunk():
+            if last_message_id > 0 and not has_new_message(cur_chunk, last_message_id):
+                return
+
+            with open(
+                join(HTML_DIR, f"{CHANNEL}-{chunk_count:03}.html"),
+                "w",
+                encoding="utf8",
+            ) as wfp:
+                wfp.write(cur_chunk)
+            chunk_is.append(chunk_count)
 
         for line in fp:
             cur_chunk += line
             line_count += 1
 
             if line_count == line_per_file:
-                with open(
-                    join(HTML_DIR, f"{CHANNEL}-{chunk_count:03}.html"),
-                    "w",
-                    encoding="utf8",
-                ) as wfp:
-                    wfp.write(cur_chunk)
-                    line_count = 0
-                    chunk_count += 1
-                    cur_chunk = ""
+                save_chunk()
+                line_count = 0
+                chunk_count += 1
+                cur_chunk = ""
 
         # Save the last file
         if cur_chunk != "":
-            with open(
-                join(HTML_DIR, f"{CHANNEL}-{chunk_count:03}.html"), "w", encoding="utf8"
-            ) as wfp:
-                wfp.write(cur_chunk)
-            return chunk_count
-        else:
-            return chunk_count - 1
+            save_chunk()
+
+        return chunk_is
+
+
+def get_message_id(tag):
+    """
+    Get the discord message id (int) of the message containing this tag.
+    Return None if the chat log does not record message ids.
+    """
+    message_tag = tag.find_parent(attrs={"data-message-id": True})
+
+    if message_tag is None:
+        message_tag = tag.find(attrs={"data-message-id": True})
+
+    if message_tag is None:
+        return None
+
+    return int(message_tag["data-message-id"])
+
+
+def get_image_name(message_id, tile_i):
+    """Create the image name. Names derived from the message id and the tile
+    index are stable across runs, so re-scraping a message overwrites its
+    images instead of duplicating them.
+
+    Args:
+        message_id (int): Discord message id, None to use a random name
+        tile_i (int): Index of the image in the message
+
+    Returns:
+        string: Image file name
+    """
+    if message_id is None:
+        return f"{str(uuid.uuid4())}.png"
+
+    return f"{uuid.uuid5(IMAGE_NAME_NAMESPACE, f'{message_id}-{tile_i}')}.png"
+
+
+def pick_one_index(message_id, count):
+    """
+    Pick a random image index. The choice is seeded by the message id so the
+    same image is kept across runs.
+    """
+    if message_id is None:
+        return random.choice(range(count))
+
+    return random.Random(message_id).choice(range(count))
 
 
 def parse_bot_command(raw_command):
@@ -132,6 +236,7 @@ def split_image(
     seeds,
     individual_commands,
     only_keep_one,
+    message_id=None,
 ):
     """Split the grid image into four images. Save each image with prompt and seed
     as metadata. Add each image into the image_index.
@@ -145,17 +250,21 @@ def split_image(
         seeds ([string]): A list of seeds
         individual_commands ([string]): A list of commands
         only_keep_one (bool): True if only extract a random image in the collage
+        message_id (int): Discord message id used to name the images
+
+    Returns:
+        int: Number of bytes written
     """
 
     if len(seeds) != image_count and len(individual_commands) != image_count:
         print("Error: missing seeds and individual_commands")
-        return
+        return 0
 
     try:
         img = Image.open(image_real_path)
     except PIL.UnidentifiedImageError:
         print("Error: PIL.UnidentifiedImageError")
-        return
+        return 0
 
     width, height = img.size
 
@@ -224,8 +333,11 @@ def split_image(
         Args:
             i (int): Index
             coord ([int]): Coordinate
+
+        Returns:
+            int: Number of bytes written
         """
-        image_name = f"{str(uuid.uuid4())}.png"
+        image_name = get_image_name(message_id, i)
         new_image_path = join(PROCESSED_DIR, image_name)
         new_image = img.crop(coord)
 
@@ -242,7 +354,7 @@ def split_image(
                 local_metadata = parse_bot_command(individual_commands[i])
                 local_metadata["a"] = artist_name
             except (AttributeError, ValueError, TypeError):
-                return
+                return 0
 
         # Add metadata
         png_info = PngInfo()
@@ -254,20 +366,96 @@ def split_image(
 
         # Add image to the image_index
         image_index[image_name] = local_metadata
+        return os.path.getsize(new_image_path)
+
+    bytes_written = 0
 
     if only_keep_one:
         # Choose a random coordinate to process
-        random_i = random.choice(range(len(coords)))
-        process_one_coord(random_i, coords[random_i])
+        random_i = pick_one_index(message_id, len(coords))
+        bytes_written += process_one_coord(random_i, coords[random_i])
     else:
         # Process all coordinates
         for i, coord in enumerate(coords):
-            process_one_coord(i, coord)
+            bytes_written += process_one_coord(i, coord)
 
+    return bytes_written
 
-def copy_one_image(image_attachments, metadata, image_index):
+
+def reflink_file(src_path, dst_path):
+    """Clone src_path into a new file dst_path without copying the data
+    blocks. Raise OSError if the filesystem does not support reflinks.
+
+    Args:
+        src_path (string): Source file path
+        dst_path (string): Destination file path, it must not exist
     """
-    Copy one image to the processed directory.
+    if fcntl is None:
+        raise OSError("Reflink is not supported on this platform")
+
+    # "xb" never opens an existing file, so a failed clone can not truncate it
+    with open(src_path, "rb") as src_fp, open(dst_path, "xb") as dst_fp:
+        try:
+            fcntl.ioctl(dst_fp.fileno(), FICLONE, src_fp.fileno())
+        except OSError:
+            # Do not leave an empty file behind for the fallback
+            dst_fp.close()
+            os.remove(dst_path)
+            raise
+
+
+def place_image(image_real_path, new_image_path):
+    """Place one image into the processed directory following LINK_MODE. The
+    image is first placed at a temporary path next to the destination, then
+    renamed onto it, so an existing destination is never written into.
+
+    Args:
+        image_real_path (string): Source image path
+        new_image_path (string): Destination image path
+
+    Returns:
+        int: Number of bytes actually written to disk (0 if the image is
+            linked or renamed instead of copied, or is already in place)
+    """
+    # A re-run finds the hardlink (or the moved file) of an earlier run
+    if exists(new_image_path) and (
+        not exists(image_real_path)
+        or os.path.samefile(image_real_path, new_image_path)
+    ):
+        return 0
+
+    if LINK_MODE == "move":
+        shutil.move(image_real_path, new_image_path)
+        return 0
+
+    tmp_path = f"{new_image_path}.tmp-{uuid.uuid4().hex}"
+
+    def finish(bytes_written):
+        os.replace(tmp_path, new_image_path)
+        return bytes_written
+
+    if LINK_MODE in ["reflink", "auto"]:
+        try:
+            reflink_file(image_real_path, tmp_path)
+            return finish(0)
+        except OSError:
+            pass
+
+    if LINK_MODE in ["hardlink", "auto"]:
+        try:
+            os.link(image_real_path, tmp_path)
+            return finish(0)
+        except OSError:
+            pass
+
+    shutil.copyfile(image_real_path, tmp_path)
+    return finish(os.path.getsize(tmp_path))
+
+
+def copy_one_image(image_attachments, metadata, image_index, message_id=None):
+    """
+    Copy one image to the processed directory. Return the number of bytes
+    written.
     """
 
     # Get the image path
@@ -275,22 +463,20 @@ def copy_one_image(image_attachments, metadata, image_index):
         image_path = image_attachments[0].find("img")["src"]
         image_path = unquote(image_path)
     except (AttributeError, ValueError, TypeError):
-        return
+        return 0
 
     image_basename = basename(image_path)
     image_real_path = join(IMAGE_DIR, image_basename)
 
-    image_name = f"{str(uuid.uuid4())}.png"
+    image_name = get_image_name(message_id, 0)
     new_image_path = join(PROCESSED_DIR, image_name)
 
     # Copy the image
-    if COPY_FILE:
-        shutil.copyfile(image_real_path, new_image_path)
-    else:
-        shutil.move(image_real_path, new_image_path)
+    bytes_written = place_image(image_real_path, new_image_path)
 
     # Add image to the image_index
     image_index[image_name] = metadata
+    return bytes_written
 
 
 def copy_multiple_images(
@@ -301,6 +487,7 @@ def copy_multiple_images(
     seeds,
     individual_commands,
     only_keep_one,
+    message_id=None,
 ):
     """Copy separate multiple images with different seeds.
 
@@ -313,12 +500,16 @@ def copy_multiple_images(
         individual_commands ([string]): Individual commands
         only_keep_one (bool): True if only copy a random image of all images
             with the same prompt
+        message_id (int): Discord message id used to name the images
+
+    Returns:
+        int: Number of bytes written
     """
     if len(seeds) != len(image_attachments) and len(individual_commands) != len(
         image_attachments
     ):
         print("Error: missing seeds and individual_commands")
-        return
+        return 0
 
     def process_one_image(i, image_tag):
         # Get the image path
@@ -326,12 +517,12 @@ def copy_multiple_images(
             image_path = image_tag.find("img")["src"]
             image_path = unquote(image_path)
         except (AttributeError, ValueError, TypeError):
-            return
+            return 0
 
         image_basename = basename(image_path)
         image_real_path = join(IMAGE_DIR, image_basename)
 
-        image_name = f"{str(uuid.uuid4())}.png"
+        image_name = get_image_name(message_id, i)
         new_image_path = join(PROCESSED_DIR, image_name)
 
         # Two cases for handling the local meta data
@@ -347,25 +538,27 @@ def copy_multiple_images(
                 local_metadata = parse_bot_command(individual_commands[i])
                 local_metadata["a"] = artist_name
             except (AttributeError, ValueError, TypeError):
-                return
+                return 0
 
         # Copy the image
-        if COPY_FILE:
-            shutil.copyfile(image_real_path, new_image_path)
-        else:
-            shutil.move(image_real_path, new_image_path)
+        bytes_written = place_image(image_real_path, new_image_path)
 
         # Add image to the image_index
         image_index[image_name] = local_metadata
+        return bytes_written
+
+    bytes_written = 0
 
     if only_keep_one:
         # Only save one random image
-        random_i = random.choice(range(len(image_attachments)))
-        process_one_image(random_i, image_attachments[random_i])
+        random_i = pick_one_index(message_id, len(image_attachments))
+        bytes_written += process_one_image(random_i, image_attachments[random_i])
     else:
         # Save all images
         for i, image_tag in enumerate(image_attachments):
-            process_one_image(i, image_tag)
+            bytes_written += process_one_image(i, image_tag)
+
+    return bytes_written
 
 
 def is_grid_mode(dream_command, message_group):
@@ -417,9 +610,10 @@ def is_grid_mode(dream_command, message_group):
     return "non-grid"
 
 
-def scrape_one_html(cur_file_i):
+def scrape_one_html(cur_file_i, last_message_id=0):
     """
-    Scrape prompts and grid images from one html chunk file.
+    Scrape prompts and grid images from one html chunk file. Messages with ids
+    not greater than last_message_id have been scraped before and are skipped.
     """
 
     cur_html = join(HTML_DIR, f"{CHANNEL}-{cur_file_i:03}.html")
@@ -430,6 +624,9 @@ def scrape_one_html(cur_file_i):
 
     image_index = {}
     error_count = 0
+    bytes_written = 0
+    max_message_id = last_message_id
+    max_timestamp = ""
 
     for message_group in soup.find_all(
         "div", attrs={"class", "chatlog__message-group"}
@@ -440,6 +637,24 @@ def scrape_one_html(cur_file_i):
             error_count += 1
             break
 
+        # Skip message groups that are scraped in previous runs
+        message_ids = [
+            int(t["data-message-id"])
+            for t in message_group.find_all(attrs={"data-message-id": True})
+        ]
+        if len(message_ids) > 0:
+            message_id = max(message_ids)
+            if message_id <= last_message_id:
+                continue
+
+            if message_id > max_message_id:
+                max_message_id = message_id
+                timestamp_tag = message_group.find(
+                    "span", attrs={"class", "chatlog__timestamp"}
+                )
+                if timestamp_tag is not None:
+                    max_timestamp = timestamp_tag.text.strip()
+
         # This message is posted by the stable diffusion bot
         if author_tag.text == "DreamBotMothership":
 
@@ -461,6 +676,14 @@ def scrape_one_html(cur_file_i):
                 if "!dream" not in inline_md_code.text:
                     continue
 
+                # A message group can have old and new messages
+                command_message_id = get_message_id(inline_md_code)
+                if (
+                    command_message_id is not None
+                    and command_message_id <= last_message_id
+                ):
+                    continue
+
                 # Check if it is grid mode
                 message_mode = is_grid_mode(inline_md_code.text, message_group)
                 if message_mode == "grid":
@@ -540,7 +763,7 @@ def scrape_one_html(cur_file_i):
                         break
 
                     # Split, save, and index images
-                    split_image(
+                    bytes_written += split_image(
                         image_real_path,
                         image_count,
                         artist_name,
@@ -549,6 +772,7 @@ def scrape_one_html(cur_file_i):
                         seeds,
                         individual_commands,
                         UNIQUE_PROMPT,
+                        command_message_id,
                     )
 
                     break
@@ -573,7 +797,9 @@ def scrape_one_html(cur_file_i):
                     metadata["a"] = artist_name
 
                     if len(image_attachments) == 1:
-                        copy_one_image(image_attachments, metadata, image_index)
+                        bytes_written += copy_one_image(
+                            image_attachments, metadata, image_index, command_message_id
+                        )
                         break
 
                     elif len(image_attachments) > 1:
@@ -603,7 +829,7 @@ def scrape_one_html(cur_file_i):
                                 error_count += 1
                                 break
 
-                        copy_multiple_images(
+                        bytes_written += copy_multiple_images(
                             image_attachments,
                             artist_name,
                             metadata,
@@ -611,6 +837,7 @@ def scrape_one_html(cur_file_i):
                             seeds,
                             individual_commands,
                             UNIQUE_PROMPT,
+                            command_message_id,
                         )
                         break
 
@@ -626,10 +853,22 @@ def scrape_one_html(cur_file_i):
 
     print("Parsing error count:", error_count)
 
-    # Save the image index
-    image_index_path = join(HTML_DIR, f"{CHANNEL}-{cur_file_i:03}.json")
-    dump(image_index, open(image_index_path, "w", encoding="utf8"))
-    return image_index
+    # Save the image index as one json line per image, so the parent process
+    # only needs to concatenate chunk files
+    image_index_path = join(HTML_DIR, f"{CHANNEL}-{cur_file_i:03}.jsonl")
+    with open(image_index_path, "w", encoding="utf8") as fp:
+        for image_name in image_index:
+            fp.write(dumps({"image_name": image_name, **image_index[image_name]}))
+            fp.write("\n")
+
+    return {
+        "chunk": cur_file_i,
+        "path": image_index_path,
+        "rows": len(image_index),
+        "bytes_written": bytes_written,
+        "max_message_id": max_message_id,
+        "max_timestamp": max_timestamp,
+    }
 
 
 def main():
@@ -637,21 +876,68 @@ def main():
     Main function
     """
 
+    # Only scrape new messages in the incremental mode
+    checkpoint = load_checkpoint() if INCREMENTAL else None
+    last_message_id = checkpoint["last_message_id"] if INCREMENTAL else 0
+
     # Split the html file into chunks
-    chunk_count = split_html()
-    chunk_is = list(range(1, chunk_count + 1))
+    chunk_is = split_html(last_message_id)
     start_time = time.time()
 
     # Scrape html files in parallel
     with Pool(N_PROC) as p:
-        image_indexes = list(
-            tqdm(p.imap(scrape_one_html, chunk_is), total=len(chunk_is))
+        results = list(
+            tqdm(
+                p.imap(
+                    partial(scrape_one_html, last_message_id=last_message_id),
+                    chunk_is,
+                ),
+                total=len(chunk_is),
+            )
         )
 
-    # Join all image_indexes and save one json file
-    flatten_image_indexes = dict(ChainMap(*image_indexes))
-    flatten_image_indexes_path = join(WORK_DIR, f"{CHANNEL}-grid.json")
-    dump(flatten_image_indexes, open(flatten_image_indexes_path, "w", encoding="utf8"))
+    bytes_written = sum([r["bytes_written"] for r in results])
+    print(f"Wrote {bytes_written / 1024**3:.2f} GB of images ({LINK_MODE} mode)")
+
+    # Concatenate all chunk indexes into one json lines table (it can be loaded
+    # with pd.read_json(path, lines=True)). Images from previous runs are kept
+    # in the incremental mode.
+    image_index_path = join(WORK_DIR, f"{CHANNEL}-grid.jsonl")
+    manifest_path = join(WORK_DIR, f"{CHANNEL}-grid-manifest.json")
+    manifest = {"chunks": [], "rows": 0}
+
+    if INCREMENTAL and exists(manifest_path):
+        manifest = load(open(manifest_path, "r", encoding="utf8"))
+
+    write_mode = "a" if INCREMENTAL else "w"
+    with open(image_index_path, write_mode, encoding="utf8") as wfp:
+        for result in results:
+            with open(result["path"], "r", encoding="utf8") as fp:
+                shutil.copyfileobj(fp, wfp)
+
+            manifest["chunks"].append(
+                {
+                    "chunk": result["chunk"],
+                    "rows": result["rows"],
+                    "max_message_id": result["max_message_id"],
+                }
+            )
+            manifest["rows"] += result["rows"]
+
+    dump(manifest, open(manifest_path, "w", encoding="utf8"))
+    print("Indexed", manifest["rows"], "images in total")
+
+    # Update the checkpoint with the newest message we have seen
+    if checkpoint is None:
+        checkpoint = {"last_message_id": 0, "last_timestamp": ""}
+
+    for result in results:
+        if result["max_message_id"] > checkpoint["last_message_id"]:
+            checkpoint["last_message_id"] = result["max_message_id"]
+            checkpoint["last_timestamp"] = result["max_timestamp"]
+
+    dump(checkpoint, open(CHECKPOINT_PATH, "w", encoding="utf8"))
+    print("Checkpoint", checkpoint)
 
     print("Finished in", (time.time() - start_time) / 60, "minutes")
 
@@ -8,20 +8,34 @@ from json import load, dump
 from multiprocessing import Pool
 from collections import ChainMap
 from datetime import datetime, timezone
+from array import array
 
 import re
 import os
 import time
-import pickle
 
 import pandas as pd
 import numpy as np
 
+from prompt_hash import hash_string
 
 WORK_DIR = "/project/zwang3049/discord-log/"
 TIMESTAMP_DIR = "/project/zwang3049/discord-log/timestamps-authors"
 N_PROC = 36
 
+# Same sampler codes as the sampler column in metadata.parquet
+SAMPLER_CODES = {
+    "ddim": 1,
+    "plms": 2,
+    "k_euler": 3,
+    "k_euler_ancestral": 4,
+    "k_heun": 5,
+    "k_dpm_2": 6,
+    "k_dpm_2_ancestral": 7,
+    "k_lms": 8,
+}
+OTHER_SAMPLER_CODE = 9
+
 
 def is_grid_mode(dream_command, message_group):
     """
@@ -167,9 +181,45 @@ def get_utc_datetime(time_str):
     return datetime.fromtimestamp(parsed_time.timestamp(), tz=timezone.utc)
 
 
-def update_timestamp_map(
-    chanel_timestamp_map,
-    chanel_timestamp_collisions,
+# Largest value of the integer columns, larger values are saved as nulls
+MAX_SEED = 2**32 - 1
+MAX_STEP = 2**16 - 1
+MAX_SIZE = 2**16 - 1
+
+
+def get_column_value(value, max_value):
+    """
+    Get the column value of an integer field. Values that are not integers in
+    [0, max_value] become -1, which is saved as a null.
+    """
+    if isinstance(value, int) and 0 <= value <= max_value:
+        return value
+    return -1
+
+
+def new_timestamp_columns():
+    """
+    Create typed column buffers to collect timestamps from one channel. Each
+    row takes ~70 bytes instead of a tuple of seven strings and a datetime.
+    """
+    return {
+        "key": array("Q"),
+        "prompt_hash": array("Q"),
+        "seed": array("q"),
+        "cfg": array("f"),
+        "step": array("q"),
+        "sampler": array("B"),
+        "width": array("q"),
+        "height": array("q"),
+        "timestamp": array("q"),
+        "author": array("L"),
+        # Author name => author code
+        "author_codes": {},
+    }
+
+
+def add_timestamp_row(
+    timestamp_columns,
     prompt,
     seed,
     cfg,
@@ -181,42 +231,129 @@ def update_timestamp_map(
     timestamp,
 ):
     """
-    Update the timestamp dictionary. Return collision count.
+    Add one image to the timestamp columns. Collisions are detected on the
+    hashed key when the columns are saved. Return the number of out-of-range
+    seed, step, width, and height values, which are saved as nulls.
     """
-    collision_count = 0
     # Make all key elements string to avoid float('nan') != float('nan') weirdness
-    cur_key = (
-        prompt,
-        str(seed),
-        str(cfg),
-        str(step),
-        str(sampler),
-        str(width),
-        str(height),
+    cur_key = "\0".join(
+        [
+            prompt,
+            str(seed),
+            str(cfg),
+            str(step),
+            str(sampler),
+            str(width),
+            str(height),
+        ]
+    )
+
+    author_codes = timestamp_columns["author_codes"]
+    if author not in author_codes:
+        author_codes[author] = len(author_codes)
+
+    # Seed is an empty string if the user does not specify it
+    values = {
+        "seed": get_column_value(seed, MAX_SEED),
+        "step": get_column_value(step, MAX_STEP),
+        "width": get_column_value(width, MAX_SIZE),
+        "height": get_column_value(height, MAX_SIZE),
+    }
+    out_of_range_count = sum(
+        values[name] < 0 and not (name == "seed" and seed == "")
+        for name in values
+    )
+
+    timestamp_columns["key"].append(hash_string(cur_key))
+    timestamp_columns["prompt_hash"].append(hash_string(prompt))
+    timestamp_columns["seed"].append(values["seed"])
+    timestamp_columns["cfg"].append(cfg)
+    timestamp_columns["step"].append(values["step"])
+    timestamp_columns["sampler"].append(
+        SAMPLER_CODES.get(sampler, OTHER_SAMPLER_CODE)
+    )
+    timestamp_columns["width"].append(values["width"])
+    timestamp_columns["height"].append(values["height"])
+    timestamp_columns["timestamp"].append(int(timestamp.timestamp()))
+    timestamp_columns["author"].append(author_codes[author])
+
+    return out_of_range_count
+
+
+def get_uint_column(values, dtype):
+    """
+    Convert an int64 column buffer into a nullable unsigned column, where -1
+    is a null.
+    """
+    values = np.frombuffer(values, dtype=np.int64)
+    return pd.Series(np.maximum(values, 0).astype(dtype.lower()), dtype=dtype).mask(
+        values < 0
+    )
+
+
+def timestamp_columns_to_df(timestamp_columns):
+    """
+    Convert the timestamp columns into a typed data frame.
+    """
+    author_names = np.empty(len(timestamp_columns["author_codes"]), dtype=object)
+    for name, code in timestamp_columns["author_codes"].items():
+        author_names[code] = name
+
+    return pd.DataFrame(
+        {
+            "key": np.frombuffer(timestamp_columns["key"], dtype=np.uint64),
+            "prompt_hash": np.frombuffer(
+                timestamp_columns["prompt_hash"], dtype=np.uint64
+            ),
+            "seed": get_uint_column(timestamp_columns["seed"], "UInt32"),
+            "cfg": np.frombuffer(timestamp_columns["cfg"], dtype=np.float32),
+            "step": get_uint_column(timestamp_columns["step"], "UInt16"),
+            "sampler": np.frombuffer(timestamp_columns["sampler"], dtype=np.uint8),
+            "width": get_uint_column(timestamp_columns["width"], "UInt16"),
+            "height": get_uint_column(timestamp_columns["height"], "UInt16"),
+            "timestamp": pd.to_datetime(
+                np.frombuffer(timestamp_columns["timestamp"], dtype=np.int64),
+                unit="s",
+                utc=True,
+            ),
+            "user_name": pd.Categorical.from_codes(
+                np.array(timestamp_columns["author"]).astype(np.int64),
+                categories=author_names,
+            ),
+        }
     )
 
-    if cur_key in chanel_timestamp_map:
-        # Collision: add the timestamp to a different map
-        collision_count += 1
-        if cur_key in chanel_timestamp_collisions:
-            chanel_timestamp_collisions[cur_key].append((timestamp, author))
-        else:
-            # Add the old and new timestamps
-            chanel_timestamp_collisions[cur_key] = [
-                chanel_timestamp_map[cur_key],
-                (timestamp, author),
-            ]
-    else:
-        chanel_timestamp_map[cur_key] = (timestamp, author)
+
+def save_timestamp_df(timestamp_df, channel):
+    """Save the timestamps of one channel into two parquet files. The timestamp
+    table keeps the first image of each key, and the collision table keeps all
+    images whose key appears more than once.
+
+    Args:
+        timestamp_df (DataFrame): Timestamps of this channel in message order
+        channel (string): Channel name
+
+    Returns:
+        int: Number of collisions
+    """
+    # Detect collisions with the hashed key
+    is_collision = timestamp_df["key"].duplicated(keep=False).to_numpy()
+    collision_count = int(timestamp_df["key"].duplicated(keep="first").sum())
+
+    timestamp_df.drop_duplicates("key", keep="first").to_parquet(
+        join(TIMESTAMP_DIR, f"{channel}-timestamp.parquet"), index=False
+    )
+    timestamp_df[is_collision].to_parquet(
+        join(TIMESTAMP_DIR, f"{channel}-timestamp-collision.parquet"), index=False
+    )
 
     return collision_count
 
 
-def scrape_one_html(
-    channel, cur_file_i, chanel_timestamp_map, chanel_timestamp_collisions
-):
+def scrape_one_html(channel, cur_file_i, timestamp_columns):
     """
-    Scrape prompts and grid images from one html chunk file.
+    Scrape prompts and grid images from one html chunk file. Return the parsing
+    error count.
     """
 
     HTML_DIR = join(WORK_DIR, f"{channel}-htmls")
@@ -227,7 +364,6 @@ def scrape_one_html(
         soup = BeautifulSoup(fp, "html.parser")
 
     error_count = 0
-    collision_count = 0
 
     for message_group in soup.find_all(
         "div", attrs={"class", "chatlog__message-group"}
@@ -356,9 +492,8 @@ def scrape_one_html(
                             width = metadata["w"]
                             height = metadata["h"]
                             author = artist_name
-                            collision_count += update_timestamp_map(
-                                chanel_timestamp_map,
-                                chanel_timestamp_collisions,
+                            error_count += add_timestamp_row(
+                                timestamp_columns,
                                 prompt,
                                 seed,
                                 cfg,
@@ -385,9 +520,8 @@ def scrape_one_html(
                                 width = local_metadata["w"]
                                 height = local_metadata["h"]
                                 author = artist_name
-                                collision_count += update_timestamp_map(
-                                    chanel_timestamp_map,
-                                    chanel_timestamp_collisions,
+                                error_count += add_timestamp_row(
+                                    timestamp_columns,
                                     prompt,
                                     seed,
                                     cfg,
@@ -434,9 +568,8 @@ def scrape_one_html(
                         width = metadata["w"]
                         height = metadata["h"]
                         author = artist_name
-                        collision_count += update_timestamp_map(
-                            chanel_timestamp_map,
-                            chanel_timestamp_collisions,
+                        error_count += add_timestamp_row(
+                            timestamp_columns,
                             prompt,
                             seed,
                             cfg,
@@ -490,9 +623,8 @@ def scrape_one_html(
                                 width = metadata["w"]
                                 height = metadata["h"]
                                 author = artist_name
-                                collision_count += update_timestamp_map(
-                                    chanel_timestamp_map,
-                                    chanel_timestamp_collisions,
+                                error_count += add_timestamp_row(
+                                    timestamp_columns,
                                     prompt,
                                     seed,
                                     cfg,
@@ -519,9 +651,8 @@ def scrape_one_html(
                                     width = local_metadata["w"]
                                     height = local_metadata["h"]
                                     author = artist_name
-                                    collision_count += update_timestamp_map(
-                                        chanel_timestamp_map,
-                                        chanel_timestamp_collisions,
+                                    error_count += add_timestamp_row(
+                                        timestamp_columns,
                                         prompt,
                                         seed,
                                         cfg,
@@ -548,37 +679,54 @@ def scrape_one_html(
                     error_count += 1
                     break
 
-    return collision_count
+    return error_count
 
 
-def scrape_one_channel(channel):
-    """
-    Scrape the timestamps from one channel.
-    """
+def scrape_one_chunk(work_item):
+    """Scrape the timestamps from one html chunk of one channel.
 
-    # Dictionary to keep track of the timestamp mappings
-    chanel_timestamp_map = {}
-    chanel_timestamp_collisions = {}
-    collision_count = 0
+    Args:
+        work_item ((string, int)): Channel name and chunk id
 
-    HTML_DIR = join(WORK_DIR, f"{channel}-htmls")
-    chunk_count = len(glob(join(HTML_DIR, "*.html")))
-    for i in range(1, chunk_count + 1):
-        collision_count += scrape_one_html(
-            channel, i, chanel_timestamp_map, chanel_timestamp_collisions
-        )
+    Returns:
+        (string, int, DataFrame, int): Channel name, chunk id, the timestamps,
+            and the number of parsing errors
+    """
+    channel, cur_file_i = work_item
 
-    # Save the dictionaries
-    pickle.dump(
-        chanel_timestamp_map,
-        open(join(TIMESTAMP_DIR, f"{channel}-timestamp.pkl"), "wb"),
+    # Typed columns to keep track of the timestamp mappings
+    timestamp_columns = new_timestamp_columns()
+    error_count = scrape_one_html(channel, cur_file_i, timestamp_columns)
+
+    return (
+        channel,
+        cur_file_i,
+        timestamp_columns_to_df(timestamp_columns),
+        error_count,
     )
-    pickle.dump(
-        chanel_timestamp_collisions,
-        open(join(TIMESTAMP_DIR, f"{channel}-timestamp-collision.pkl"), "wb"),
+
+
+def reduce_one_channel(channel, chunk_dfs, error_count):
+    """Join the chunk timestamps of one channel in message order and save them.
+
+    Args:
+        channel (string): Channel name
+        chunk_dfs (dict): Chunk id => timestamps of this chunk
+        error_count (int): Number of parsing errors in all chunks
+
+    Returns:
+        int: Number of collisions
+    """
+    if error_count > 0:
+        print(f"{channel}: {error_count} parsing errors")
+
+    timestamp_df = pd.concat(
+        [chunk_dfs[i] for i in sorted(chunk_dfs)], ignore_index=True
     )
 
-    return collision_count
+    # Each chunk has its own user name categories
+    timestamp_df["user_name"] = timestamp_df["user_name"].astype("category")
+    return save_timestamp_df(timestamp_df, channel)
 
 
 def main():
@@ -590,13 +738,41 @@ def main():
     for i in range(1, 51):
         channels.append(f"dream-{i}")
 
-    # Scrape channels in parallel
+    # Use html chunks across all channels as work items, so large channels do
+    # not keep the last few processes busy while others are idle
+    work_items = []
+    channel_chunk_counts = {}
+    for channel in channels:
+        HTML_DIR = join(WORK_DIR, f"{channel}-htmls")
+        chunk_count = len(glob(join(HTML_DIR, "*.html")))
+        channel_chunk_counts[channel] = chunk_count
+        for i in range(1, chunk_count + 1):
+            work_items.append((channel, i))
+
+    # Scrape chunks in parallel, and reduce a channel once all its chunks are
+    # scraped
+    collision_counts = []
+    channel_chunk_dfs = {channel: {} for channel in channels}
+    channel_error_counts = {channel: 0 for channel in channels}
+
     with Pool(N_PROC) as p:
-        collision_counts = list(
-            tqdm(p.imap(scrape_one_channel, channels), total=len(channels))
-        )
+        for channel, i, chunk_df, error_count in tqdm(
+            p.imap_unordered(scrape_one_chunk, work_items), total=len(work_items)
+        ):
+            channel_chunk_dfs[channel][i] = chunk_df
+            channel_error_counts[channel] += error_count
+
+            if len(channel_chunk_dfs[channel]) == channel_chunk_counts[channel]:
+                collision_counts.append(
+                    reduce_one_channel(
+                        channel,
+                        channel_chunk_dfs.pop(channel),
+                        channel_error_counts[channel],
+                    )
+                )
 
     print("Total collisions", np.sum(collision_counts))
+    print("Total parsing errors", sum(channel_error_counts.values()))
     print("Finished in", (time.time() - start_time) / 60, "minutes")
 
 
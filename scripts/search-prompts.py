@@ -0,0 +1,73 @@
+from os.path import join
+
+import time
+import argparse
+
+from prompt_index import PromptIndex, SAMPLER_CODES
+
+WORK_DIR = "/nvmescratch/jay/diffusiondb"
+
+parser = argparse.ArgumentParser(
+    description='Search prompts, for example: \'"greg rutkowski" AND artstation\''
+)
+parser.add_argument("query", type=str, help="Boolean query of words and phrases")
+parser.add_argument(
+    "-l",
+    "--large",
+    default=False,
+    help="Search DiffusionDB Large instead of DiffusionDB 2M",
+    action="store_true",
+)
+parser.add_argument(
+    "--nsfw_range",
+    type=float,
+    nargs=2,
+    default=None,
+    help="Inclusive image_nsfw range, for example 0 0.5",
+)
+parser.add_argument(
+    "--time_range",
+    type=str,
+    nargs=2,
+    default=None,
+    help="Inclusive UTC timestamp range, for example 2022-08-01 2022-08-15",
+)
+parser.add_argument(
+    "--samplers",
+    type=str,
+    nargs="+",
+    default=None,
+    choices=list(SAMPLER_CODES),
+    help="Allowed samplers",
+)
+parser.add_argument(
+    "-n", "--num_prompts", type=int, default=5, help="Number of prompts to print"
+)
+
+
+def main():
+    """
+    Main function
+    """
+    args = parser.parse_args()
+    index_name = "prompt-index-large" if args.large else "prompt-index-2m"
+    index_dir = join(WORK_DIR, index_name)
+
+    start_time = time.time()
+    prompt_index = PromptIndex(index_dir)
+    print(f"Opened the index in {(time.time() - start_time) * 1000:.1f} ms")
+
+    start_time = time.time()
+    rows = prompt_index.search(
+        args.query, args.nsfw_range, args.time_range, args.samplers
+    )
+    print(f"Found {len(rows)} rows in {(time.time() - start_time) * 1000:.1f} ms")
+
+    # Show a few prompts that match the query (before the column filters)
+    prompt_ids = prompt_index.parse_query(args.query)[: args.num_prompts]
+    for prompt_id in prompt_ids:
+        print("\t" + prompt_index.get_prompt(prompt_id))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+from os.path import join
+from json import dumps
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+import argparse
+import traceback
+
+from prompt_search import PromptSearch, N_PROBE
+
+SHARE_DIR = "/project/zwang3049/diffusiondb-hugging"
+WORK_DIR = "/nvmescratch/jay/diffusiondb"
+STORE_DIR = join(WORK_DIR, "prompt-embeddings")
+
+# Largest k a request can ask for
+MAX_K = 100
+
+parser = argparse.ArgumentParser(
+    description="Serve prompt similarity search on localhost, for example "
+    "GET /search?q=a+cat+in+space&k=10"
+)
+parser.add_argument(
+    "-l",
+    "--large",
+    default=False,
+    help="Return images of DiffusionDB Large instead of DiffusionDB 2M",
+    action="store_true",
+)
+parser.add_argument("-p", "--port", type=int, default=8765, help="Port to listen on")
+
+
+def make_handler(prompt_search):
+    """
+    Create a request handler class that answers with prompt_search.
+    """
+
+    class SearchHandler(BaseHTTPRequestHandler):
+        def send_json(self, status, data):
+            body = dumps(data).encode("utf8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.send_header("Access-Control-Allow-Origin", "*")
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            if url.path != "/search":
+                self.send_json(404, {"error": "Not found"})
+                return
+
+            query = parse_qs(url.query)
+            if "q" not in query:
+                self.send_json(400, {"error": "Missing query parameter q"})
+                return
+
+            try:
+                k = min(int(query.get("k", ["10"])[0]), MAX_K)
+                n_probe = int(query.get("n_probe", [str(N_PROBE)])[0])
+            except ValueError:
+                self.send_json(400, {"error": "k and n_probe must be integers"})
+                return
+
+            n_lists = len(prompt_search.index.centroids)
+            if k < 1 or not 1 <= n_probe <= n_lists:
+                self.send_json(
+                    400,
+                    {"error": f"k must be at least 1, n_probe in [1, {n_lists}]"},
+                )
+                return
+
+            # Keep serving other requests if one search fails
+            try:
+                results = prompt_search.search(query["q"][0], k, n_probe)
+            except Exception:
+                traceback.print_exc()
+                self.send_json(500, {"error": "Search failed"})
+                return
+
+            self.send_json(200, {"results": results})
+
+    return SearchHandler
+
+
+def main():
+    """
+    Main function
+    """
+    args = parser.parse_args()
+
+    if args.large:
+        metadata_path = join(SHARE_DIR, "metadata-large.parquet")
+    else:
+        metadata_path = join(SHARE_DIR, "metadata.parquet")
+
+    prompt_search = PromptSearch(STORE_DIR, metadata_path)
+    print(
+        f"Indexed {prompt_search.store.count} prompts in "
+        f"{len(prompt_search.index.centroids)} lists"
+    )
+
+    # Only listen on localhost
+    server = ThreadingHTTPServer(("127.0.0.1", args.port), make_handler(prompt_search))
+    print(f"Serving on http://127.0.0.1:{args.port}/search?q=...")
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+"""Member index of part zip files for random access without extraction."""
+
+from json import load, dump
+from urllib.request import Request, urlopen
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+
+import os
+import struct
+import zlib
+
+# Size of the fixed part of a zip local file header
+_LOCAL_HEADER_SIZE = 30
+_LOCAL_HEADER_SIGNATURE = b"PK\x03\x04"
+
+# Field order of a member entry in the index
+INDEX_FIELDS = ["offset", "compress_size", "file_size", "crc", "compress_type"]
+
+
+def get_index_path(zip_path):
+    """
+    Get the index path of a zip file: part-000001.zip => part-000001-index.json
+    """
+    return zip_path[: -len(".zip")] + "-index.json"
+
+
+def build_zip_index(zip_path):
+    """Build the member index of a zip file. The offset of each member points
+    to its data (after the local header), so a reader can get a member with one
+    positioned read or one HTTP range request.
+
+    Args:
+        zip_path (string): Path to the zip file
+
+    Returns:
+        dict: {"zip_size": int, "members": {name: [offset, compress_size,
+            file_size, crc, compress_type]}}
+    """
+    members = {}
+
+    with ZipFile(zip_path) as zip_file, open(zip_path, "rb") as fp:
+        for info in zip_file.infolist():
+            # The local header can have a different extra field from the
+            # central directory, so we read its lengths from the local header
+            fp.seek(info.header_offset)
+            local_header = fp.read(_LOCAL_HEADER_SIZE)
+            if local_header[:4] != _LOCAL_HEADER_SIGNATURE:
+                raise ValueError(f"Bad local header of {info.filename}")
+
+            name_length, extra_length = struct.unpack("<HH", local_header[26:30])
+            data_offset = (
+                info.header_offset + _LOCAL_HEADER_SIZE + name_length + extra_length
+            )
+
+            members[info.filename] = [
+                data_offset,
+                info.compress_size,
+                info.file_size,
+                info.CRC,
+                info.compress_type,
+            ]
+
+    return {"zip_size": os.path.getsize(zip_path), "members": members}
+
+
+def save_zip_index(zip_path):
+    """
+    Build the member index of a zip file and save it next to the zip file.
+    Return the index.
+    """
+    zip_index = build_zip_index(zip_path)
+    dump(zip_index, open(get_index_path(zip_path), "w", encoding="utf8"))
+    return zip_index
+
+
+def load_zip_index(zip_path):
+    """
+    Load the saved member index of a zip file.
+    """
+    return load(open(get_index_path(zip_path), "r", encoding="utf8"))
+
+
+def decode_member(data, entry):
+    """Decompress the raw bytes of a member and check its CRC.
+
+    Args:
+        data (bytes): Raw member data from the zip file
+        entry (list): Member entry in the index
+
+    Returns:
+        bytes: Member content
+    """
+    _, _, file_size, crc, compress_type = entry
+
+    if compress_type == ZIP_DEFLATED:
+        data = zlib.decompress(data, -zlib.MAX_WBITS)
+    elif compress_type != ZIP_STORED:
+        raise ValueError(f"Unsupported compression type {compress_type}")
+
+    if len(data) != file_size or zlib.crc32(data) != crc:
+        raise ValueError("Member data does not match the index")
+
+    return data
+
+
+def read_member(fd, entry):
+    """Read one member with a positioned read.
+
+    Args:
+        fd (int): File descriptor of the zip file (from os.open())
+        entry (list): Member entry in the index
+
+    Returns:
+        bytes: Member content
+    """
+    offset, compress_size = entry[0], entry[1]
+    return decode_member(os.pread(fd, compress_size, offset), entry)
+
+
+def fetch_member(url, entry):
+    """Fetch one member from a remote zip file with an HTTP range request.
+
+    Args:
+        url (string): URL of the zip file
+        entry (list): Member entry in the index
+
+    Returns:
+        bytes: Member content
+    """
+    offset, compress_size = entry[0], entry[1]
+    request = Request(
+        url, headers={"Range": f"bytes={offset}-{offset + compress_size - 1}"}
+    )
+
+    with urlopen(request) as response:
+        data = response.read()
+
+    return decode_member(data, entry)